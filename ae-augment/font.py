@@ -0,0 +1,160 @@
+import tensorflow as tf
+import numpy as np
+import argparse
+import os
+import json
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from util import locate, img_loader, prefetch
+from serve import restore_codec
+
+def init():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--gpu', type=str, default='0', help="gpu to use")
+    parser.add_argument('--gpu_fraction', type=float, default=0.8, help="fraction of gpu memory to use")
+    parser.add_argument('--ckpt_path', type=str, default='ckpt/ce-5e-05-1.0-1.0-1.0-1.0-1.0', help="checkpoint directory (its latest checkpoint is restored) or checkpoint prefix")
+    parser.add_argument('--scope', type=str, default='ae-with-gan', help="variable scope the model was trained under")
+    parser.add_argument('--categorical_cardinality', type=int, default=1000, help="characters 0..categorical_cardinality-1 are generated")
+    parser.add_argument('--data_path', type=str, default='../../demo/', help="path to save images")
+    parser.add_argument('--content_style', type=int, default=0, help="style whose glyphs give the content (class vectors) of every character")
+    parser.add_argument("--target_styles", nargs="*", type=int, default=[], help="styles a font is generated in")
+    parser.add_argument("--style_chars", nargs="*", type=int, default=[0], help="characters of every target style whose style vectors are averaged")
+    parser.add_argument("--style_glyphs", nargs="*", type=str, default=[], help="glyph files whose averaged style vector gives one more font, written as 'glyphs'")
+    parser.add_argument('--image_size', type=int, default=64, help="the size of images trained")
+    parser.add_argument('--kernel', type=int, default=4, help="kernel size")
+    parser.add_argument('--stride', type=int, default=2, help="stride")
+    parser.add_argument('--class_dim', type=int, default=50, help="dimension of class vector")
+    parser.add_argument('--style_dim', type=int, default=50, help="dimension of style vector")
+    parser.add_argument('--precision', type=str, default='fp32', help="run the conv/fc stacks in half (fp16) or single (fp32) precision, batch norm and losses always use fp32")
+    parser.add_argument('--batch_forward', type=str, default='none', help="batch_forward the model was trained with (none, grouped or pooled)")
+    parser.add_argument('--batch_size', type=int, default=512, help="glyphs per encoder/decoder pass")
+    parser.add_argument('--prefetch', type=int, default=2, help="number of content batches decoded ahead on worker threads")
+    parser.add_argument('--output_path', type=str, default='../../demo/font', help="directory the fonts and the progress file are written to")
+    parser.add_argument('--output_format', type=str, default='png', help="one png per glyph in output_path/<style>/ (png) or one uint8 [categorical_cardinality,h,w] array output_path/<style>.npy (npy)")
+    return parser.parse_args()
+
+def load_glyphs(names,image_size):
+    return np.stack([img_loader(name,image_size,image_size,image_size,image_size,True) for name in names]).astype(np.float32) / 255.0
+
+def encode_glyphs(codec,names,batch_size,prefetch_depth=0):
+    # class and style vectors of every glyph in names, batch_size glyphs per encoder pass
+    batches = [names[i:i+batch_size] for i in range(0,len(names),batch_size)]
+    class_vectors, style_vectors = [], []
+    for glyphs in prefetch(lambda batch: load_glyphs(batch,codec['image_size']), batches, prefetch_depth):
+        class_vector, style_vector = codec['sess'].run([codec['class_vector'],codec['style_vector']],feed_dict={codec['glyphs']:glyphs})
+        class_vectors.append(class_vector)
+        style_vectors.append(style_vector)
+    return np.concatenate(class_vectors), np.concatenate(style_vectors)
+
+def style_sources(data_path,target_styles,style_chars,style_glyphs):
+    # name -> reference glyph files of every font to generate
+    sources = OrderedDict()
+    for style in target_styles:
+        names = locate(data_path,[style],max(style_chars)+1,[])[0][0][style_chars]
+        sources[str(style)] = [name for name in names if os.path.exists(name)]
+        assert sources[str(style)], 'no reference glyph of style %d found' % style
+    if style_glyphs:
+        sources['glyphs'] = list(style_glyphs)
+    return sources
+
+def save_progress(progress,path):
+    with open(path+'.tmp','w') as f:
+        json.dump(progress,f)
+    os.replace(path+'.tmp',path)
+
+def open_font(output_path,style,output_format,categorical_cardinality,image_size):
+    if output_format == 'npy':
+        path = os.path.join(output_path,style+'.npy')
+        if os.path.exists(path):
+            return np.load(path,mmap_mode='r+')
+        # characters without a content glyph stay blank
+        font = np.lib.format.open_memmap(path,mode='w+',dtype=np.uint8,shape=(categorical_cardinality,image_size,image_size))
+        font[:] = 255
+        return font
+    if not os.path.exists(os.path.join(output_path,style)):
+        os.makedirs(os.path.join(output_path,style))
+    return os.path.join(output_path,style)
+
+def write_glyphs(font,labels,glyphs,progress,progress_path,style,done):
+    # runs on the writer thread, the progress file only counts batches that are completely written
+    glyphs = (np.clip(glyphs[:,:,:,0],0.0,1.0)*255).astype(np.uint8)
+    if isinstance(font, str):
+        for label, glyph in zip(labels,glyphs):
+            Image.fromarray(glyph,'L').save(os.path.join(font,'%d.png' % label))
+    else:
+        font[labels] = glyphs
+        font.flush()
+    progress['done'][style] = done
+    save_progress(progress,progress_path)
+
+def main():
+    parser = init()
+    os.environ["CUDA_VISIBLE_DEVICES"] = parser.gpu
+    categorical_cardinality = parser.categorical_cardinality
+    image_size = parser.image_size
+    batch_size = parser.batch_size
+    dtype = tf.float16 if parser.precision == 'fp16' else tf.float32
+    batch_forward = None if parser.batch_forward == 'none' else parser.batch_forward
+    output_path = parser.output_path
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+
+    contentName = locate(parser.data_path,[parser.content_style],categorical_cardinality,[])[0][0]
+    labels = np.array([label for label, name in enumerate(contentName) if os.path.exists(name)], dtype=np.int32)
+    sources = style_sources(parser.data_path,parser.target_styles,parser.style_chars,parser.style_glyphs)
+    print('%d characters in %d styles' % (len(labels), len(sources)))
+
+    # progress counts the characters written per style. it is only trusted for the same characters, content style,
+    # checkpoint, precision and format (which also decide class_vectors.npy), and per style for the same references
+    progress_path = os.path.join(output_path,'progress.json')
+    progress = {'labels': labels.tolist(), 'content_style': parser.content_style, 'format': parser.output_format,
+                'ckpt': parser.ckpt_path, 'precision': parser.precision, 'sources': {}, 'done': {}}
+    if os.path.exists(progress_path):
+        with open(progress_path) as f:
+            saved = json.load(f)
+        if all(saved.get(key) == progress[key] for key in ['labels', 'content_style', 'format', 'ckpt', 'precision']):
+            progress = saved
+        else:
+            print('%s was written with other settings, starting over' % progress_path)
+    class_vector_path = os.path.join(output_path,'class_vectors.npy')
+
+    codec = restore_codec(parser.ckpt_path,image_size,parser.kernel,parser.stride,parser.class_dim,parser.style_dim,parser.scope,batch_forward,dtype,parser.gpu_fraction)
+    # every content glyph is encoded once for all styles
+    if progress['done'] and os.path.exists(class_vector_path):
+        class_vectors = np.load(class_vector_path)
+    else:
+        class_vectors, _ = encode_glyphs(codec,list(contentName[labels]),batch_size,parser.prefetch)
+        np.save(class_vector_path,class_vectors)
+
+    writer = ThreadPoolExecutor(max_workers=1)
+    pending = deque()
+    for style, names in sources.items():
+        if progress['sources'].get(style) != names:
+            progress['sources'][style] = names
+            progress['done'][style] = 0
+        done = progress['done'].get(style,0)
+        if done >= len(labels):
+            print('style %s already generated, skipped' % style)
+            continue
+        start_time = time.time()
+        _, style_vectors = encode_glyphs(codec,names,batch_size)
+        style_vector = np.mean(style_vectors,axis=0,keepdims=True)
+        font = open_font(output_path,style,parser.output_format,categorical_cardinality,image_size)
+        for start in range(done,len(labels),batch_size):
+            end = min(start+batch_size,len(labels))
+            glyphs = codec['sess'].run(codec['output'],feed_dict={codec['class_input']:class_vectors[start:end],codec['style_input']:np.repeat(style_vector,end-start,axis=0)})
+            pending.append(writer.submit(write_glyphs,font,labels[start:end],glyphs,progress,progress_path,style,end))
+            # a few batches may be in flight, more would only pile up decoded glyphs in memory
+            while len(pending) > 2 or (pending and pending[0].done()):
+                pending.popleft().result()
+        while pending:
+            pending.popleft().result()
+        print('style %s: %d glyphs in %.1fs' % (style, len(labels)-done, time.time()-start_time))
+    writer.shutdown()
+    codec['sess'].close()
+
+
+if __name__ == '__main__':
+    main()
@@ -13,6 +13,24 @@ def scope_variables(name):
     with tf.variable_scope(name):
         return variables_in_current_scope()
 
+def float32_variable_getter(getter, name, shape=None, dtype=None, initializer=None, regularizer=None, trainable=True, *args, **kwargs):
+    # half precision layers still store (and checkpoint) float32 variables, they only see a casted copy
+    variable = getter(name, shape, dtype=tf.float32 if trainable else dtype, initializer=initializer, regularizer=regularizer, trainable=trainable, *args, **kwargs)
+    if trainable and dtype not in (None, tf.float32):
+        variable = tf.cast(variable, dtype)
+    return variable
+
+def float32_normalizer(normalizer_fn):
+    # batch norm moments and moving averages are kept in float32 whatever the precision of the layer
+    def normalizer(inputs, **kwargs):
+        return tf.cast(normalizer_fn(tf.cast(inputs, tf.float32), **kwargs), inputs.dtype)
+    return normalizer
+
+def loss_scaled(solver, init_loss_scale=2**15, incr_every_n_steps=2000):
+    # dynamic loss scaling for float16 gradients, steps with inf/nan gradients are skipped and the scale is halved
+    manager = tf.contrib.mixed_precision.ExponentialUpdateLossScaleManager(init_loss_scale, incr_every_n_steps, decr_every_n_nan_or_inf=1, decr_ratio=0.5)
+    return tf.contrib.mixed_precision.LossScaleOptimizer(solver, manager)
+
 def leaky_rectify(x, leakiness=0.01):
     assert leakiness <= 1
     ret = tf.maximum(x, leakiness * x)
@@ -25,7 +43,8 @@ def conv_batch_norm(inputs,
                     name="batch_norm",
                     is_training=True,
                     trainable=True,
-                    epsilon=1e-5):
+                    epsilon=1e-5,
+                    groups=1):
     ema = tf.train.ExponentialMovingAverage(decay=0.9)
     shp = inputs.get_shape()[-1].value
 
@@ -33,13 +52,23 @@ def conv_batch_norm(inputs,
         gamma = tf.get_variable("gamma", [shp], initializer=tf.random_normal_initializer(1., 0.02), trainable=trainable)
         beta = tf.get_variable("beta", [shp], initializer=tf.constant_initializer(0.), trainable=trainable)
 
-        mean, variance = tf.nn.moments(inputs, [0, 1, 2])
+        if groups > 1:
+            # moments of every group on its own, as if each was a separate call, their average feeds the moving averages
+            grouped = tf.reshape(inputs, tf.concat([[groups, -1], tf.shape(inputs)[1:]], 0))
+            group_mean, group_variance = tf.nn.moments(grouped, [1, 2, 3], keep_dims=True)
+            mean, variance = tf.reduce_mean(group_mean, [0, 1, 2, 3]), tf.reduce_mean(group_variance, [0, 1, 2, 3])
+        else:
+            mean, variance = tf.nn.moments(inputs, [0, 1, 2])
         mean.set_shape((shp,))
         variance.set_shape((shp,))
         ema_apply_op = ema.apply([mean, variance])
 
         def update():
             with tf.control_dependencies([ema_apply_op]):
+                if groups > 1:
+                    normalized = tf.reshape(tf.nn.batch_normalization(grouped, group_mean, group_variance, beta, gamma, epsilon), tf.shape(inputs))
+                    normalized.set_shape(inputs.get_shape())
+                    return normalized
                 return tf.nn.batch_norm_with_global_normalization(
                     inputs, mean, variance, beta, gamma, epsilon,
                     scale_after_normalization=True
@@ -51,6 +80,10 @@ def conv_batch_norm(inputs,
                 scale_after_normalization=True
             )
 
+        if isinstance(is_training, bool):
+            # a python flag builds its branch alone, so an inference graph only reads the moving averages
+            # (ema.apply above still creates them under their checkpoint names, its update op is never run)
+            return update() if is_training else do_not_update()
         normalized_x = tf.cond(
             is_training,
             update,
@@ -58,29 +91,37 @@ def conv_batch_norm(inputs,
         )
         return normalized_x
 
-def conv2d(inputs,num_outputs,kernel_size,stride,is_training,normalizer_fn,activation_fn,name):
+def conv2d(inputs,num_outputs,kernel_size,stride,is_training,normalizer_fn,activation_fn,name,groups=1):
+    if inputs.dtype.base_dtype == tf.float16:
+        normalizer_fn = float32_normalizer(normalizer_fn)
     with tf.variable_scope(name,reuse=tf.AUTO_REUSE):
         out = layers.convolution2d(inputs,
                     num_outputs=num_outputs,
                     kernel_size=kernel_size,
                     stride=stride,
-                    normalizer_params={"is_training": is_training},
+                    normalizer_params={"is_training": is_training, "groups": groups},
                     normalizer_fn=normalizer_fn,
                     activation_fn=activation_fn)
         return out
 
-def conv2d_transpose(inputs,num_outputs,kernel_size,stride,is_training,normalizer_fn,activation_fn,name):
+def conv2d_transpose(inputs,num_outputs,kernel_size,stride,is_training,normalizer_fn,activation_fn,name,groups=1):
+    if inputs.dtype.base_dtype == tf.float16:
+        normalizer_fn = float32_normalizer(normalizer_fn)
     with tf.variable_scope(name,reuse=tf.AUTO_REUSE):
         out = layers.convolution2d_transpose(inputs,
                     num_outputs=num_outputs,
                     kernel_size=kernel_size,
                     stride=stride,
-                    normalizer_params={"is_training": is_training},
+                    normalizer_params={"is_training": is_training, "groups": groups},
                     normalizer_fn=normalizer_fn,
                     activation_fn=activation_fn)
         return out
 
-def fc(inputs,num_outputs,is_training,normalizer_fn,activation_fn,name):
+def fc(inputs,num_outputs,is_training,normalizer_fn,activation_fn,name,groups=1):
+    if groups > 1:
+        return tf.concat([fc(part,num_outputs,is_training,normalizer_fn,activation_fn,name) for part in tf.split(inputs,groups,0)],0)
+    if inputs.dtype.base_dtype == tf.float16:
+        normalizer_fn = float32_normalizer(normalizer_fn)
     with tf.variable_scope(name,reuse=tf.AUTO_REUSE):
         out = layers.fully_connected(inputs,
                 num_outputs=num_outputs,
@@ -89,37 +130,40 @@ def fc(inputs,num_outputs,is_training,normalizer_fn,activation_fn,name):
                 normalizer_params={"is_training": is_training, "updates_collections": None})
         return out
 
-def encoder(image,kernel,stride,class_dim,style_dim,is_training,name='encoder'):
+def encoder(image,kernel,stride,class_dim,style_dim,is_training,name='encoder',groups=1,dtype=tf.float32):
     with tf.variable_scope(name,reuse=tf.AUTO_REUSE) as scope:
         print(scope.name, name)
-        conv1 = conv2d(image,32,kernel,stride,is_training,conv_batch_norm,leaky_rectify,'conv1')
-        conv2 = conv2d(conv1,64,kernel,stride,is_training,conv_batch_norm,leaky_rectify,'conv2')
-        conv3 = conv2d(conv2,128,kernel,stride,is_training,conv_batch_norm,leaky_rectify,'conv3')
-        conv4 = conv2d(conv3,128,kernel,stride,is_training,conv_batch_norm,leaky_rectify,'conv4')
+        image = tf.cast(image, dtype)
+        conv1 = conv2d(image,32,kernel,stride,is_training,conv_batch_norm,leaky_rectify,'conv1',groups)
+        conv2 = conv2d(conv1,64,kernel,stride,is_training,conv_batch_norm,leaky_rectify,'conv2',groups)
+        conv3 = conv2d(conv2,128,kernel,stride,is_training,conv_batch_norm,leaky_rectify,'conv3',groups)
+        conv4 = conv2d(conv3,128,kernel,stride,is_training,conv_batch_norm,leaky_rectify,'conv4',groups)
         sp = conv4.get_shape()
         flatten = tf.reshape(conv4, [-1,sp[1]*sp[2]*sp[3]])
-        fc1 = fc(flatten,1024,is_training,layers.batch_norm,leaky_rectify,'fc1')
+        fc1 = fc(flatten,1024,is_training,layers.batch_norm,leaky_rectify,'fc1',groups)
         #class_vector = fc(fc1,class_dim,is_training,layers.batch_norm,leaky_rectify,'class_vector')
         #style_vector = fc(fc1,style_dim,is_training,layers.batch_norm,leaky_rectify,'style_vector')
-        class_vector = fc(fc1,class_dim,is_training,layers.batch_norm,tf.nn.tanh,'class_vector')
-        style_vector = fc(fc1,style_dim,is_training,layers.batch_norm,tf.nn.tanh,'style_vector')
-    return class_vector, style_vector, sp[1], sp[2], sp[3]
+        class_vector = fc(fc1,class_dim,is_training,layers.batch_norm,tf.nn.tanh,'class_vector',groups)
+        style_vector = fc(fc1,style_dim,is_training,layers.batch_norm,tf.nn.tanh,'style_vector',groups)
+    return tf.cast(class_vector, tf.float32), tf.cast(style_vector, tf.float32), sp[1], sp[2], sp[3]
 
-def decoder(vector,w,h,c,kernel,stride,is_training,name='decoder'):
+def decoder(vector,w,h,c,kernel,stride,is_training,name='decoder',groups=1,dtype=tf.float32):
     with tf.variable_scope(name,reuse=tf.AUTO_REUSE) as scope:
         print(scope.name, name)
-        fc1 = fc(vector,1024,is_training,layers.batch_norm,leaky_rectify,'fc1')
-        fc2 = fc(fc1,w*h*c,is_training,layers.batch_norm,leaky_rectify,'fc2')
+        vector = tf.cast(vector, dtype)
+        fc1 = fc(vector,1024,is_training,layers.batch_norm,leaky_rectify,'fc1',groups)
+        fc2 = fc(fc1,w*h*c,is_training,layers.batch_norm,leaky_rectify,'fc2',groups)
         expand = tf.reshape(fc2, [-1,w,h,c])
-        conv1 = conv2d_transpose(expand,128,kernel,stride,is_training,conv_batch_norm,leaky_rectify,'conv1')
-        conv2 = conv2d_transpose(conv1,64,kernel,stride,is_training,conv_batch_norm,leaky_rectify,'conv2')
-        conv3 = conv2d_transpose(conv2,32,kernel,stride,is_training,conv_batch_norm,leaky_rectify,'conv3')
-        conv4 = conv2d_transpose(conv3,1,kernel,stride,is_training,conv_batch_norm,tf.nn.sigmoid,'conv4')
-    return conv4
+        conv1 = conv2d_transpose(expand,128,kernel,stride,is_training,conv_batch_norm,leaky_rectify,'conv1',groups)
+        conv2 = conv2d_transpose(conv1,64,kernel,stride,is_training,conv_batch_norm,leaky_rectify,'conv2',groups)
+        conv3 = conv2d_transpose(conv2,32,kernel,stride,is_training,conv_batch_norm,leaky_rectify,'conv3',groups)
+        conv4 = conv2d_transpose(conv3,1,kernel,stride,is_training,conv_batch_norm,tf.nn.sigmoid,'conv4',groups)
+    return tf.cast(conv4, tf.float32)
 
-def discriminator(image,kernel,stride,is_training,classNum=1,name='discriminator'):
+def discriminator(image,kernel,stride,is_training,classNum=1,name='discriminator',dtype=tf.float32):
     with tf.variable_scope(name,reuse=tf.AUTO_REUSE) as scope:
         print(scope.name, name)
+        image = tf.cast(image, dtype)
         conv1 = conv2d(image,32,kernel,stride,is_training,conv_batch_norm,leaky_rectify,'conv1')
         conv2 = conv2d(conv1,64,kernel,stride,is_training,conv_batch_norm,leaky_rectify,'conv2')
         conv3 = conv2d(conv2,128,kernel,stride,is_training,conv_batch_norm,leaky_rectify,'conv3')
@@ -129,21 +173,45 @@ def discriminator(image,kernel,stride,is_training,classNum=1,name='discriminator
         fc1 = fc(flatten,1024,is_training,layers.batch_norm,leaky_rectify,'fc1')
         fc2 = fc(fc1,128,is_training,layers.batch_norm,leaky_rectify,'fc2')
         pred = fc(fc2,classNum,is_training,layers.batch_norm,tf.nn.sigmoid,'pred')
-    return pred
+    return tf.cast(pred, tf.float32)
+
+def batched_discriminator(images,kernel,stride,is_training,classNum=1,name='discriminator',dtype=tf.float32):
+    # a single discriminator pass over all images concatenated along the batch axis, batch norm moments are pooled over them
+    sizes = [tf.shape(image)[0] for image in images]
+    pred = discriminator(tf.concat(images,0),kernel,stride,is_training,classNum,name,dtype)
+    return tf.split(pred,tf.stack(sizes),0,num=len(images))
+
+def encode_all(images,kernel,stride,class_dim,style_dim,is_training,batch_forward=None,dtype=tf.float32):
+    # None encodes every image on its own, otherwise their concatenation runs through the encoder once with
+    # batch norm statistics kept per image ('grouped') or shared by all of them ('pooled')
+    if batch_forward is None:
+        return [encoder(image,kernel,stride,class_dim,style_dim,is_training,dtype=dtype) for image in images]
+    groups = len(images) if batch_forward == 'grouped' else 1
+    class_vector, style_vector, w, h, c = encoder(tf.concat(images,0),kernel,stride,class_dim,style_dim,is_training,groups=groups,dtype=dtype)
+    return [(class_vector_i, style_vector_i, w, h, c) for class_vector_i, style_vector_i in zip(tf.split(class_vector,len(images),0),tf.split(style_vector,len(images),0))]
+
+def decode_all(vectors,w,h,c,kernel,stride,is_training,batch_forward=None,dtype=tf.float32):
+    if batch_forward is None:
+        return [decoder(vector,w,h,c,kernel,stride,is_training,dtype=dtype) for vector in vectors]
+    groups = len(vectors) if batch_forward == 'grouped' else 1
+    return tf.split(decoder(tf.concat(vectors,0),w,h,c,kernel,stride,is_training,groups=groups,dtype=dtype),len(vectors),0)
 
-def ae_with_gan(image1,image3,image5,image6,label1,label3,is_calligraphy,kernel,stride,class_dim,style_dim,image_size,channel_size,is_training,loss_type,style_num,reconstruct_coef_1,reconstruct_coef_3,generator_coef,discriminator_coef,name='ae-with-gan'):
+def ae_with_gan(image1,image3,image5,image6,label1,label3,is_calligraphy,kernel,stride,class_dim,style_dim,image_size,channel_size,is_training,loss_type,style_num,reconstruct_coef_1,reconstruct_coef_3,generator_coef,discriminator_coef,name='ae-with-gan',batch_discriminator=False,batch_forward=None,dtype=tf.float32):
     # image2 is the ground truth of image1
     # image4 is the ground truth of image3
     # image5 if the ground truth of content of image1 with style of image3
     # image6 if the ground truth of content of image3 with style of image1
-    with tf.variable_scope(name,reuse=tf.AUTO_REUSE) as scope:
-        class_vector_1, style_vector_1, w, h, c = encoder(image1,kernel,stride,class_dim,style_dim,is_training)
-        class_vector_3, style_vector_3, _, _, _ = encoder(image3,kernel,stride,class_dim,style_dim,is_training)
+    # dtype=tf.float16 runs the conv/fc stacks in half precision, batch norm and the losses stay in float32
+    with tf.variable_scope(name,reuse=tf.AUTO_REUSE,custom_getter=float32_variable_getter if dtype != tf.float32 else None) as scope:
+        (class_vector_1, style_vector_1, w, h, c), (class_vector_3, style_vector_3, _, _, _) = encode_all([image1,image3],kernel,stride,class_dim,style_dim,is_training,batch_forward,dtype)
         w,h,c = int(w), int(h), int(c)
+        image1_forward_reconstruct, image3_forward_reconstruct, image1_style_reconstruct, image3_style_reconstruct = decode_all([
+            tf.concat([class_vector_1,style_vector_1],1),
+            tf.concat([class_vector_3,style_vector_3],1),
+            tf.concat([class_vector_1,style_vector_3],1),
+            tf.concat([class_vector_3,style_vector_1],1)],w,h,c,kernel,stride,is_training,batch_forward,dtype)
 
         # forward
-        image1_forward_reconstruct = decoder(tf.concat([class_vector_1,style_vector_1],1),w,h,c,kernel,stride,is_training)
-        image3_forward_reconstruct = decoder(tf.concat([class_vector_3,style_vector_3],1),w,h,c,kernel,stride,is_training)
         image1_forward_reconstruct = binary(image1_forward_reconstruct,image_size,channel_size,0.7)
         image3_forward_reconstruct = binary(image3_forward_reconstruct,image_size,channel_size,0.7)
         if loss_type == 'l1':
@@ -155,8 +223,6 @@ def ae_with_gan(image1,image3,image5,image6,label1,label3,is_calligraphy,kernel,
         reconstruct_loss_1 = reconstruct_coef_1 * reconstruct_loss_1
 
         # swap
-        image1_style_reconstruct = decoder(tf.concat([class_vector_1,style_vector_3],1),w,h,c,kernel,stride,is_training)
-        image3_style_reconstruct = decoder(tf.concat([class_vector_3,style_vector_1],1),w,h,c,kernel,stride,is_training)
         image1_style_reconstruct = binary(image1_style_reconstruct,image_size,channel_size,0.7)
         image3_style_reconstruct = binary(image3_style_reconstruct,image_size,channel_size,0.7)
         if loss_type == 'l1':
@@ -170,14 +236,20 @@ def ae_with_gan(image1,image3,image5,image6,label1,label3,is_calligraphy,kernel,
         forward_loss = reconstruct_loss_1 + reconstruct_loss_3
 
         style_num = style_num + 1
-        image1_pred_true = discriminator(image1,kernel,stride,is_training,style_num,'discriminator')
-        image3_pred_true = discriminator(image3,kernel,stride,is_training,style_num,'discriminator')
-        image5_pred_true = discriminator(image5,kernel,stride,is_training,style_num,'discriminator')
-        image6_pred_true = discriminator(image6,kernel,stride,is_training,style_num,'discriminator')
-        image1_pred_forward_fake = discriminator(image1_forward_reconstruct,kernel,stride,is_training,style_num,'discriminator')
-        image3_pred_forward_fake = discriminator(image3_forward_reconstruct,kernel,stride,is_training,style_num,'discriminator')
-        image1_style_forward_fake = discriminator(image1_style_reconstruct,kernel,stride,is_training,style_num,'discriminator')
-        image3_style_forward_fake = discriminator(image3_style_reconstruct,kernel,stride,is_training,style_num,'discriminator')
+        if batch_discriminator:
+            image1_pred_true, image3_pred_true, image5_pred_true, image6_pred_true, \
+            image1_pred_forward_fake, image3_pred_forward_fake, image1_style_forward_fake, image3_style_forward_fake = batched_discriminator(
+                [image1,image3,image5,image6,image1_forward_reconstruct,image3_forward_reconstruct,image1_style_reconstruct,image3_style_reconstruct],
+                kernel,stride,is_training,style_num,'discriminator',dtype)
+        else:
+            image1_pred_true = discriminator(image1,kernel,stride,is_training,style_num,'discriminator',dtype)
+            image3_pred_true = discriminator(image3,kernel,stride,is_training,style_num,'discriminator',dtype)
+            image5_pred_true = discriminator(image5,kernel,stride,is_training,style_num,'discriminator',dtype)
+            image6_pred_true = discriminator(image6,kernel,stride,is_training,style_num,'discriminator',dtype)
+            image1_pred_forward_fake = discriminator(image1_forward_reconstruct,kernel,stride,is_training,style_num,'discriminator',dtype)
+            image3_pred_forward_fake = discriminator(image3_forward_reconstruct,kernel,stride,is_training,style_num,'discriminator',dtype)
+            image1_style_forward_fake = discriminator(image1_style_reconstruct,kernel,stride,is_training,style_num,'discriminator',dtype)
+            image3_style_forward_fake = discriminator(image3_style_reconstruct,kernel,stride,is_training,style_num,'discriminator',dtype)
 
         label1_true = tf.concat([is_calligraphy,label1],1)
         label3_true = tf.concat([is_calligraphy,label3],1)
@@ -209,6 +281,15 @@ def ae_with_gan(image1,image3,image5,image6,label1,label3,is_calligraphy,kernel,
     class_vector_1, style_vector_1, class_vector_3, style_vector_3,\
     image1_pred_true, image3_pred_true, image5_pred_true, image6_pred_true, image1_pred_forward_fake, image3_pred_forward_fake, image1_style_forward_fake, image3_style_forward_fake
 
+def fused_train(solvers,losses,var_lists):
+    # every gradient is taken from the same forward pass before any update is applied, the updates then run one after another
+    grads = [solver.compute_gradients(loss, var_list=var_list) for solver, loss, var_list in zip(solvers,losses,var_lists)]
+    train = tf.group(*[g for grad in grads for g, _ in grad if g is not None])
+    for solver, grad in zip(solvers,grads):
+        with tf.control_dependencies([train]):
+            train = solver.apply_gradients(grad)
+    return train
+
 def binary(image,image_size,channel_size,threshold=None):
     image_average = tf.reshape(tf.reduce_mean(image,[1,2,3]),[-1,1,1,1])
     if threshold is not None:
@@ -217,13 +298,139 @@ def binary(image,image_size,channel_size,threshold=None):
     image_mask = tf.cast(tf.less(image,image_average),tf.float32)
     return image*image_mask+(1-image_mask)
 
-def transfer(image1,image2,kernel,stride,class_dim,style_dim,is_training,name):
-    with tf.variable_scope(name,reuse=tf.AUTO_REUSE):
-        class_vector_1, style_vector_1, w, h, c = encoder(image1,kernel,stride,class_dim,style_dim,is_training)
-        class_vector_2, style_vector_2, w, h, c = encoder(image2,kernel,stride,class_dim,style_dim,is_training)
+def transfer(image1,image2,kernel,stride,class_dim,style_dim,is_training,name,batch_forward=None,dtype=tf.float32):
+    with tf.variable_scope(name,reuse=tf.AUTO_REUSE,custom_getter=float32_variable_getter if dtype != tf.float32 else None):
+        (class_vector_1, style_vector_1, w, h, c), (class_vector_2, style_vector_2, w, h, c) = encode_all([image1,image2],kernel,stride,class_dim,style_dim,is_training,batch_forward,dtype)
+        w,h,c = int(w), int(h), int(c)
+
+        image1_forward_reconstruct, image2_forward_reconstruct = decode_all([tf.concat([class_vector_1,style_vector_2],1),tf.concat([class_vector_2,style_vector_1],1)],w,h,c,kernel,stride,is_training,batch_forward,dtype)
+
+        return image1_forward_reconstruct, image2_forward_reconstruct
+
+def codec(glyphs,class_input,style_input,kernel,stride,class_dim,style_dim,is_training,name,dtype=tf.float32):
+    # encoder (glyphs -> class_vector, style_vector) and decoder (class_input, style_input -> glyph) halves of transfer(),
+    # so that the vectors of glyphs used again and again are computed only once. one copy of each under one scope,
+    # restore it through codec_checkpoint_names to load the moving averages of a batch_forward='grouped' model
+    with tf.variable_scope(name,reuse=tf.AUTO_REUSE,custom_getter=float32_variable_getter if dtype != tf.float32 else None):
+        class_vector, style_vector, w, h, c = encoder(glyphs,kernel,stride,class_dim,style_dim,is_training,dtype=dtype)
         w,h,c = int(w), int(h), int(c)
+        output = decoder(tf.concat([class_input,style_input],1),w,h,c,kernel,stride,is_training,dtype=dtype)
+        return class_vector, style_vector, output
+
+def codec_checkpoint_names(variables,batch_forward=None):
+    # checkpoint name -> variable of a codec. conv_batch_norm names its moving averages after the ops of the moments,
+    # tf.nn.moments in a plain call and the reduce_mean of the per-group moments in a grouped one
+    names = {}
+    for variable in variables:
+        name = variable.op.name
+        if batch_forward == 'grouped':
+            name = name.replace('/batch_norm/moments/Squeeze/ExponentialMovingAverage','/batch_norm/Mean/ExponentialMovingAverage')
+            name = name.replace('/batch_norm/moments/Squeeze_1/ExponentialMovingAverage','/batch_norm/Mean_1/ExponentialMovingAverage')
+        names[name] = variable
+    return names
+
+def input_pipeline(imageName,styleNum,charNum,desired_height,desired_width,value_range,augment,batch_size,rows=None,num_parallel_calls=4,prefetch_size=2,name='input',packed_levels=1):
+    # tf.data replacement for util.loader: decodes (or gathers the packed_levels held in the pack when rows is given) inside the runtime.
+    # every epoch starts with running initializer on shuffled idxes, every step with load_batch, which stages the next
+    # batch in local variables so that the forward/generator/discriminator runs of one step see the same batch.
+    # decoded glyphs are resized with the AREA filter, not with the antialias filter of util.decode_levels, so unless
+    # a pack holds every level the inputs differ slightly from the ones of the feed mode
+    fractions = [0.75, 0.5, 0.25]
+    levels = 1 + augment
+    with tf.variable_scope(name):
+        idxes1 = tf.placeholder(tf.int32,[None],name='idxes1')
+        idxes2 = tf.placeholder(tf.int32,[None],name='idxes2')
+        names = tf.constant(imageName.ravel().tolist())
+        glyphs = None
+        if rows is not None:
+            glyphs = tf.placeholder(tf.uint8,[None, packed_levels, desired_height, desired_width],name='glyphs')
+            glyphs_variable = tf.Variable(glyphs,trainable=False,collections=[tf.GraphKeys.LOCAL_VARIABLES],validate_shape=False,name='glyphs_variable')
+            rows_flat = tf.constant(rows.ravel(),dtype=tf.int32)
 
-        image1_forward_reconstruct = decoder(tf.concat([class_vector_1,style_vector_2],1),w,h,c,kernel,stride,is_training)
-        image2_forward_reconstruct = decoder(tf.concat([class_vector_2,style_vector_1],1),w,h,c,kernel,stride,is_training)
+        def decode(idx,level,center_height,center_width):
+            if rows is not None and level < packed_levels:
+                return tf.cast(tf.gather(glyphs_variable,rows_flat[idx])[level,:,:,None],tf.float32)
+            image = tf.image.decode_png(tf.read_file(names[idx]),channels=1)
+            image = tf.image.resize_images(image,[center_height,center_width],method=tf.image.ResizeMethod.AREA)
+            top, left = int(desired_height/2)-int(center_height/2), int(desired_width/2)-int(center_width/2)
+            return 255.0 - tf.image.pad_to_bounding_box(255.0 - image,top,left,desired_height,desired_width)
 
-        return image1_forward_reconstruct, image2_forward_reconstruct
\ No newline at end of file
+        def sample(idx1,idx2):
+            styleId1, charId1, styleId2, charId2 = idx1 // charNum, idx1 % charNum, idx2 // charNum, idx2 % charNum
+            images = []
+            for idx in (idx1, idx2, styleId2*charNum+charId1, styleId1*charNum+charId2):
+                image = []
+                for level in range(levels):
+                    if level == 0:
+                        center_height, center_width = desired_height, desired_width
+                    else:
+                        center_height, center_width = int(desired_height*fractions[level-1]), int(desired_width*fractions[level-1])
+                    image.append(decode(idx,level,center_height,center_width))
+                image = tf.stack(image)
+                images.append(value_range[0] + (image / 255.0) * (value_range[1] - value_range[0]))
+            label1 = tf.tile(tf.one_hot(styleId1,styleNum)[None,:],[levels,1])
+            label3 = tf.tile(tf.one_hot(styleId2,styleNum)[None,:],[levels,1])
+            is_calligraphy = tf.ones([levels,1],dtype=tf.float32)
+            return tuple(images) + (label1, label3, is_calligraphy)
+
+        def merge_levels(*batch):
+            return tuple(tf.reshape(x,tf.concat([[-1],tf.shape(x)[2:]],0)) for x in batch)
+
+        dataset = tf.data.Dataset.from_tensor_slices((idxes1,idxes2))
+        dataset = dataset.map(sample,num_parallel_calls=num_parallel_calls)
+        dataset = dataset.batch(batch_size).map(merge_levels).prefetch(prefetch_size)
+        iterator = dataset.make_initializable_iterator()
+
+        shapes = [[desired_height,desired_width,1]]*4 + [[styleNum],[styleNum],[1]]
+        staged, assigns = [], []
+        for tensor, shape in zip(iterator.get_next(), shapes):
+            variable = tf.Variable(tf.zeros([0]+shape),trainable=False,collections=[tf.GraphKeys.LOCAL_VARIABLES],validate_shape=False)
+            assigns.append(tf.assign(variable,tensor,validate_shape=False))
+            staged.append(tf.reshape(variable,[-1]+shape))
+        load_batch = tf.group(*assigns)
+
+    return staged, idxes1, idxes2, iterator.initializer, load_batch, glyphs
+
+def augment_batch(images,augment,desired_height,desired_width,value_range,scale_jitter=0.0,offset_jitter=0.0):
+    # in-graph counterpart of the shrink-and-center levels of util.loader, applied to base scale batches.
+    # rows come out in the loader order (sample i at rows i*levels ... i*levels+augment) and all images of a row share
+    # the same random zoom and shift, so image5/image6 stay aligned with image1/image3.
+    fractions = [1.0, 0.75, 0.5, 0.25][:1+augment]
+    lo, hi = value_range
+    inks = []
+    for image in images:
+        # ink is 0 on the background, so resizing, padding and transforming fill with background
+        ink = (hi - image) / (hi - lo)
+        levels = []
+        for fraction in fractions:
+            center_height, center_width = int(desired_height*fraction), int(desired_width*fraction)
+            level = ink
+            if fraction != 1.0:
+                level = tf.image.resize_images(ink,[center_height,center_width],method=tf.image.ResizeMethod.AREA)
+                top, left = int(desired_height/2)-int(center_height/2), int(desired_width/2)-int(center_width/2)
+                level = tf.image.pad_to_bounding_box(level,top,left,desired_height,desired_width)
+            levels.append(level)
+        inks.append(tf.reshape(tf.stack(levels,1),[-1,desired_height,desired_width,image.get_shape()[-1].value]))
+    if scale_jitter > 0 or offset_jitter > 0:
+        num = tf.shape(inks[0])[0]
+        scale = tf.random_uniform([num],1.0-scale_jitter,1.0+scale_jitter)
+        dx = tf.random_uniform([num],-offset_jitter,offset_jitter)
+        dy = tf.random_uniform([num],-offset_jitter,offset_jitter)
+        cx, cy = (desired_width-1)/2.0, (desired_height-1)/2.0
+        # output pixel (x, y) samples the input at ((x-cx)/scale+cx-dx, (y-cy)/scale+cy-dy)
+        zeros = tf.zeros([num])
+        transforms = tf.stack([1.0/scale, zeros, cx-cx/scale-dx, zeros, 1.0/scale, cy-cy/scale-dy, zeros, zeros],1)
+        inks = [tf.contrib.image.transform(ink,transforms,interpolation='BILINEAR') for ink in inks]
+    return [hi - ink * (hi - lo) for ink in inks]
+
+def augment_inputs(images,labels,augment,desired_height,desired_width,value_range,is_training,scale_jitter=0.0,offset_jitter=0.0,name='augment'):
+    # training batches are expanded to 1+augment scale levels (labels repeated to match), inference batches pass through
+    levels = 1 + augment
+    with tf.variable_scope(name):
+        def augmented():
+            repeated = [tf.reshape(tf.tile(label[:,None,:],[1,levels,1]),[-1,label.get_shape()[-1].value]) for label in labels]
+            return augment_batch(images,augment,desired_height,desired_width,value_range,scale_jitter,offset_jitter) + repeated
+        outputs = tf.cond(is_training, augmented, lambda: list(images) + list(labels))
+        for output, tensor in zip(outputs, list(images) + list(labels)):
+            output.set_shape(tensor.get_shape())
+    return outputs
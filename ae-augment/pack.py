@@ -0,0 +1,23 @@
+import argparse
+from util import locate, pack_glyphs
+
+def init():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--categorical_cardinality', type=int, default=1000, help="number of the characters to be packed")
+    parser.add_argument('--data_path', type=str, default='../../demo/', help="path to save images")
+    parser.add_argument("--styles", nargs="*", type=int, default=[6,10], help="appointed styles to be packed")
+    parser.add_argument('--image_size', type=int, default=64, help="the size of images trained")
+    parser.add_argument('--augment', type=int, default=2, help="shrunken augment levels packed next to the base scale, training with a larger --augment decodes the levels beyond them")
+    parser.add_argument('--force_grayscale', type=bool, default=True, help="transform images into single channel or not")
+    parser.add_argument('--pack_path', type=str, default='../../demo/pack', help="prefix of the packed glyph array and its index")
+    return parser.parse_args()
+
+def main():
+    parser = init()
+    imageName, _ = locate(parser.data_path, styles=parser.styles, max_label=parser.categorical_cardinality, partition=[])
+    print(imageName.shape)
+    pack_glyphs(imageName, parser.pack_path, parser.image_size, parser.image_size, parser.force_grayscale, parser.augment)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,272 @@
+import tensorflow as tf
+import numpy as np
+import argparse
+import os
+import sys
+import io
+import json
+import time
+import queue
+import threading
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from PIL import Image
+from util import img_loader
+from network import codec, codec_checkpoint_names
+
+def init():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--gpu', type=str, default='0', help="gpu to use")
+    parser.add_argument('--gpu_fraction', type=float, default=0.8, help="fraction of gpu memory to use")
+    parser.add_argument('--ckpt_path', type=str, default='ckpt/ce-5e-05-1.0-1.0-1.0-1.0-1.0', help="checkpoint directory (its latest checkpoint is restored) or checkpoint prefix")
+    parser.add_argument('--scope', type=str, default='ae-with-gan', help="variable scope the model was trained under")
+    parser.add_argument('--image_size', type=int, default=64, help="the size of images trained")
+    parser.add_argument('--kernel', type=int, default=4, help="kernel size")
+    parser.add_argument('--stride', type=int, default=2, help="stride")
+    parser.add_argument('--class_dim', type=int, default=50, help="dimension of class vector")
+    parser.add_argument('--style_dim', type=int, default=50, help="dimension of style vector")
+    parser.add_argument('--precision', type=str, default='fp32', help="run the conv/fc stacks in half (fp16) or single (fp32) precision, batch norm and losses always use fp32")
+    parser.add_argument('--batch_forward', type=str, default='none', help="batch_forward the model was trained with (none, grouped or pooled)")
+    parser.add_argument('--max_batch', type=int, default=64, help="largest number of transfers run in one session call")
+    parser.add_argument('--max_delay', type=float, default=0.01, help="seconds the first request of a batch waits for more requests to join it")
+    parser.add_argument('--vector_cache', type=int, default=65536, help="number of glyphs whose class and style vectors are kept for later requests")
+    parser.add_argument('--port', type=int, default=0, help="serve http on this port (0: read 'content style output' lines from stdin)")
+    parser.add_argument('--host', type=str, default='127.0.0.1', help="address the http server binds to")
+    parser.add_argument('--glyph_root', type=str, default='../../demo/', help="directory the content and style files of http requests are resolved in")
+    parser.add_argument('--output_root', type=str, default=None, help="directory http requests may write their output file to (None: the png is always returned)")
+    return parser.parse_args()
+
+def restore_codec(ckpt_path,image_size,kernel,stride,class_dim,style_dim,name='ae-with-gan',batch_forward=None,dtype=tf.float32,gpu_fraction=0.8):
+    # encoder (glyphs -> class_vector, style_vector) and decoder (class_input, style_input -> output) graphs
+    # of a trained model in their own session, restored once from ckpt_path. is_training is a python False, so
+    # the graph holds no batch norm updates and every run leaves the restored model untouched
+    graph = tf.Graph()
+    with graph.as_default():
+        glyphs = tf.placeholder(tf.float32,[None, image_size, image_size, 1],name="glyphs")
+        class_input = tf.placeholder(tf.float32,[None, class_dim],name="class_input")
+        style_input = tf.placeholder(tf.float32,[None, style_dim],name="style_input")
+        class_vector, style_vector, output = codec(glyphs,class_input,style_input,kernel,stride,class_dim,style_dim,False,name,dtype)
+        assert_read_only([class_vector, style_vector, output])
+        saver = tf.train.Saver(codec_checkpoint_names(tf.global_variables(),batch_forward))
+    config = tf.ConfigProto()
+    config.gpu_options.per_process_gpu_memory_fraction = gpu_fraction
+    sess = tf.Session(graph=graph,config=config)
+    try:
+        saver.restore(sess, tf.train.latest_checkpoint(ckpt_path) if os.path.isdir(ckpt_path) else ckpt_path)
+    except tf.errors.NotFoundError as e:
+        sess.close()
+        raise ValueError('%s does not match the graph, check that --scope and --batch_forward are the ones the model was trained with (%s)' % (ckpt_path, e.message.split('\n')[0]))
+    return {'sess': sess, 'glyphs': glyphs, 'class_vector': class_vector, 'style_vector': style_vector,
+            'class_input': class_input, 'style_input': style_input, 'output': output, 'image_size': image_size}
+
+def assert_read_only(tensors):
+    # nothing the tensors are computed from may write to a variable, otherwise the results of a glyph would
+    # depend on what was run before it
+    seen, ops = set(), [tensor.op for tensor in tensors]
+    while ops:
+        op = ops.pop()
+        if op in seen: continue
+        seen.add(op)
+        assert not op.type.startswith('Assign'), '%s writes to %s whenever the codec runs' % (op.name, op.inputs[0].name)
+        ops.extend(tensor.op for tensor in op.inputs)
+        ops.extend(op.control_inputs)
+
+def open_engine(ckpt_path,image_size,kernel,stride,class_dim,style_dim,name='ae-with-gan',batch_forward=None,dtype=tf.float32,gpu_fraction=0.8,max_batch=64,max_delay=0.01,vector_cache=65536):
+    # a worker thread groups the submitted (content, style) pairs into batches of up to max_batch, waiting at most
+    # max_delay for a batch to fill. the vectors of the last vector_cache distinct glyphs are kept, so a glyph is
+    # encoded once however often it is used
+    engine = restore_codec(ckpt_path,image_size,kernel,stride,class_dim,style_dim,name,batch_forward,dtype,gpu_fraction)
+    engine.update(requests=queue.Queue(), max_batch=max_batch, max_delay=max_delay, vectors=OrderedDict(), vector_cache=vector_cache)
+    engine['worker'] = threading.Thread(target=serve_batches,args=(engine,),daemon=True)
+    engine['worker'].start()
+    return engine
+
+def close_engine(engine):
+    engine['requests'].put(None)
+    engine['worker'].join()
+    engine['sess'].close()
+
+def as_glyph(glyph,image_size):
+    # a file name or a [h,w] / [h,w,1] array, uint8 in [0,255] or float in [0,1], as a float [h,w,1] glyph
+    if isinstance(glyph, str):
+        glyph = img_loader(glyph,image_size,image_size,image_size,image_size,True)
+    glyph = np.asarray(glyph)
+    if glyph.ndim == 2: glyph = glyph[:,:,None]
+    assert glyph.shape == (image_size,image_size,1), glyph.shape
+    if glyph.dtype == np.uint8: return glyph.astype(np.float32) / 255.0
+    return glyph.astype(np.float32)
+
+def glyph_key(glyph,image_size):
+    # files are keyed by name and modification time and only decoded when their vectors are not cached, so a
+    # rewritten file is encoded again. arrays are keyed by a hash of their pixels
+    if isinstance(glyph, str):
+        return (glyph, os.stat(glyph).st_mtime_ns), glyph
+    glyph = as_glyph(glyph,image_size)
+    return hashlib.md5(glyph.tobytes()).hexdigest(), glyph
+
+def submit(engine,content,style):
+    # returns a Future of the float [h,w,1] glyph with the content of content and the style of style
+    future = Future()
+    try:
+        engine['requests'].put((glyph_key(content,engine['image_size']),glyph_key(style,engine['image_size']),future))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+def transfer_glyphs(engine,contents,styles):
+    futures = [submit(engine,content,style) for content, style in zip(contents,styles)]
+    return np.stack([future.result() for future in futures])
+
+def serve_batches(engine):
+    requests = engine['requests']
+    closing = False
+    while not closing:
+        request = requests.get()
+        if request is None: break
+        batch = [request]
+        deadline = time.time() + engine['max_delay']
+        while len(batch) < engine['max_batch']:
+            try:
+                request = requests.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                break
+            if request is None:
+                closing = True
+                break
+            batch.append(request)
+        run_batch(engine,batch)
+
+def run_batch(engine,batch):
+    # glyphs without cached vectors go through the encoder together, then the decoder runs on the vector pairs alone
+    cache = engine['vectors']
+    vectors, missing, ready = {}, OrderedDict(), []
+    for content, style, future in batch:
+        try:
+            for key, glyph in (content, style):
+                if key in vectors or key in missing: continue
+                if key in cache:
+                    cache.move_to_end(key)
+                    vectors[key] = cache[key]
+                else:
+                    missing[key] = as_glyph(glyph,engine['image_size'])
+            ready.append((content[0], style[0], future))
+        except Exception as e:
+            future.set_exception(e)
+    if not ready: return
+    try:
+        if missing:
+            class_vectors, style_vectors = engine['sess'].run([engine['class_vector'],engine['style_vector']],feed_dict={engine['glyphs']:np.stack(list(missing.values()))})
+            for key, class_vector, style_vector in zip(missing, class_vectors, style_vectors):
+                vectors[key] = cache[key] = (class_vector, style_vector)
+            while len(cache) > engine['vector_cache']:
+                cache.popitem(last=False)
+        outputs = engine['sess'].run(engine['output'],feed_dict={engine['class_input']:np.stack([vectors[content][0] for content, _, _ in ready]),
+                                                                 engine['style_input']:np.stack([vectors[style][1] for _, style, _ in ready])})
+        for (_, _, future), output in zip(ready, outputs):
+            future.set_result(output)
+    except Exception as e:
+        for _, _, future in ready:
+            if not future.done(): future.set_exception(e)
+
+def encode_png(glyph):
+    buffer = io.BytesIO()
+    Image.fromarray((np.clip(glyph[:,:,0],0.0,1.0)*255).astype(np.uint8),'L').save(buffer,format='PNG')
+    return buffer.getvalue()
+
+def serve_stdin(engine):
+    # every line is 'content_file style_file output_file'; requests are submitted as they are read so that
+    # consecutive lines share batches, and every output file name is printed once it is written
+    lock = threading.Lock()
+    def write(output_path, future):
+        try:
+            with open(output_path,'wb') as f:
+                f.write(encode_png(future.result()))
+            message = output_path
+        except Exception as e:
+            message = 'error %s: %s' % (output_path, e)
+        with lock:
+            print(message)
+            sys.stdout.flush()
+    futures = []
+    for line in sys.stdin:
+        fields = line.split()
+        if not fields: continue
+        if len(fields) != 3:
+            print('error: expected "content_file style_file output_file", got %r' % line.strip())
+            continue
+        future = submit(engine,fields[0],fields[1])
+        future.add_done_callback(lambda future, output_path=fields[2]: write(output_path, future))
+        futures.append(future)
+    for future in futures:
+        try: future.result()
+        except Exception: pass
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def resolve_path(root,name):
+    # name relative to root, anything that resolves outside of it (absolute names, '..', links) is refused
+    root = os.path.realpath(root)
+    path = os.path.realpath(os.path.join(root,name))
+    if os.path.commonpath([root,path]) != root:
+        raise ValueError('%s is outside of %s' % (name, root))
+    return path
+
+def serve_http(engine,host,port,glyph_root,output_root=None):
+    # POST /transfer {"content": file, "style": file} answers with the png, or with {"output": file} after
+    # writing it there when "output" is given. files are names relative to glyph_root (content, style) and
+    # output_root (output), requests cannot reach anything else, and without output_root nothing is written
+    class TransferHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != '/transfer':
+                self.send_error(404)
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+                if request.get('output') and output_root is None:
+                    raise ValueError('writing output files is disabled, the png is returned when output is not given')
+                output_path = resolve_path(output_root,request['output']) if request.get('output') else None
+                png = encode_png(submit(engine,resolve_path(glyph_root,request['content']),resolve_path(glyph_root,request['style'])).result())
+            except Exception as e:
+                self.send_error(400, str(e))
+                return
+            if output_path is not None:
+                with open(output_path,'wb') as f:
+                    f.write(png)
+                body, content_type = json.dumps({'output': request['output']}).encode('utf-8'), 'application/json'
+            else:
+                body, content_type = png, 'image/png'
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), TransferHandler)
+    print('serving transfers on http://%s:%d/transfer' % (host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+def main():
+    parser = init()
+    os.environ["CUDA_VISIBLE_DEVICES"] = parser.gpu
+    dtype = tf.float16 if parser.precision == 'fp16' else tf.float32
+    batch_forward = None if parser.batch_forward == 'none' else parser.batch_forward
+
+    engine = open_engine(parser.ckpt_path,parser.image_size,parser.kernel,parser.stride,parser.class_dim,parser.style_dim,
+                         parser.scope,batch_forward,dtype,parser.gpu_fraction,parser.max_batch,parser.max_delay,parser.vector_cache)
+    if parser.port:
+        serve_http(engine,parser.host,parser.port,parser.glyph_root,parser.output_root)
+    else:
+        serve_stdin(engine)
+    close_engine(engine)
+
+
+if __name__ == '__main__':
+    main()
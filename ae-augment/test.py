@@ -26,6 +26,8 @@ def init():
     parser.add_argument('--reconstruct_coef_2', type=float, default=1.0, help="reconstruct coef 2")
     parser.add_argument('--generator_coef', type=float, default=1.0, help="generator coef")
     parser.add_argument('--discriminator_coef', type=float, default=1.0, help="discriminator coef")
+    parser.add_argument('--batch_forward', type=str, default='none', help="run the encoder/decoder calls one by one (none) or as one concatenated batch with per-call (grouped) or shared (pooled) batch norm statistics")
+    parser.add_argument('--precision', type=str, default='fp32', help="run the conv/fc stacks in half (fp16) or single (fp32) precision, batch norm and losses always use fp32")
     return parser.parse_args()
 
 def test_with_graph_manually_set_up():
@@ -49,6 +51,8 @@ def test_with_graph_manually_set_up():
     reconstruct_coef_2 = parser.reconstruct_coef_2
     generator_coef = parser.generator_coef
     discriminator_coef = parser.discriminator_coef
+    batch_forward = None if parser.batch_forward == 'none' else parser.batch_forward
+    dtype = tf.float16 if parser.precision == 'fp16' else tf.float32
 
     imageName, imageDict = locate(data_path, styles=styles, max_label=categorical_cardinality)
     _, imageTrue = locate(data_path, max_label=categorical_cardinality)
@@ -61,7 +65,7 @@ def test_with_graph_manually_set_up():
     forward_loss, reconstruct_loss_1, reconstruct_loss_2, generator_loss, discriminator_loss, image1_forward_reconstruct, image2_forward_reconstruct,  class_vector_1, style_vector_1, image1_transfer_reconstruct, image2_transfer_reconstruct = ae_with_gan(
                                                                                                                                  image1,image2,kernel,stride,class_dim,style_dim,is_training,
                                                                                                                                  reconstruct_coef_1,reconstruct_coef_2,generator_coef,discriminator_coef,
-                                                                                                                                 'cycle-consistent-vae-with-gan')
+                                                                                                                                 'cycle-consistent-vae-with-gan',batch_forward=batch_forward,dtype=dtype)
 
     #print([n.name for n in tf.get_default_graph().as_graph_def().node])
     config = tf.ConfigProto() 
@@ -108,6 +112,8 @@ def transfer_style():
     reconstruct_coef_2 = parser.reconstruct_coef_2
     generator_coef = parser.generator_coef
     discriminator_coef = parser.discriminator_coef
+    batch_forward = None if parser.batch_forward == 'none' else parser.batch_forward
+    dtype = tf.float16 if parser.precision == 'fp16' else tf.float32
 
     imageName, imageDict = locate(data_path, styles=styles, max_label=categorical_cardinality)
     _, imageTrue = locate(data_path, max_label=categorical_cardinality)
@@ -117,7 +123,7 @@ def transfer_style():
     image2 = tf.placeholder(tf.float32,[None, image_size, image_size, channel_size],name="image2")
     is_training = tf.placeholder(tf.bool,[],name="is_training")
 
-    image1_forward_reconstruct, image2_forward_reconstruct = transfer(image1,image2,kernel,stride,class_dim,style_dim,is_training,'cycle-consistent-vae-with-gan')
+    image1_forward_reconstruct, image2_forward_reconstruct = transfer(image1,image2,kernel,stride,class_dim,style_dim,is_training,'cycle-consistent-vae-with-gan',batch_forward,dtype)
 
     config = tf.ConfigProto() 
     config.gpu_options.per_process_gpu_memory_fraction = parser.gpu_fraction
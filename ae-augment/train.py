@@ -2,8 +2,10 @@ import tensorflow as tf
 import numpy as np
 import argparse
 import os
-from util import locate, choice, find_truth, loader, plot_batch, make_partition
-from network import ae_with_gan, scope_variables, get_mean
+import time
+from tensorflow.python.client import timeline
+from util import locate, choice, find_truth, loader, plot_batch, flush_plots, make_partition, set_glyph_cache, open_pack, prefetch, timed, timed_iter, report_timings
+from network import ae_with_gan, scope_variables, get_mean, input_pipeline, fused_train, loss_scaled, augment_inputs
 
 def init():
     parser = argparse.ArgumentParser()
@@ -17,11 +19,22 @@ def init():
     parser.add_argument('--image_size', type=int, default=64, help="the size of images trained")
     parser.add_argument('--force_grayscale', type=bool, default=True, help="transform images into single channel or not")
     parser.add_argument('--augment', type=int, default=2, help="augment level with ascending (0: None)")
+    parser.add_argument('--graph_augment', type=int, default=0, help="feed base scale glyphs only and build the augment levels inside the graph (0: augment in the loader)")
+    parser.add_argument('--scale_jitter', type=float, default=0.0, help="random zoom range (1 +- scale_jitter) of the in-graph augmentation")
+    parser.add_argument('--offset_jitter', type=float, default=0.0, help="random shift range in pixels of the in-graph augmentation")
     parser.add_argument('--seed', type=int, default=1, help="random seed")
+    parser.add_argument('--cache_size', type=int, default=512, help="memory budget of the decoded glyph cache in MB")
+    parser.add_argument('--cache_path', type=str, default=None, help="directory of the on-disk glyph cache (None: memory only)")
+    parser.add_argument('--prefetch', type=int, default=0, help="number of batches loaded ahead on background threads (0: load synchronously)")
+    parser.add_argument('--input_mode', type=str, default='feed', help="feed batches through feed_dict (feed) or build them with tf.data (dataset), which resizes the levels missing from --pack_path with tf's area filter instead of PIL's antialias")
+    parser.add_argument('--num_parallel_calls', type=int, default=4, help="parallel decoders of the tf.data input mode")
+    parser.add_argument('--train_step', type=str, default='alternate', help="run the forward/generator/discriminator updates one after another (alternate) or in a single graph execution (fused)")
+    parser.add_argument('--pack_path', type=str, default=None, help="prefix of the glyph pack written by pack.py, the scale levels it holds are not decoded again (None: decode the png files)")
     parser.add_argument('--lr', type=float, default=5e-5, help="learning rate")
     parser.add_argument('--loss_type', type=str, default='ce', help="choice of loss functions")
     parser.add_argument('--batch_size', type=int, default=64, help="batch size")
     parser.add_argument('--epochs', type=int, default=1000, help="epochs")
+    parser.add_argument('--plot_every', type=int, default=1, help="write the preview montages every k epochs")
     parser.add_argument('--kernel', type=int, default=4, help="kernel size")
     parser.add_argument('--stride', type=int, default=2, help="stride")
     parser.add_argument('--class_dim', type=int, default=50, help="dimension of class vector")
@@ -30,8 +43,18 @@ def init():
     parser.add_argument('--reconstruct_coef_3', type=float, default=1.0, help="reconstruct coef 3")
     parser.add_argument('--generator_coef', type=float, default=1.0, help="generator coef")
     parser.add_argument('--discriminator_coef', type=float, default=1.0, help="discriminator coef")
+    parser.add_argument('--batch_discriminator', type=int, default=0, help="evaluate all discriminator inputs in one concatenated pass (0: one pass per input)")
+    parser.add_argument('--batch_forward', type=str, default='none', help="run the encoder/decoder calls one by one (none) or as one concatenated batch with per-call (grouped) or shared (pooled) batch norm statistics")
+    parser.add_argument('--precision', type=str, default='fp32', help="run the conv/fc stacks in half (fp16) or single (fp32) precision, batch norm and losses always use fp32")
+    parser.add_argument('--timing', type=int, default=0, help="print per-phase wall-clock timings every epoch and append them to timing_log (0: off)")
+    parser.add_argument('--timing_log', type=str, default='timing.jsonl', help="json-lines file of the per-epoch timings")
+    parser.add_argument('--trace_step', type=int, default=-1, help="step of every epoch whose first session run is traced into timeline-<epoch>.json (-1: no trace)")
     return parser.parse_args()
 
+def write_trace(run_metadata, epoch):
+    with open('timeline-%d.json' % epoch, 'w') as f:
+        f.write(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format())
+
 def main():
     # initialize parameters
     parser = init()
@@ -44,6 +67,9 @@ def main():
     image_size = parser.image_size
     force_grayscale = parser.force_grayscale
     augment = parser.augment
+    graph_augment = parser.graph_augment
+    # levels the loader (or the tf.data pipeline) produces on the host
+    host_augment = 0 if graph_augment else augment
     channel_size = 1 if force_grayscale else 3
     seed = parser.seed
     lr = parser.lr
@@ -58,30 +84,52 @@ def main():
     reconstruct_coef_3 = parser.reconstruct_coef_3
     generator_coef = parser.generator_coef
     discriminator_coef = parser.discriminator_coef
+    batch_discriminator = parser.batch_discriminator
+    batch_forward = None if parser.batch_forward == 'none' else parser.batch_forward
+    dtype = tf.float16 if parser.precision == 'fp16' else tf.float32
+    prefetch_depth = parser.prefetch
+    input_mode = parser.input_mode
+    train_step = parser.train_step
+    timings = {}
+    np.random.seed(seed)
 
     # load data
+    set_glyph_cache(parser.cache_size*1024*1024, parser.cache_path)
     partition = make_partition(300,categorical_cardinality,fraction)
     #partition = np.array([297,304,313,316,376,381,441,512,617,633])
-    imageNameTrain, imageNameTest = locate(data_path,styles=styles, max_label=categorical_cardinality,partition=partition)
+    with timed(timings, 'locate'):
+        imageNameTrain, imageNameTest = locate(data_path,styles=styles, max_label=categorical_cardinality,partition=partition)
     styleTrainNum, charTrainNum, imageTrainNum = imageNameTrain.shape[0], imageNameTrain.shape[1], imageNameTrain.shape[0] * imageNameTrain.shape[1]
     styleTestNum, charTestNum, imageTestNum = imageNameTest.shape[0], imageNameTest.shape[1], imageNameTest.shape[0] * imageNameTest.shape[1]
     print('partition:\n',partition)
     print(imageNameTrain.shape, imageNameTest.shape)
+    pack = open_pack(parser.pack_path) if parser.pack_path is not None else None
 
-    image1 = tf.placeholder(tf.float32,[None, image_size, image_size, channel_size],name="image1")
-    image3 = tf.placeholder(tf.float32,[None, image_size, image_size, channel_size],name="image3")
-    image5 = tf.placeholder(tf.float32,[None, image_size, image_size, channel_size],name="image5")
-    image6 = tf.placeholder(tf.float32,[None, image_size, image_size, channel_size],name="image6")
-    label1 = tf.placeholder(tf.float32,[None, styleTrainNum],name="label1")
-    label3 = tf.placeholder(tf.float32,[None, styleTrainNum],name="label3")
-    is_calligraphy = tf.placeholder(tf.float32,[None, 1],name="is_calligraphy")
+    if input_mode == 'dataset':
+        # the staged batch tensors can still be fed directly for the plots below
+        rows = np.array([[pack[1][name] for name in names] for names in imageNameTrain]) if pack is not None else None
+        [image1,image3,image5,image6,label1,label3,is_calligraphy], input_idxes_1, input_idxes_2, input_initializer, load_batch, input_glyphs = \
+            input_pipeline(imageNameTrain,styleTrainNum,charTrainNum,image_size,image_size,(0.0, 1.0),host_augment,batch_size,rows,parser.num_parallel_calls,max(prefetch_depth,1),
+                           packed_levels=pack[0].shape[1] if pack is not None else 1)
+    else:
+        image1 = tf.placeholder(tf.float32,[None, image_size, image_size, channel_size],name="image1")
+        image3 = tf.placeholder(tf.float32,[None, image_size, image_size, channel_size],name="image3")
+        image5 = tf.placeholder(tf.float32,[None, image_size, image_size, channel_size],name="image5")
+        image6 = tf.placeholder(tf.float32,[None, image_size, image_size, channel_size],name="image6")
+        label1 = tf.placeholder(tf.float32,[None, styleTrainNum],name="label1")
+        label3 = tf.placeholder(tf.float32,[None, styleTrainNum],name="label3")
+        is_calligraphy = tf.placeholder(tf.float32,[None, 1],name="is_calligraphy")
     is_training = tf.placeholder(tf.bool,[],name="is_training")
+    model_inputs = [image1,image3,image5,image6,label1,label3,is_calligraphy]
+    if graph_augment:
+        # the fed tensors above stay the base scale batches, only the model sees the augment levels
+        model_inputs = augment_inputs(model_inputs[:4],model_inputs[4:],augment,image_size,image_size,(0.0, 1.0),is_training,parser.scale_jitter,parser.offset_jitter)
 
     forward_loss, reconstruct_loss_1, reconstruct_loss_3, generator_loss, discriminator_loss, \
     image1_forward_reconstruct, image3_forward_reconstruct, image1_style_reconstruct, image3_style_reconstruct, \
-    _,_,_,_,_,_,_,_,_,_,_,_ = ae_with_gan(image1,image3,image5,image6,label1,label3,is_calligraphy,kernel,stride,class_dim,style_dim,image_size,channel_size,is_training, 
+    _,_,_,_,_,_,_,_,_,_,_,_ = ae_with_gan(*model_inputs,kernel,stride,class_dim,style_dim,image_size,channel_size,is_training, 
                                           loss_type,styleTrainNum,reconstruct_coef_1,reconstruct_coef_3,generator_coef,discriminator_coef,
-                                          'ae-with-gan')
+                                          'ae-with-gan',batch_discriminator,batch_forward,dtype)
 
     encoder_variables = scope_variables("ae-with-gan/encoder")
     decoder_variables = scope_variables('ae-with-gan/decoder')
@@ -93,9 +141,15 @@ def main():
     forward_solver = tf.train.AdamOptimizer(learning_rate=lr,beta1=0.5)
     generator_solver = tf.train.AdamOptimizer(learning_rate=lr,beta1=0.5)
     discriminator_solver = tf.train.AdamOptimizer(learning_rate=lr,beta1=0.5)
-    forward_train = forward_solver.minimize(forward_loss, var_list=encoder_variables+decoder_variables)
-    generator_train = generator_solver.minimize(generator_loss, var_list=decoder_variables)
-    discriminator_train = discriminator_solver.minimize(discriminator_loss, var_list=discriminator_variables)
+    if dtype == tf.float16:
+        forward_solver, generator_solver, discriminator_solver = loss_scaled(forward_solver), loss_scaled(generator_solver), loss_scaled(discriminator_solver)
+    if train_step == 'fused':
+        train = fused_train([forward_solver,generator_solver,discriminator_solver],[forward_loss,generator_loss,discriminator_loss],
+                            [encoder_variables+decoder_variables,decoder_variables,discriminator_variables])
+    else:
+        forward_train = forward_solver.minimize(forward_loss, var_list=encoder_variables+decoder_variables)
+        generator_train = generator_solver.minimize(generator_loss, var_list=decoder_variables)
+        discriminator_train = discriminator_solver.minimize(discriminator_loss, var_list=discriminator_variables)
 
     idxesTrain_1 = np.arange(imageTrainNum, dtype=np.int32)
     idxesTrain_2 = np.arange(imageTrainNum, dtype=np.int32)
@@ -106,7 +160,10 @@ def main():
     saver = tf.train.Saver()
     with tf.Session(config=config) as sess:
         sess.run(tf.global_variables_initializer())
+        if input_mode == 'dataset':
+            sess.run(tf.local_variables_initializer(),feed_dict={input_glyphs:pack[0]} if pack is not None else None)
         for epoch in range(epochs):
+            epoch_start = time.time()
             np.random.shuffle(idxesTrain_1)
             np.random.shuffle(idxesTrain_2)
             forward_losses = []
@@ -115,49 +172,90 @@ def main():
             generator_losses = []
             discriminator_losses = []
             
-            for idx in range(0, imageTrainNum, batch_size):
-                image1_batch, image3_batch, image5_batch, image6_batch, label1_batch, label3_batch, is_calligraphy_batch = loader(imageNameTrain,idxesTrain_1[idx:idx + batch_size],idxesTrain_2[idx:idx + batch_size],styleTrainNum,charTrainNum,desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),augment=augment,force_grayscale=force_grayscale)
-                feed_dict_training = {image1:image1_batch,image3:image3_batch,image5:image5_batch,image6:image6_batch,label1:label1_batch,label3:label3_batch,is_calligraphy:is_calligraphy_batch,is_training:True}
+            if input_mode == 'dataset':
+                sess.run(input_initializer,feed_dict={input_idxes_1:idxesTrain_1,input_idxes_2:idxesTrain_2})
+                def load(idx):
+                    with timed(timings, 'decode'):
+                        return sess.run(load_batch)
+            else:
+                def load(idx):
+                    with timed(timings, 'decode'):
+                        return loader(imageNameTrain,idxesTrain_1[idx:idx + batch_size],idxesTrain_2[idx:idx + batch_size],styleTrainNum,charTrainNum,desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),augment=host_augment,force_grayscale=force_grayscale,pack=pack)
+            for step, batch in enumerate(timed_iter(timings, 'load', prefetch(load, range(0, imageTrainNum, batch_size), 0 if input_mode == 'dataset' else prefetch_depth))):
+                run_options, run_metadata = None, None
+                if step == parser.trace_step:
+                    run_options, run_metadata = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), tf.RunMetadata()
+                if input_mode == 'dataset':
+                    feed_dict_training = {is_training:True}
+                else:
+                    image1_batch, image3_batch, image5_batch, image6_batch, label1_batch, label3_batch, is_calligraphy_batch = batch
+                    feed_dict_training = {image1:image1_batch,image3:image3_batch,image5:image5_batch,image6:image6_batch,label1:label1_batch,label3:label3_batch,is_calligraphy:is_calligraphy_batch,is_training:True}
+
+                if train_step == 'fused':
+                    # forward, generator and discriminator
+                    with timed(timings, 'fused'):
+                        _,_forward_loss,_reconstruct_loss_1,_reconstruct_loss_3,_generator_loss,_discriminator_loss = sess.run([train,forward_loss,reconstruct_loss_1,reconstruct_loss_3,generator_loss,discriminator_loss],feed_dict=feed_dict_training,options=run_options,run_metadata=run_metadata)
+                    if run_metadata is not None:
+                        write_trace(run_metadata, epoch)
+                    forward_losses.append(_forward_loss)
+                    reconstruct_losses_1.append(_reconstruct_loss_1)
+                    reconstruct_losses_3.append(_reconstruct_loss_3)
+                    generator_losses.append(_generator_loss)
+                    discriminator_losses.append(_discriminator_loss)
+                    continue
 
                 # forward
-                _,_forward_loss,_reconstruct_loss_1,_reconstruct_loss_3 = sess.run([forward_train,forward_loss,reconstruct_loss_1,reconstruct_loss_3],feed_dict=feed_dict_training)
+                with timed(timings, 'forward'):
+                    _,_forward_loss,_reconstruct_loss_1,_reconstruct_loss_3 = sess.run([forward_train,forward_loss,reconstruct_loss_1,reconstruct_loss_3],feed_dict=feed_dict_training,options=run_options,run_metadata=run_metadata)
+                if run_metadata is not None:
+                    write_trace(run_metadata, epoch)
                 forward_losses.append(_forward_loss)
                 reconstruct_losses_1.append(_reconstruct_loss_1)
                 reconstruct_losses_3.append(_reconstruct_loss_3)
 
                 # generator
-                _,_generator_loss = sess.run([generator_train,generator_loss],feed_dict=feed_dict_training)
+                with timed(timings, 'generator'):
+                    _,_generator_loss = sess.run([generator_train,generator_loss],feed_dict=feed_dict_training)
                 generator_losses.append(_generator_loss)
 
                 # discriminator
-                _,_discriminator_loss = sess.run([discriminator_train,discriminator_loss],feed_dict=feed_dict_training)
+                with timed(timings, 'discriminator'):
+                    _,_discriminator_loss = sess.run([discriminator_train,discriminator_loss],feed_dict=feed_dict_training)
                 discriminator_losses.append(_discriminator_loss)
 
             print('epoch: %d\nforward_loss: %f\nself_reconstruct_loss: %f\ntransfer_reconstruct_loss: %f\ngenerator_loss: %f\ndiscriminator_loss: %f\n' % \
                 (epoch, get_mean(forward_losses), get_mean(reconstruct_losses_1), get_mean(reconstruct_losses_3), get_mean(generator_losses), get_mean(discriminator_losses)))
             
             # test
-            image1_plot, image3_plot, image5_plot, image6_plot, label1_plot, label3_plot, is_calligraphy_plot = loader(imageNameTrain,idxesTrain_1[0:10],idxesTrain_2[0:10],styleTrainNum,charTrainNum,desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),augment=augment,force_grayscale=force_grayscale)
-            feed_dict_not_training = {image1:image1_plot,image3:image3_plot,image5:image5_plot,image6:image6_plot,label1:label1_plot,label3:label3_plot,is_calligraphy:is_calligraphy_plot,is_training:False}
-            _image1_forward_reconstruct,_image3_forward_reconstruct,_image1_style_reconstruct,_image3_style_reconstruct = sess.run([image1_forward_reconstruct,image3_forward_reconstruct,image1_style_reconstruct,image3_style_reconstruct],feed_dict=feed_dict_not_training)
-            images = [image1_plot,image3_plot,image5_plot,image6_plot,_image1_forward_reconstruct,_image3_forward_reconstruct,_image1_style_reconstruct,_image3_style_reconstruct]
-            coefs = [loss_type,lr,reconstruct_coef_1,reconstruct_coef_3,generator_coef,discriminator_coef]
-            plot_batch(images, 'train', epoch, coefs)
-
-            image1_plot, image3_plot, image5_plot, image6_plot, label1_plot, label3_plot, is_calligraphy_plot = loader(imageNameTest,idxesTest_1,idxesTest_2,styleTestNum,charTestNum,desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),augment=0,force_grayscale=force_grayscale)
-            feed_dict_not_training = {image1:image1_plot,image3:image3_plot,image5:image5_plot,image6:image6_plot,label1:label1_plot,label3:label3_plot,is_calligraphy:is_calligraphy_plot,is_training:False}
-            _image1_forward_reconstruct,_image3_forward_reconstruct,_image1_style_reconstruct,_image3_style_reconstruct = sess.run([image1_forward_reconstruct,image3_forward_reconstruct,image1_style_reconstruct,image3_style_reconstruct],feed_dict=feed_dict_not_training)
-            images = [image1_plot,image3_plot,image5_plot,image6_plot,_image1_forward_reconstruct,_image3_forward_reconstruct,_image1_style_reconstruct,_image3_style_reconstruct]
-            coefs = [loss_type,lr,reconstruct_coef_1,reconstruct_coef_3,generator_coef,discriminator_coef]
-            plot_batch(images, 'test', epoch, coefs)
+            if epoch % parser.plot_every == 0:
+                with timed(timings, 'plot'):
+                    image1_plot, image3_plot, image5_plot, image6_plot, label1_plot, label3_plot, is_calligraphy_plot = loader(imageNameTrain,idxesTrain_1[0:10],idxesTrain_2[0:10],styleTrainNum,charTrainNum,desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),augment=host_augment,force_grayscale=force_grayscale,pack=pack)
+                    feed_dict_not_training = {image1:image1_plot,image3:image3_plot,image5:image5_plot,image6:image6_plot,label1:label1_plot,label3:label3_plot,is_calligraphy:is_calligraphy_plot,is_training:False}
+                    _image1_forward_reconstruct,_image3_forward_reconstruct,_image1_style_reconstruct,_image3_style_reconstruct = sess.run([image1_forward_reconstruct,image3_forward_reconstruct,image1_style_reconstruct,image3_style_reconstruct],feed_dict=feed_dict_not_training)
+                    images = [image1_plot,image3_plot,image5_plot,image6_plot,_image1_forward_reconstruct,_image3_forward_reconstruct,_image1_style_reconstruct,_image3_style_reconstruct]
+                    coefs = [loss_type,lr,reconstruct_coef_1,reconstruct_coef_3,generator_coef,discriminator_coef]
+                    plot_batch(images, 'train', epoch, coefs)
+
+                    image1_plot, image3_plot, image5_plot, image6_plot, label1_plot, label3_plot, is_calligraphy_plot = loader(imageNameTest,idxesTest_1,idxesTest_2,styleTestNum,charTestNum,desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),augment=0,force_grayscale=force_grayscale,pack=pack)
+                    feed_dict_not_training = {image1:image1_plot,image3:image3_plot,image5:image5_plot,image6:image6_plot,label1:label1_plot,label3:label3_plot,is_calligraphy:is_calligraphy_plot,is_training:False}
+                    _image1_forward_reconstruct,_image3_forward_reconstruct,_image1_style_reconstruct,_image3_style_reconstruct = sess.run([image1_forward_reconstruct,image3_forward_reconstruct,image1_style_reconstruct,image3_style_reconstruct],feed_dict=feed_dict_not_training)
+                    images = [image1_plot,image3_plot,image5_plot,image6_plot,_image1_forward_reconstruct,_image3_forward_reconstruct,_image1_style_reconstruct,_image3_style_reconstruct]
+                    coefs = [loss_type,lr,reconstruct_coef_1,reconstruct_coef_3,generator_coef,discriminator_coef]
+                    plot_batch(images, 'test', epoch, coefs)
 
             if (epoch+1) % save_frequency == 0:
                 coefs = [loss_type,lr,reconstruct_coef_1,reconstruct_coef_2,reconstruct_coef_3,generator_coef,discriminator_coef]
                 suffix = ''
                 for coef in coefs:
                     suffix += str(coef)+'-'
-                saver.save(sess,os.path.join(os.path.join('ckpt',suffix[:-1]),'model'))
+                with timed(timings, 'save'):
+                    saver.save(sess,os.path.join(os.path.join('ckpt',suffix[:-1]),'model'))
+
+            if parser.timing:
+                report_timings(timings, epoch, time.time() - epoch_start, imageTrainNum * (1 + augment), parser.timing_log)
+            timings.clear()
 
+        flush_plots()
         if epoch+1 % save_frequency != 0:
             coefs = [loss_type,lr,reconstruct_coef_1,reconstruct_coef_2,reconstruct_coef_3,generator_coef,discriminator_coef]
             suffix = ''
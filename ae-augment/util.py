@@ -1,5 +1,13 @@
 import numpy as np
 import os
+import hashlib
+import tempfile
+import threading
+import time
+import json
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 
 def make_partition(start,end,fraction):
@@ -36,44 +44,110 @@ def find_truth(image1,imageTrue):
         image2.append(imageTrue[flabel][0])
     return image2
 
-def numpy_img_append(batch,img):
-    if batch is None: 
-        batch = np.array([img], dtype=np.float32)
-    else: 
-        batch = np.concatenate((batch,np.array([img], dtype=np.float32)),axis=0)
-    return batch
+glyph_cache = OrderedDict()
+glyph_cache_state = {'budget': 512*1024*1024, 'bytes': 0, 'path': None}
+glyph_cache_lock = threading.Lock()
+
+def set_glyph_cache(budget, path=None):
+    # budget in bytes for decoded glyphs kept in memory, path is an optional on-disk cache directory
+    glyph_cache.clear()
+    glyph_cache_state.update(budget=budget, bytes=0, path=path)
+    if path is not None and not os.path.exists(path):
+        os.makedirs(path)
 
-def numpy_label_append(label,styleNum,styleId):
-    hotVector = np.zeros(styleNum)
-    hotVector[styleId] = 1
-    if label is None:
-        label = np.array([hotVector],dtype=np.float32)
+def cached_glyph(decode, *key):
+    with glyph_cache_lock:
+        img = glyph_cache.get(key)
+        if img is not None:
+            glyph_cache.move_to_end(key)
+            return img
+    path = glyph_cache_state['path']
+    if path is not None:
+        digest = hashlib.md5('-'.join(str(k) for k in key+(os.path.getmtime(key[0]),)).encode()).hexdigest()
+        cache_name = os.path.join(path, digest+'.npy')
+        if os.path.exists(cache_name):
+            img = np.load(cache_name)
+        else:
+            img = decode(*key)
+            # written under a unique name and renamed into place, so that other threads or processes never load a partial file
+            with tempfile.NamedTemporaryFile(dir=path, suffix='.tmp', delete=False) as f:
+                np.save(f, img)
+            os.replace(f.name, cache_name)
     else:
-        label = np.concatenate((label,np.array([hotVector], dtype=np.float32)),axis=0)
-    return label
+        img = decode(*key)
+    img.flags.writeable = False
+    with glyph_cache_lock:
+        if img.nbytes <= glyph_cache_state['budget'] and key not in glyph_cache:
+            glyph_cache[key] = img
+            glyph_cache_state['bytes'] += img.nbytes
+            while glyph_cache_state['bytes'] > glyph_cache_state['budget']:
+                _, evicted = glyph_cache.popitem(last=False)
+                glyph_cache_state['bytes'] -= evicted.nbytes
+    return img
 
-def img_loader(imgName,desired_height,desired_width,center_height,center_width,force_grayscale):
+def new_batch(length,shape,dtype=np.float32):
+    return np.empty((length,)+tuple(shape), dtype=dtype)
+
+def make_one_hot(indices,size,repeat=1):
+    # float32 one-hot rows for a whole batch of integer ids, each row repeated for the augment levels
+    indices = np.repeat(indices, repeat)
+    one_hot = np.zeros((indices.shape[0],size), dtype=np.float32)
+    one_hot[np.arange(indices.shape[0]),indices] = 1
+    return one_hot
+
+def scale_batch(batch,value_range):
+    batch /= 255.0
+    batch *= (value_range[1] - value_range[0])
+    batch += value_range[0]
+    return batch
+
+def decode_levels(imgName,desired_height,desired_width,centers,force_grayscale):
+    # opens the file once and renders every (center_height, center_width) in centers onto its own canvas
     image = Image.open(imgName)
     width, height = image.size
-    img = Image.new('L',(desired_width,desired_height))
-    background = np.ones_like(image,dtype=np.uint8)*255
-    img.paste(Image.fromarray(background.astype(np.uint8)),(0,0))
-    if width != center_width or height != center_height:
-        image = image.resize((center_width, center_height), Image.ANTIALIAS)
-    image_np = np.array(image).astype(np.uint8)
-    #image_binary = np.greater(image_np,np.ones_like(image_np)*250).astype(np.uint8)
-    img.paste(Image.fromarray(image_np),(int(desired_width/2)-int(center_width/2),int(desired_height/2)-int(center_height/2)))
-    #img.paste(Image.fromarray(np.array(image).astype(np.uint8)),(0,0))
-    image = img
-    if force_grayscale: 
-        image = image.convert("L")
-    img = np.array(image)
-    if len(img.shape) == 2: 
-        img = img[:, :, None]
-    #print(np.mean(np.power(img-255/2,2)-(255/2)*(255/2)))
-    return img
+    if image.mode != 'L':
+        image = image.convert('L')
+    imgs = np.zeros((len(centers),desired_height,desired_width,1), dtype=np.uint8)
+    imgs[:,:min(height,desired_height),:min(width,desired_width)] = 255
+    for level, (center_height, center_width) in enumerate(centers):
+        resized = image
+        if width != center_width or height != center_height:
+            resized = image.resize((center_width, center_height), Image.ANTIALIAS)
+        top, left = int(desired_height/2)-int(center_height/2), int(desired_width/2)-int(center_width/2)
+        imgs[level,top:top+center_height,left:left+center_width,0] = np.asarray(resized)
+    return imgs
+
+def decode_img(imgName,desired_height,desired_width,center_height,center_width,force_grayscale):
+    return decode_levels(imgName,desired_height,desired_width,((center_height,center_width),),force_grayscale)[0]
+
+def img_loader(imgName,desired_height,desired_width,center_height,center_width,force_grayscale):
+    return cached_glyph(decode_img,imgName,desired_height,desired_width,center_height,center_width,force_grayscale)
+
+def levels_loader(imgName,desired_height,desired_width,centers,force_grayscale):
+    return cached_glyph(decode_levels,imgName,desired_height,desired_width,centers,force_grayscale)
+
+def pack_glyphs(imageName,pack_path,desired_height,desired_width,force_grayscale=True,augment=0):
+    # write the (style, char) grid of glyphs, each at the base scale and its first augment shrunken levels, into one
+    # uint8 array next to the grid of file names it was built from
+    styleNum, charNum = imageName.shape
+    fractions = [0.75, 0.5, 0.25]
+    centers = [(desired_height, desired_width)] + [(int(desired_height*fraction), int(desired_width*fraction)) for fraction in fractions[:augment]]
+    glyphs = np.lib.format.open_memmap(pack_path+'.npy', mode='w+', dtype=np.uint8, shape=(styleNum,charNum,len(centers),desired_height,desired_width))
+    for styleId in range(styleNum):
+        for charId in range(charNum):
+            glyphs[styleId,charId] = decode_levels(imageName[styleId,charId],desired_height,desired_width,centers,force_grayscale)[:,:,:,0]
+    glyphs.flush()
+    np.save(pack_path+'-index.npy', imageName)
 
-def loader(imageName,idxes1,idxes2,styleNum,charNum,desired_height,desired_width,value_range,augment,force_grayscale=True):
+def open_pack(pack_path):
+    # [glyph, level, h, w] array and {file name: glyph}, packs written with the base scale alone have one level
+    glyphs = np.load(pack_path+'.npy', mmap_mode='r')
+    if glyphs.ndim == 4: glyphs = glyphs[:,:,None]
+    names = np.load(pack_path+'-index.npy')
+    index = dict(zip(names.ravel(), range(names.size)))
+    return glyphs.reshape((-1,)+glyphs.shape[2:]), index
+
+def loader(imageName,idxes1,idxes2,styleNum,charNum,desired_height,desired_width,value_range,augment,force_grayscale=True,pack=None):
     '''
     0 1 2  3 
     4 5 6  7 
@@ -81,79 +155,155 @@ def loader(imageName,idxes1,idxes2,styleNum,charNum,desired_height,desired_width
     '''
     length = idxes1.shape[0]
     fractions = [0.75, 0.5, 0.25]
-    batch1, batch3, batch5, batch6 = None, None, None, None
-    label1, label3, is_calligraphy = None, None, None
-    for i in range(length):
-        styleId1 = int(idxes1[i] / charNum)
-        charId1 = int(idxes1[i] % charNum)
-        styleId2 = int(idxes2[i] / charNum)
-        charId2 = int(idxes2[i] % charNum)
-        #print(idxes1[i], idxes2[i], styleId1,charId1,styleId2,charId2)
-        batch1 = numpy_img_append(batch1,img_loader(imageName[styleId1,charId1],desired_height,desired_width,desired_height,desired_width,force_grayscale))
-        batch3 = numpy_img_append(batch3,img_loader(imageName[styleId2,charId2],desired_height,desired_width,desired_height,desired_width,force_grayscale))
-        batch5 = numpy_img_append(batch5,img_loader(imageName[styleId2,charId1],desired_height,desired_width,desired_height,desired_width,force_grayscale))
-        batch6 = numpy_img_append(batch6,img_loader(imageName[styleId1,charId2],desired_height,desired_width,desired_height,desired_width,force_grayscale))
-        label1 = numpy_label_append(label1,styleNum,styleId1)
-        label3 = numpy_label_append(label3,styleNum,styleId2)
-        is_calligraphy = numpy_label_append(is_calligraphy,1,0)
-        for level in range(augment):
-            batch1 = numpy_img_append(batch1,img_loader(imageName[styleId1,charId1],desired_height,desired_width,int(desired_height*fractions[level]),int(desired_width*fractions[level]),force_grayscale))
-            batch3 = numpy_img_append(batch3,img_loader(imageName[styleId2,charId2],desired_height,desired_width,int(desired_height*fractions[level]),int(desired_width*fractions[level]),force_grayscale))
-            batch5 = numpy_img_append(batch5,img_loader(imageName[styleId2,charId1],desired_height,desired_width,int(desired_height*fractions[level]),int(desired_width*fractions[level]),force_grayscale))
-            batch6 = numpy_img_append(batch6,img_loader(imageName[styleId1,charId2],desired_height,desired_width,int(desired_height*fractions[level]),int(desired_width*fractions[level]),force_grayscale))
-            label1 = numpy_label_append(label1,styleNum,styleId1)
-            label3 = numpy_label_append(label3,styleNum,styleId2)
-            is_calligraphy = numpy_label_append(is_calligraphy,1,0)
-    #threshold = np.ones_like(batch1,dtype=np.float32)*1.0
-    batch1 = (value_range[0] + (batch1 / 255.0) * (value_range[1] - value_range[0]))
-    batch3 = (value_range[0] + (batch3 / 255.0) * (value_range[1] - value_range[0]))
-    batch5 = (value_range[0] + (batch5 / 255.0) * (value_range[1] - value_range[0]))
-    batch6 = (value_range[0] + (batch6 / 255.0) * (value_range[1] - value_range[0]))
-    #batch1 = np.greater(batch1,threshold).astype(np.float32)
-    #batch3 = np.greater(batch3,threshold).astype(np.float32)
-    #batch5 = np.greater(batch5,threshold).astype(np.float32)
-    #batch6 = np.greater(batch6,threshold).astype(np.float32)
-    #print(np.mean(np.power(batch1-0.5,2)-0.25))
-    #print(np.mean(np.power(batch3-0.5,2)-0.25))
-    #print(np.mean(np.power(batch5-0.5,2)-0.25))
-    #print(np.mean(np.power(batch6-0.5,2)-0.25))
+    levels = 1 + augment
+    batch1 = new_batch(length*levels,(desired_height,desired_width,1))
+    batch3 = new_batch(length*levels,(desired_height,desired_width,1))
+    batch5 = new_batch(length*levels,(desired_height,desired_width,1))
+    batch6 = new_batch(length*levels,(desired_height,desired_width,1))
+    styleIds1, charIds1, styleIds2, charIds2 = idxes1 // charNum, idxes1 % charNum, idxes2 // charNum, idxes2 % charNum
+    label1 = make_one_hot(styleIds1,styleNum,levels)
+    label3 = make_one_hot(styleIds2,styleNum,levels)
+    is_calligraphy = np.ones((length*levels,1), dtype=np.float32)
+    first = 0
+    if pack is not None:
+        # the levels held in the pack come straight from the packed array, only the ones beyond them are decoded
+        glyphs, index = pack
+        assert glyphs.shape[2:] == (desired_height, desired_width)
+        first = min(glyphs.shape[1], levels)
+        batch1.reshape(length,levels,desired_height,desired_width)[:,:first] = glyphs[[index[name] for name in imageName[styleIds1,charIds1]],:first]
+        batch3.reshape(length,levels,desired_height,desired_width)[:,:first] = glyphs[[index[name] for name in imageName[styleIds2,charIds2]],:first]
+        batch5.reshape(length,levels,desired_height,desired_width)[:,:first] = glyphs[[index[name] for name in imageName[styleIds2,charIds1]],:first]
+        batch6.reshape(length,levels,desired_height,desired_width)[:,:first] = glyphs[[index[name] for name in imageName[styleIds1,charIds2]],:first]
+    centers = [(desired_height, desired_width)] + [(int(desired_height*fraction), int(desired_width*fraction)) for fraction in fractions[:augment]]
+    centers = tuple(centers[first:])
+    for i in range(length if centers else 0):
+        styleId1, charId1, styleId2, charId2 = styleIds1[i], charIds1[i], styleIds2[i], charIds2[i]
+        # every file is decoded once for all of its scale levels
+        rows = slice(i*levels + first, (i+1)*levels)
+        batch1[rows] = levels_loader(imageName[styleId1,charId1],desired_height,desired_width,centers,force_grayscale)
+        batch3[rows] = levels_loader(imageName[styleId2,charId2],desired_height,desired_width,centers,force_grayscale)
+        batch5[rows] = levels_loader(imageName[styleId2,charId1],desired_height,desired_width,centers,force_grayscale)
+        batch6[rows] = levels_loader(imageName[styleId1,charId2],desired_height,desired_width,centers,force_grayscale)
+    batch1 = scale_batch(batch1,value_range)
+    batch3 = scale_batch(batch3,value_range)
+    batch5 = scale_batch(batch5,value_range)
+    batch6 = scale_batch(batch6,value_range)
     return batch1, batch3, batch5, batch6, label1, label3, is_calligraphy
 
 
+def prefetch(load, items, depth):
+    # yields load(item) in order while up to depth later items are being loaded on worker threads
+    if depth <= 0:
+        for item in items:
+            yield load(item)
+        return
+    with ThreadPoolExecutor(max_workers=depth) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(load, item))
+            if len(pending) > depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+@contextmanager
+def timed(timings, phase):
+    # wall-clock seconds of the block are appended to timings[phase], safe to use from the prefetch threads
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings.setdefault(phase, []).append(time.time() - start)
+
+def timed_iter(timings, phase, items):
+    # times how long every next() blocks, e.g. waiting for the prefetched batches
+    items = iter(items)
+    while True:
+        start = time.time()
+        try:
+            item = next(items)
+        except StopIteration:
+            return
+        timings.setdefault(phase, []).append(time.time() - start)
+        yield item
+
+def report_timings(timings, epoch, elapsed, images, log_path=None):
+    record = {'epoch': epoch, 'seconds': elapsed, 'images_per_sec': images / elapsed if elapsed > 0 else 0.0, 'phases': {}}
+    print('timing: epoch %d, %.2fs, %.1f images/sec' % (epoch, elapsed, record['images_per_sec']))
+    for phase, durations in sorted(timings.items()):
+        durations = np.array(durations)
+        counts, edges = np.histogram(durations, bins=8)
+        record['phases'][phase] = {'total': float(durations.sum()), 'count': len(durations), 'mean': float(durations.mean()),
+                                   'p50': float(np.percentile(durations, 50)), 'p90': float(np.percentile(durations, 90)), 'max': float(durations.max()),
+                                   'histogram': {'counts': counts.tolist(), 'edges': edges.tolist()}}
+        print('  %-14s total %8.3fs  %5.1f%%  n %6d  mean %8.2fms  p50 %8.2fms  p90 %8.2fms  max %8.2fms' % \
+            (phase, durations.sum(), 100.0 * durations.sum() / elapsed if elapsed > 0 else 0.0, len(durations),
+             1e3 * durations.mean(), 1e3 * np.percentile(durations, 50), 1e3 * np.percentile(durations, 90), 1e3 * durations.max()))
+    if log_path is not None:
+        with open(log_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+plot_writer = {'executor': None, 'pending': []}
+
+def montage(columns):
+    # [num,h,w,1] float images in [0,1], laid side by side as a single uint8 [num*h,len(columns)*w] grid
+    grid = (np.stack([column[...,0] for column in columns],axis=1)*255).astype(np.uint8)
+    num, length, h, w = grid.shape
+    return grid.transpose(0,2,1,3).reshape(num*h,length*w)
+
+def save_montage(grid, path):
+    # png encoding and writing run on a background thread so the training loop does not wait on them
+    if plot_writer['executor'] is None:
+        plot_writer['executor'] = ThreadPoolExecutor(max_workers=1)
+    for future in [future for future in plot_writer['pending'] if future.done()]:
+        future.result()
+        plot_writer['pending'].remove(future)
+    plot_writer['pending'].append(plot_writer['executor'].submit(lambda: Image.fromarray(grid,'L').save(path)))
+
+def flush_plots():
+    for future in plot_writer['pending']:
+        future.result()
+    plot_writer['pending'] = []
+
 def plot(image1_plot, image2_plot, image1_reconstruct, image2_reconstruct, title, epoch, reconstruct_coef_1, reconstruct_coef_2, lr):
-    num, w, h, c = image1_plot.shape[0], image1_plot.shape[1], image1_plot.shape[2], image1_plot.shape[3]
-    img = Image.new('L',(w*4,h*num))
-    for i in range(num):
-        img.paste(Image.fromarray(np.squeeze((image1_plot[i]*255).astype(np.uint8))),(64*0,64*i))
-        img.paste(Image.fromarray(np.squeeze((image2_plot[i]*255).astype(np.uint8))),(64*1,64*i))
-        img.paste(Image.fromarray(np.squeeze((image1_reconstruct[i]*255).astype(np.uint8))),(64*2,64*i))
-        img.paste(Image.fromarray(np.squeeze((image2_reconstruct[i]*255).astype(np.uint8))),(64*3,64*i))
-    img.save(os.path.join('savedImages',title+'-'+str(epoch)+'-'+str(reconstruct_coef_1)+'-'+str(reconstruct_coef_2)+str(lr)+'-''.png'))
+    save_montage(montage([image1_plot, image2_plot, image1_reconstruct, image2_reconstruct]), os.path.join('savedImages',title+'-'+str(epoch)+'-'+str(reconstruct_coef_1)+'-'+str(reconstruct_coef_2)+str(lr)+'-''.png'))
 
 def plot_batch(images, title, epoch, coefs):
-    length = len(images)
-    num, w, h, c = images[0].shape[0], images[0].shape[1], images[0].shape[2], images[0].shape[3]
-    img = Image.new('L',(w*length,h*num))
-    for i in range(num):
-        for j in range(length):
-            img.paste(Image.fromarray(np.squeeze((images[j][i]*255).astype(np.uint8))),(64*j,64*i))
     imgName = title+'-'+str(epoch)
     for coef in coefs:
         imgName += '-'+str(coef)
-    img.save(os.path.join('savedImages',imgName+'.png'))
+    save_montage(montage(images), os.path.join('savedImages',imgName+'.png'))
+
+def vector_key(fname):
+    # '<style>/<file name without extension>', the same for a glyph and the .npy file save_vector writes for it
+    namesp = fname.split('/')
+    return namesp[-2]+'/'+namesp[-1].split('.')[0]
+
+def create_vector_store(path, imageName, dim):
+    # one float32 [len(imageName),dim] matrix path.npy with a row for every glyph of imageName, written in batches
+    # by save_vector, and path-index.json listing the vector_key of every row
+    keys = [vector_key(fname) for fname in imageName]
+    with open(path+'-index.json', 'w') as f:
+        json.dump(keys, f)
+    vectors = np.lib.format.open_memmap(path+'.npy', mode='w+', dtype=np.float32, shape=(len(keys), dim))
+    return {'path': path, 'index': {key: row for row, key in enumerate(keys)}, 'vectors': vectors}
 
-def save_vector(imageName, vector):
+def open_vector_store(path):
+    with open(path+'-index.json') as f:
+        keys = json.load(f)
+    return {'path': path, 'index': {key: row for row, key in enumerate(keys)}, 'vectors': np.load(path+'.npy', mmap_mode='r')}
+
+def vector_rows(store, imageName):
+    return np.array([store['index'][vector_key(fname)] for fname in imageName], dtype=np.int64)
+
+def save_vector(imageName, vector, store=None):
+    # without a store every vector goes to its own .npy file next to the glyph
+    if store is not None:
+        store['vectors'][vector_rows(store, imageName)] = vector
+        return
     path = '../../demo'
     for i in range(len(imageName)):
         namesp = imageName[i].split('/')
         style = namesp[-2]
         filename = namesp[-1].split('.')[0]
         np.save(os.path.join(os.path.join(path,style),filename+'.npy'),vector[i])
-
-if __name__ == '__main__':
-    label = None
-    label = numpy_label_append(label,5,2)
-    label = numpy_label_append(label,5,4)
-    label = numpy_label_append(label,5,0)
-    label = numpy_label_append(label,5,2)
-    print(label)
\ No newline at end of file
@@ -131,7 +131,13 @@ def discriminator(image,kernel,stride,is_training,name='discriminator'):
         pred = fc(fc2,1,is_training,layers.batch_norm,tf.nn.sigmoid,'pred')
     return pred
 
-def ae_with_gan(image1,image2,image3,image4,image5,image6,kernel,stride,class_dim,style_dim,is_training,loss_type,reconstruct_coef_1,reconstruct_coef_2,reconstruct_coef_3,generator_coef,discriminator_coef,name='ae-with-gan'):
+def batched_discriminator(images,kernel,stride,is_training,name):
+    # a single discriminator pass over all images concatenated along the batch axis, batch norm moments are pooled over them
+    sizes = [tf.shape(image)[0] for image in images]
+    pred = discriminator(tf.concat(images,0),kernel,stride,is_training,name)
+    return tf.split(pred,tf.stack(sizes),0,num=len(images))
+
+def ae_with_gan(image1,image2,image3,image4,image5,image6,kernel,stride,class_dim,style_dim,is_training,loss_type,reconstruct_coef_1,reconstruct_coef_2,reconstruct_coef_3,generator_coef,discriminator_coef,name='ae-with-gan',batch_discriminator=False):
     # image2 is the ground truth of image1
     # image4 is the ground truth of image3
     # image5 if the ground truth of content of image1 with style of image3
@@ -176,18 +182,26 @@ def ae_with_gan(image1,image2,image3,image4,image5,image6,kernel,stride,class_di
 
         forward_loss = reconstruct_loss_1 + reconstruct_loss_2 + reconstruct_loss_3
 
-        image1_pred_true = discriminator(image1,kernel,stride,is_training,'discriminator_1')
-        image2_pred_true = discriminator(image2,kernel,stride,is_training,'discriminator_2')
-        image3_pred_true = discriminator(image3,kernel,stride,is_training,'discriminator_3')
-        image4_pred_true = discriminator(image4,kernel,stride,is_training,'discriminator_2')
-        image5_pred_true = discriminator(image5,kernel,stride,is_training,'discriminator_3')
-        image6_pred_true = discriminator(image6,kernel,stride,is_training,'discriminator_1')
-        image1_pred_forward_fake = discriminator(image1_forward_reconstruct,kernel,stride,is_training,'discriminator_1')
-        image2_pred_forward_fake = discriminator(image2_forward_reconstruct,kernel,stride,is_training,'discriminator_2')
-        image3_pred_forward_fake = discriminator(image3_forward_reconstruct,kernel,stride,is_training,'discriminator_3')
-        image4_pred_forward_fake = discriminator(image4_forward_reconstruct,kernel,stride,is_training,'discriminator_2')
-        image1_style_forward_fake = discriminator(image1_style_reconstruct,kernel,stride,is_training,'discriminator_3')
-        image3_style_forward_fake = discriminator(image3_style_reconstruct,kernel,stride,is_training,'discriminator_1')
+        if batch_discriminator:
+            image1_pred_true, image6_pred_true, image1_pred_forward_fake, image3_style_forward_fake = batched_discriminator(
+                [image1,image6,image1_forward_reconstruct,image3_style_reconstruct],kernel,stride,is_training,'discriminator_1')
+            image2_pred_true, image4_pred_true, image2_pred_forward_fake, image4_pred_forward_fake = batched_discriminator(
+                [image2,image4,image2_forward_reconstruct,image4_forward_reconstruct],kernel,stride,is_training,'discriminator_2')
+            image3_pred_true, image5_pred_true, image3_pred_forward_fake, image1_style_forward_fake = batched_discriminator(
+                [image3,image5,image3_forward_reconstruct,image1_style_reconstruct],kernel,stride,is_training,'discriminator_3')
+        else:
+            image1_pred_true = discriminator(image1,kernel,stride,is_training,'discriminator_1')
+            image2_pred_true = discriminator(image2,kernel,stride,is_training,'discriminator_2')
+            image3_pred_true = discriminator(image3,kernel,stride,is_training,'discriminator_3')
+            image4_pred_true = discriminator(image4,kernel,stride,is_training,'discriminator_2')
+            image5_pred_true = discriminator(image5,kernel,stride,is_training,'discriminator_3')
+            image6_pred_true = discriminator(image6,kernel,stride,is_training,'discriminator_1')
+            image1_pred_forward_fake = discriminator(image1_forward_reconstruct,kernel,stride,is_training,'discriminator_1')
+            image2_pred_forward_fake = discriminator(image2_forward_reconstruct,kernel,stride,is_training,'discriminator_2')
+            image3_pred_forward_fake = discriminator(image3_forward_reconstruct,kernel,stride,is_training,'discriminator_3')
+            image4_pred_forward_fake = discriminator(image4_forward_reconstruct,kernel,stride,is_training,'discriminator_2')
+            image1_style_forward_fake = discriminator(image1_style_reconstruct,kernel,stride,is_training,'discriminator_3')
+            image3_style_forward_fake = discriminator(image3_style_reconstruct,kernel,stride,is_training,'discriminator_1')
 
         discriminator_true_1 = tf.reduce_mean(tf.log(image1_pred_true + 1e-6))
         discriminator_true_2 = tf.reduce_mean(tf.log(image2_pred_true + 1e-6))
@@ -2,7 +2,7 @@ import tensorflow as tf
 import numpy as np
 import argparse
 import os
-from util import locate, choice, find_truth, loader, plot, save_vector
+from util import locate, choice, truth_rows, loader, plot, save_vector
 from network import ae_with_gan, transfer
 
 def init():
@@ -50,8 +50,8 @@ def test_with_graph_manually_set_up():
     generator_coef = parser.generator_coef
     discriminator_coef = parser.discriminator_coef
 
-    imageName, imageDict = locate(data_path, styles=styles, max_label=categorical_cardinality)
-    _, imageTrue = locate(data_path, max_label=categorical_cardinality)
+    imageName, imageDict, imageIndex = locate(data_path, styles=styles, max_label=categorical_cardinality, index=True)
+    imageTrueName, imageTrue, imageTrueIndex = locate(data_path, max_label=categorical_cardinality, index=True)
     imageNum = len(imageName)
 
     image1 = tf.placeholder(tf.float32,[None, image_size, image_size, channel_size],name="image1")
@@ -73,7 +73,7 @@ def test_with_graph_manually_set_up():
         saver.restore(sess, tf.train.latest_checkpoint('ckpt/try'))
         for idx in range(0, imageNum, batch_size):
             image1_test = loader(imageName[idxes_1[idx:idx + batch_size]],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
-            image2_test = loader(find_truth(imageName[idxes_1[idx:idx + batch_size]],imageTrue),desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
+            image2_test = loader(imageTrueName[truth_rows(imageIndex['labels'][idxes_1[idx:idx + batch_size]],imageTrueIndex)],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
             feed_dict_not_training = {image1:image1_test,image2:image2_test,is_training:False}
             image1_reconstruct, image2_reconstruct = sess.run([image1_forward_reconstruct, image2_forward_reconstruct],feed_dict=feed_dict_not_training)
             #save_vector(imageName[idxes_1[idx:idx + batch_size]], latent_vector)
@@ -109,8 +109,8 @@ def transfer_style():
     generator_coef = parser.generator_coef
     discriminator_coef = parser.discriminator_coef
 
-    imageName, imageDict = locate(data_path, styles=styles, max_label=categorical_cardinality)
-    _, imageTrue = locate(data_path, max_label=categorical_cardinality)
+    imageName, imageDict, imageIndex = locate(data_path, styles=styles, max_label=categorical_cardinality, index=True)
+    imageTrueName, imageTrue, imageTrueIndex = locate(data_path, max_label=categorical_cardinality, index=True)
     imageNum = len(imageName)
 
     image1 = tf.placeholder(tf.float32,[None, image_size, image_size, channel_size],name="image1")
@@ -157,8 +157,8 @@ def test_with_graph_automatically_loaded():
     generator_coef = parser.generator_coef
     discriminator_coef = parser.discriminator_coef
 
-    imageName, imageDict = locate(data_path, styles=styles, max_label=categorical_cardinality)
-    _, imageTrue = locate(data_path, max_label=categorical_cardinality)
+    imageName, imageDict, imageIndex = locate(data_path, styles=styles, max_label=categorical_cardinality, index=True)
+    imageTrueName, imageTrue, imageTrueIndex = locate(data_path, max_label=categorical_cardinality, index=True)
     imageNum = len(imageName)
 
     #image1 = tf.placeholder(tf.float32,[None, image_size, image_size, channel_size],name="image1")
@@ -177,7 +177,7 @@ def test_with_graph_automatically_loaded():
         with tf.Session(config=config) as sess:
             saver.restore(sess, tf.train.latest_checkpoint('ckpt/server-2/'))
             image1_test = loader(imageName[idxes_1[0:10]],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
-            image2_test = loader(find_truth(imageName[idxes_1[0:10]],imageTrue),desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
+            image2_test = loader(imageTrueName[truth_rows(imageIndex['labels'][idxes_1[0:10]],imageTrueIndex)],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
             image1 = graph.get_tensor_by_name('image1:0')
             image2 = graph.get_tensor_by_name('image2:0')
             is_training = graph.get_tensor_by_name('is_training:0')
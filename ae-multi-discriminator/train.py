@@ -2,7 +2,7 @@ import tensorflow as tf
 import numpy as np
 import argparse
 import os
-from util import locate, choice, find_truth, loader, plot_batch
+from util import locate, choice, truth_rows, loader, plot_batch, flush_plots, set_glyph_cache, set_manifest
 from network import ae_with_gan, scope_variables, get_mean
 
 def init():
@@ -17,10 +17,14 @@ def init():
     parser.add_argument('--image_size', type=int, default=64, help="the size of images trained")
     parser.add_argument('--force_grayscale', type=bool, default=True, help="transform images into single channel or not")
     parser.add_argument('--seed', type=int, default=1, help="random seed")
+    parser.add_argument('--cache_size', type=int, default=512, help="memory budget of the decoded glyph cache in MB")
+    parser.add_argument('--cache_path', type=str, default=None, help="directory of the on-disk glyph cache (None: memory only)")
+    parser.add_argument('--manifest_path', type=str, default=None, help="json file caching the dataset directory listings (None: walk the dataset at every start)")
     parser.add_argument('--lr', type=float, default=5e-5, help="learning rate")
     parser.add_argument('--loss_type', type=str, default='l1', help="choice of loss functions")
     parser.add_argument('--batch_size', type=int, default=64, help="batch size")
     parser.add_argument('--epochs', type=int, default=1000, help="epochs")
+    parser.add_argument('--plot_every', type=int, default=1, help="write the preview montages every k epochs")
     parser.add_argument('--kernel', type=int, default=4, help="kernel size")
     parser.add_argument('--stride', type=int, default=2, help="stride")
     parser.add_argument('--class_dim', type=int, default=50, help="dimension of class vector")
@@ -30,6 +34,7 @@ def init():
     parser.add_argument('--reconstruct_coef_3', type=float, default=1.0, help="reconstruct coef 3")
     parser.add_argument('--generator_coef', type=float, default=1.0, help="generator coef")
     parser.add_argument('--discriminator_coef', type=float, default=1.0, help="discriminator coef")
+    parser.add_argument('--batch_discriminator', type=int, default=0, help="evaluate all discriminator inputs in one concatenated pass (0: one pass per input)")
     return parser.parse_args()
 
 def main():
@@ -58,15 +63,18 @@ def main():
     reconstruct_coef_3 = parser.reconstruct_coef_3
     generator_coef = parser.generator_coef
     discriminator_coef = parser.discriminator_coef
+    batch_discriminator = parser.batch_discriminator
 
     # load data
+    set_glyph_cache(parser.cache_size*1024*1024, parser.cache_path)
+    set_manifest(parser.manifest_path)
     partition = np.arange(categorical_cardinality, dtype=np.int32)
     np.random.shuffle(partition)
     partition = partition[:int(categorical_cardinality*(1-fraction))]
     print('partition:\n',partition)
-    imageNameTrain1, imageDictTrain1, imageNameTest1, imageDictTest1 = locate(data_path, styles=['std/'+style_1+'/cut'], max_label=categorical_cardinality, partition=partition)
-    imageNameTrain2, imageDictTrain2, imageNameTest2, imageDictTest2 = locate(data_path, styles=['std/'+style_2+'/cut'], max_label=categorical_cardinality, partition=partition)
-    imageNameTrain3, imageDictTrain3, imageNameTest3, imageDictTest3 = locate(data_path, styles=['std/0/cut'], max_label=categorical_cardinality, partition=partition)
+    imageNameTrain1, imageDictTrain1, imageNameTest1, imageDictTest1, imageIndexTrain1, imageIndexTest1 = locate(data_path, styles=['std/'+style_1+'/cut'], max_label=categorical_cardinality, partition=partition, index=True)
+    imageNameTrain2, imageDictTrain2, imageNameTest2, imageDictTest2, imageIndexTrain2, imageIndexTest2 = locate(data_path, styles=['std/'+style_2+'/cut'], max_label=categorical_cardinality, partition=partition, index=True)
+    imageNameTrain3, imageDictTrain3, imageNameTest3, imageDictTest3, imageIndexTrain3, imageIndexTest3 = locate(data_path, styles=['std/0/cut'], max_label=categorical_cardinality, partition=partition, index=True)
     imageNum = len(imageNameTrain1)
 
     image1 = tf.placeholder(tf.float32,[None, image_size, image_size, channel_size],name="image1")
@@ -81,7 +89,7 @@ def main():
     image1_forward_reconstruct, image2_forward_reconstruct, image3_forward_reconstruct, image4_forward_reconstruct, \
     class_vector_1, style_vector_1, image1_style_reconstruct, image3_style_reconstruct = ae_with_gan(image1,image2,image3,image4,image5,image6,kernel,stride,class_dim,style_dim,is_training, loss_type,
                                                                                                      reconstruct_coef_1,reconstruct_coef_2,reconstruct_coef_3,generator_coef,discriminator_coef,
-                                                                                                     'ae-with-gan')
+                                                                                                     'ae-with-gan',batch_discriminator)
 
     encoder_variables = scope_variables("ae-with-gan/encoder")
     decoder_variables = scope_variables('ae-with-gan/decoder')
@@ -118,11 +126,11 @@ def main():
             
             for idx in range(0, imageNum, batch_size):
                 image1_batch = loader(imageNameTrain1[idxes_1[idx:idx + batch_size]],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
-                image2_batch = loader(find_truth(imageNameTrain1[idxes_1[idx:idx + batch_size]],imageDictTrain3),desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
+                image2_batch = loader(imageNameTrain3[truth_rows(imageIndexTrain1['labels'][idxes_1[idx:idx + batch_size]],imageIndexTrain3)],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
                 image3_batch = loader(imageNameTrain2[idxes_2[idx:idx + batch_size]],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
-                image4_batch = loader(find_truth(imageNameTrain2[idxes_2[idx:idx + batch_size]],imageDictTrain3),desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
-                image5_batch = loader(find_truth(imageNameTrain1[idxes_1[idx:idx + batch_size]],imageDictTrain2),desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
-                image6_batch = loader(find_truth(imageNameTrain2[idxes_2[idx:idx + batch_size]],imageDictTrain1),desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
+                image4_batch = loader(imageNameTrain3[truth_rows(imageIndexTrain2['labels'][idxes_2[idx:idx + batch_size]],imageIndexTrain3)],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
+                image5_batch = loader(imageNameTrain2[truth_rows(imageIndexTrain1['labels'][idxes_1[idx:idx + batch_size]],imageIndexTrain2)],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
+                image6_batch = loader(imageNameTrain1[truth_rows(imageIndexTrain2['labels'][idxes_2[idx:idx + batch_size]],imageIndexTrain1)],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
                 feed_dict_training = {image1:image1_batch,image2:image2_batch,image3:image3_batch,image4:image4_batch,image5:image5_batch,image6:image6_batch,is_training:True}
 
                 # forward
@@ -143,31 +151,33 @@ def main():
             print('epoch: %d\nforward_loss: %f\nself_reconstruct_loss: %f\ntruth_reconstruct_loss: %f\ntransfer_reconstruct_loss: %f\ngenerator_loss: %f\ndiscriminator_loss: %f\n' % \
                 (epoch, get_mean(forward_losses), get_mean(reconstruct_losses_1), get_mean(reconstruct_losses_2), get_mean(reconstruct_losses_3), get_mean(generator_losses), get_mean(discriminator_losses)))
             
-            # test
-            image1_plot = loader(imageNameTrain1[idxes_1[0:10]],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
-            image2_plot = loader(find_truth(imageNameTrain1[idxes_1[0:10]],imageDictTrain3),desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
-            image3_plot = loader(imageNameTrain2[idxes_2[0:10]],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
-            image4_plot = loader(find_truth(imageNameTrain2[idxes_2[0:10]],imageDictTrain3),desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
-            image5_plot = loader(find_truth(imageNameTrain1[idxes_1[0:10]],imageDictTrain2),desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
-            image6_plot = loader(find_truth(imageNameTrain2[idxes_2[0:10]],imageDictTrain1),desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
-            feed_dict_not_training = {image1:image1_plot,image2:image2_plot,image3:image3_plot,image4:image4_plot,image5:image5_plot,image6:image6_plot,is_training:False}
-            _image1_forward_reconstruct,_image2_forward_reconstruct,_image3_forward_reconstruct,_image4_forward_reconstruct,_image1_style_reconstruct,_image3_style_reconstruct = sess.run([image1_forward_reconstruct,image2_forward_reconstruct,image3_forward_reconstruct,image4_forward_reconstruct,image1_style_reconstruct,image3_style_reconstruct],feed_dict=feed_dict_not_training)
-            images = [image1_plot,image2_plot,image3_plot,image4_plot,image5_plot,image6_plot,_image1_forward_reconstruct,_image2_forward_reconstruct,_image3_forward_reconstruct,_image4_forward_reconstruct,_image1_style_reconstruct,_image3_style_reconstruct]
-            coefs = [loss_type,lr,reconstruct_coef_1,reconstruct_coef_2,reconstruct_coef_3,generator_coef,discriminator_coef]
-            plot_batch(images, 'train', epoch, coefs)
-
-            image1_plot = loader(imageNameTest1,desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
-            image2_plot = loader(find_truth(imageNameTest1,imageDictTest3),desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
-            image3_plot = loader(imageNameTest2,desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
-            image4_plot = loader(find_truth(imageNameTest2,imageDictTest3),desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
-            image5_plot = loader(find_truth(imageNameTest1,imageDictTest2),desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
-            image6_plot = loader(find_truth(imageNameTest2,imageDictTest1),desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
-            feed_dict_not_training = {image1:image1_plot,image2:image2_plot,image3:image3_plot,image4:image4_plot,image5:image5_plot,image6:image6_plot,is_training:False}
-            _image1_forward_reconstruct,_image2_forward_reconstruct,_image3_forward_reconstruct,_image4_forward_reconstruct,_image1_style_reconstruct,_image3_style_reconstruct = sess.run([image1_forward_reconstruct,image2_forward_reconstruct,image3_forward_reconstruct,image4_forward_reconstruct,image1_style_reconstruct,image3_style_reconstruct],feed_dict=feed_dict_not_training)
-            images = [image1_plot,image2_plot,image3_plot,image4_plot,image5_plot,image6_plot,_image1_forward_reconstruct,_image2_forward_reconstruct,_image3_forward_reconstruct,_image4_forward_reconstruct,_image1_style_reconstruct,_image3_style_reconstruct]
-            coefs = [loss_type,lr,reconstruct_coef_1,reconstruct_coef_2,reconstruct_coef_3,generator_coef,discriminator_coef]
-            plot_batch(images, 'test', epoch, coefs)
-
+            if epoch % parser.plot_every == 0:
+                # test
+                image1_plot = loader(imageNameTrain1[idxes_1[0:10]],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
+                image2_plot = loader(imageNameTrain3[truth_rows(imageIndexTrain1['labels'][idxes_1[0:10]],imageIndexTrain3)],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
+                image3_plot = loader(imageNameTrain2[idxes_2[0:10]],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
+                image4_plot = loader(imageNameTrain3[truth_rows(imageIndexTrain2['labels'][idxes_2[0:10]],imageIndexTrain3)],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
+                image5_plot = loader(imageNameTrain2[truth_rows(imageIndexTrain1['labels'][idxes_1[0:10]],imageIndexTrain2)],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
+                image6_plot = loader(imageNameTrain1[truth_rows(imageIndexTrain2['labels'][idxes_2[0:10]],imageIndexTrain1)],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
+                feed_dict_not_training = {image1:image1_plot,image2:image2_plot,image3:image3_plot,image4:image4_plot,image5:image5_plot,image6:image6_plot,is_training:False}
+                _image1_forward_reconstruct,_image2_forward_reconstruct,_image3_forward_reconstruct,_image4_forward_reconstruct,_image1_style_reconstruct,_image3_style_reconstruct = sess.run([image1_forward_reconstruct,image2_forward_reconstruct,image3_forward_reconstruct,image4_forward_reconstruct,image1_style_reconstruct,image3_style_reconstruct],feed_dict=feed_dict_not_training)
+                images = [image1_plot,image2_plot,image3_plot,image4_plot,image5_plot,image6_plot,_image1_forward_reconstruct,_image2_forward_reconstruct,_image3_forward_reconstruct,_image4_forward_reconstruct,_image1_style_reconstruct,_image3_style_reconstruct]
+                coefs = [loss_type,lr,reconstruct_coef_1,reconstruct_coef_2,reconstruct_coef_3,generator_coef,discriminator_coef]
+                plot_batch(images, 'train', epoch, coefs)
+
+                image1_plot = loader(imageNameTest1,desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
+                image2_plot = loader(imageNameTest3[truth_rows(imageIndexTest1['labels'],imageIndexTest3)],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
+                image3_plot = loader(imageNameTest2,desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
+                image4_plot = loader(imageNameTest3[truth_rows(imageIndexTest2['labels'],imageIndexTest3)],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
+                image5_plot = loader(imageNameTest2[truth_rows(imageIndexTest1['labels'],imageIndexTest2)],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
+                image6_plot = loader(imageNameTest1[truth_rows(imageIndexTest2['labels'],imageIndexTest1)],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
+                feed_dict_not_training = {image1:image1_plot,image2:image2_plot,image3:image3_plot,image4:image4_plot,image5:image5_plot,image6:image6_plot,is_training:False}
+                _image1_forward_reconstruct,_image2_forward_reconstruct,_image3_forward_reconstruct,_image4_forward_reconstruct,_image1_style_reconstruct,_image3_style_reconstruct = sess.run([image1_forward_reconstruct,image2_forward_reconstruct,image3_forward_reconstruct,image4_forward_reconstruct,image1_style_reconstruct,image3_style_reconstruct],feed_dict=feed_dict_not_training)
+                images = [image1_plot,image2_plot,image3_plot,image4_plot,image5_plot,image6_plot,_image1_forward_reconstruct,_image2_forward_reconstruct,_image3_forward_reconstruct,_image4_forward_reconstruct,_image1_style_reconstruct,_image3_style_reconstruct]
+                coefs = [loss_type,lr,reconstruct_coef_1,reconstruct_coef_2,reconstruct_coef_3,generator_coef,discriminator_coef]
+                plot_batch(images, 'test', epoch, coefs)
+
+        flush_plots()
         coefs = [loss_type,lr,reconstruct_coef_1,reconstruct_coef_2,reconstruct_coef_3,generator_coef,discriminator_coef]
         suffix = ''
         for coef in coefs:
@@ -2,7 +2,7 @@ import tensorflow as tf
 import numpy as np
 import argparse
 import os
-from util import locate, choice, find_truth, loader, plot, save_vector
+from util import locate, choice, truth_rows, loader, plot, save_vector
 from network import ae_with_gan, transfer
 
 def init():
@@ -26,6 +26,7 @@ def init():
     parser.add_argument('--reconstruct_coef_2', type=float, default=1.0, help="reconstruct coef 2")
     parser.add_argument('--generator_coef', type=float, default=1.0, help="generator coef")
     parser.add_argument('--discriminator_coef', type=float, default=1.0, help="discriminator coef")
+    parser.add_argument('--batch_forward', type=str, default='none', help="run the encoder/decoder calls one by one (none) or as one concatenated batch with per-call (grouped) or shared (pooled) batch norm statistics")
     return parser.parse_args()
 
 def test_with_graph_manually_set_up():
@@ -49,9 +50,10 @@ def test_with_graph_manually_set_up():
     reconstruct_coef_2 = parser.reconstruct_coef_2
     generator_coef = parser.generator_coef
     discriminator_coef = parser.discriminator_coef
+    batch_forward = None if parser.batch_forward == 'none' else parser.batch_forward
 
-    imageName, imageDict = locate(data_path, styles=styles, max_label=categorical_cardinality)
-    _, imageTrue = locate(data_path, max_label=categorical_cardinality)
+    imageName, imageDict, imageIndex = locate(data_path, styles=styles, max_label=categorical_cardinality, index=True)
+    imageTrueName, imageTrue, imageTrueIndex = locate(data_path, max_label=categorical_cardinality, index=True)
     imageNum = len(imageName)
 
     image1 = tf.placeholder(tf.float32,[None, image_size, image_size, channel_size],name="image1")
@@ -61,7 +63,7 @@ def test_with_graph_manually_set_up():
     forward_loss, reconstruct_loss_1, reconstruct_loss_2, generator_loss, discriminator_loss, image1_forward_reconstruct, image2_forward_reconstruct,  class_vector_1, style_vector_1, image1_transfer_reconstruct, image2_transfer_reconstruct = ae_with_gan(
                                                                                                                                  image1,image2,kernel,stride,class_dim,style_dim,is_training,
                                                                                                                                  reconstruct_coef_1,reconstruct_coef_2,generator_coef,discriminator_coef,
-                                                                                                                                 'cycle-consistent-vae-with-gan')
+                                                                                                                                 'cycle-consistent-vae-with-gan',batch_forward=batch_forward)
 
     #print([n.name for n in tf.get_default_graph().as_graph_def().node])
     config = tf.ConfigProto() 
@@ -73,7 +75,7 @@ def test_with_graph_manually_set_up():
         saver.restore(sess, tf.train.latest_checkpoint('ckpt/try'))
         for idx in range(0, imageNum, batch_size):
             image1_test = loader(imageName[idxes_1[idx:idx + batch_size]],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
-            image2_test = loader(find_truth(imageName[idxes_1[idx:idx + batch_size]],imageTrue),desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
+            image2_test = loader(imageTrueName[truth_rows(imageIndex['labels'][idxes_1[idx:idx + batch_size]],imageTrueIndex)],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
             feed_dict_not_training = {image1:image1_test,image2:image2_test,is_training:False}
             image1_reconstruct, image2_reconstruct = sess.run([image1_forward_reconstruct, image2_forward_reconstruct],feed_dict=feed_dict_not_training)
             #save_vector(imageName[idxes_1[idx:idx + batch_size]], latent_vector)
@@ -108,16 +110,17 @@ def transfer_style():
     reconstruct_coef_2 = parser.reconstruct_coef_2
     generator_coef = parser.generator_coef
     discriminator_coef = parser.discriminator_coef
+    batch_forward = None if parser.batch_forward == 'none' else parser.batch_forward
 
-    imageName, imageDict = locate(data_path, styles=styles, max_label=categorical_cardinality)
-    _, imageTrue = locate(data_path, max_label=categorical_cardinality)
+    imageName, imageDict, imageIndex = locate(data_path, styles=styles, max_label=categorical_cardinality, index=True)
+    imageTrueName, imageTrue, imageTrueIndex = locate(data_path, max_label=categorical_cardinality, index=True)
     imageNum = len(imageName)
 
     image1 = tf.placeholder(tf.float32,[None, image_size, image_size, channel_size],name="image1")
     image2 = tf.placeholder(tf.float32,[None, image_size, image_size, channel_size],name="image2")
     is_training = tf.placeholder(tf.bool,[],name="is_training")
 
-    image1_forward_reconstruct, image2_forward_reconstruct = transfer(image1,image2,kernel,stride,class_dim,style_dim,is_training,'cycle-consistent-vae-with-gan')
+    image1_forward_reconstruct, image2_forward_reconstruct = transfer(image1,image2,kernel,stride,class_dim,style_dim,is_training,'cycle-consistent-vae-with-gan',batch_forward)
 
     config = tf.ConfigProto() 
     config.gpu_options.per_process_gpu_memory_fraction = parser.gpu_fraction
@@ -157,8 +160,8 @@ def test_with_graph_automatically_loaded():
     generator_coef = parser.generator_coef
     discriminator_coef = parser.discriminator_coef
 
-    imageName, imageDict = locate(data_path, styles=styles, max_label=categorical_cardinality)
-    _, imageTrue = locate(data_path, max_label=categorical_cardinality)
+    imageName, imageDict, imageIndex = locate(data_path, styles=styles, max_label=categorical_cardinality, index=True)
+    imageTrueName, imageTrue, imageTrueIndex = locate(data_path, max_label=categorical_cardinality, index=True)
     imageNum = len(imageName)
 
     #image1 = tf.placeholder(tf.float32,[None, image_size, image_size, channel_size],name="image1")
@@ -177,7 +180,7 @@ def test_with_graph_automatically_loaded():
         with tf.Session(config=config) as sess:
             saver.restore(sess, tf.train.latest_checkpoint('ckpt/server-2/'))
             image1_test = loader(imageName[idxes_1[0:10]],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
-            image2_test = loader(find_truth(imageName[idxes_1[0:10]],imageTrue),desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
+            image2_test = loader(imageTrueName[truth_rows(imageIndex['labels'][idxes_1[0:10]],imageTrueIndex)],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
             image1 = graph.get_tensor_by_name('image1:0')
             image2 = graph.get_tensor_by_name('image2:0')
             is_training = graph.get_tensor_by_name('is_training:0')
@@ -2,7 +2,7 @@ import tensorflow as tf
 import numpy as np
 import argparse
 import os
-from util import locate, choice, find_truth, loader, plot
+from util import locate, choice, truth_rows, loader, plot, flush_plots, set_glyph_cache, set_manifest
 from network import ae_with_gan, scope_variables, get_mean
 
 def init():
@@ -15,9 +15,13 @@ def init():
     parser.add_argument('--image_size', type=int, default=64, help="the size of images trained")
     parser.add_argument('--force_grayscale', type=bool, default=True, help="transform images into single channel or not")
     parser.add_argument('--seed', type=int, default=1, help="random seed")
+    parser.add_argument('--cache_size', type=int, default=512, help="memory budget of the decoded glyph cache in MB")
+    parser.add_argument('--cache_path', type=str, default=None, help="directory of the on-disk glyph cache (None: memory only)")
+    parser.add_argument('--manifest_path', type=str, default=None, help="json file caching the dataset directory listings (None: walk the dataset at every start)")
     parser.add_argument('--lr', type=float, default=5e-4, help="learning rate")
     parser.add_argument('--batch_size', type=int, default=64, help="batch size")
     parser.add_argument('--epochs', type=int, default=1000, help="epochs")
+    parser.add_argument('--plot_every', type=int, default=1, help="write the preview montages every k epochs")
     parser.add_argument('--kernel', type=int, default=4, help="kernel size")
     parser.add_argument('--stride', type=int, default=2, help="stride")
     parser.add_argument('--class_dim', type=int, default=50, help="dimension of class vector")
@@ -26,6 +30,7 @@ def init():
     parser.add_argument('--reconstruct_coef_2', type=float, default=1.0, help="reconstruct coef 2")
     parser.add_argument('--generator_coef', type=float, default=1.0, help="generator coef")
     parser.add_argument('--discriminator_coef', type=float, default=1.0, help="discriminator coef")
+    parser.add_argument('--batch_forward', type=str, default='none', help="run the encoder/decoder calls one by one (none) or as one concatenated batch with per-call (grouped) or shared (pooled) batch norm statistics")
     return parser.parse_args()
 
 def main():
@@ -50,10 +55,13 @@ def main():
     reconstruct_coef_2 = parser.reconstruct_coef_2
     generator_coef = parser.generator_coef
     discriminator_coef = parser.discriminator_coef
+    batch_forward = None if parser.batch_forward == 'none' else parser.batch_forward
 
     # load data
-    imageName, imageDict = locate(data_path, styles=styles, max_label=categorical_cardinality)
-    _, imageTrue = locate(data_path, max_label=categorical_cardinality)
+    set_glyph_cache(parser.cache_size*1024*1024, parser.cache_path)
+    set_manifest(parser.manifest_path)
+    imageName, imageDict, imageIndex = locate(data_path, styles=styles, max_label=categorical_cardinality, index=True)
+    imageTrueName, imageTrue, imageTrueIndex = locate(data_path, max_label=categorical_cardinality, index=True)
     imageNum = len(imageName)
 
     image1 = tf.placeholder(tf.float32,[None, image_size, image_size, channel_size],name="image1")
@@ -63,7 +71,7 @@ def main():
     forward_loss, reconstruct_loss_1, reconstruct_loss_2, generator_loss, discriminator_loss, image1_forward_reconstruct, image2_forward_reconstruct,  _, _, image1_transfer_reconstruct, image2_transfer_reconstruct = ae_with_gan(
                                                                                                                                  image1,image2,kernel,stride,class_dim,style_dim,is_training,
                                                                                                                                  reconstruct_coef_1,reconstruct_coef_2,generator_coef,discriminator_coef,
-                                                                                                                                 'cycle-consistent-vae-with-gan')
+                                                                                                                                 'cycle-consistent-vae-with-gan',batch_forward)
 
     encoder_variables = scope_variables("cycle-consistent-vae-with-gan/encoder")
     decoder_variables = scope_variables('cycle-consistent-vae-with-gan/decoder')
@@ -95,7 +103,7 @@ def main():
             
             for idx in range(0, imageNum, batch_size):
                 image1_batch = loader(imageName[idxes_1[idx:idx + batch_size]],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
-                image2_batch = loader(find_truth(imageName[idxes_1[idx:idx + batch_size]],imageTrue),desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
+                image2_batch = loader(imageTrueName[truth_rows(imageIndex['labels'][idxes_1[idx:idx + batch_size]],imageTrueIndex)],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
 
                 feed_dict_training = {image1:image1_batch,image2:image2_batch,is_training:True}
 
@@ -115,20 +123,22 @@ def main():
 
             print('epoch: %d\nforward_loss: %f, self_reconstruct_loss: %f, truth_reconstruct_loss: %f\ngenerator_loss: %f, discriminator_loss: %f\n' % (epoch, get_mean(forward_losses), get_mean(reconstruct_losses_1), get_mean(reconstruct_losses_2), get_mean(generator_losses), get_mean(discriminator_losses)))
             
-            # test
-            # truth
-            image1_plot = loader(imageName[idxes_1[0:10]],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
-            image2_plot = loader(find_truth(imageName[idxes_1[0:10]],imageTrue),desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
-            feed_dict_not_training = {image1:image1_plot,image2:image2_plot,is_training:False}
-            image1_reconstruct, image2_reconstruct = sess.run([image1_forward_reconstruct,image2_forward_reconstruct],feed_dict=feed_dict_not_training)
-            plot(image1_plot, image2_plot, image1_reconstruct, image2_reconstruct, 'truth', epoch, reconstruct_coef_1, reconstruct_coef_2, lr)
-
-            # transfer
-            image2_plot = loader(imageName[idxes_1[10:20]],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
-            feed_dict_not_training = {image1:image1_plot,image2:image2_plot,is_training:False}
-            _image1_transfer_reconstruct,_image2_transfer_reconstruct = sess.run([image1_transfer_reconstruct, image2_transfer_reconstruct],feed_dict=feed_dict_not_training)
-            plot(image1_plot, image2_plot, _image1_transfer_reconstruct, _image2_transfer_reconstruct, 'transfer', epoch, reconstruct_coef_1, reconstruct_coef_2, lr)
-
+            if epoch % parser.plot_every == 0:
+                # test
+                # truth
+                image1_plot = loader(imageName[idxes_1[0:10]],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
+                image2_plot = loader(imageTrueName[truth_rows(imageIndex['labels'][idxes_1[0:10]],imageTrueIndex)],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
+                feed_dict_not_training = {image1:image1_plot,image2:image2_plot,is_training:False}
+                image1_reconstruct, image2_reconstruct = sess.run([image1_forward_reconstruct,image2_forward_reconstruct],feed_dict=feed_dict_not_training)
+                plot(image1_plot, image2_plot, image1_reconstruct, image2_reconstruct, 'truth', epoch, reconstruct_coef_1, reconstruct_coef_2, lr)
+
+                # transfer
+                image2_plot = loader(imageName[idxes_1[10:20]],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
+                feed_dict_not_training = {image1:image1_plot,image2:image2_plot,is_training:False}
+                _image1_transfer_reconstruct,_image2_transfer_reconstruct = sess.run([image1_transfer_reconstruct, image2_transfer_reconstruct],feed_dict=feed_dict_not_training)
+                plot(image1_plot, image2_plot, _image1_transfer_reconstruct, _image2_transfer_reconstruct, 'transfer', epoch, reconstruct_coef_1, reconstruct_coef_2, lr)
+
+        flush_plots()
         saver.save(sess,os.path.join(os.path.join('ckpt',str(reconstruct_coef_1)+'-'+str(reconstruct_coef_2)+'-'+str(lr)),'model'))
 
 
@@ -22,7 +22,8 @@ def conv_batch_norm(inputs,
                     name="batch_norm",
                     is_training=True,
                     trainable=True,
-                    epsilon=1e-5):
+                    epsilon=1e-5,
+                    groups=1):
     ema = tf.train.ExponentialMovingAverage(decay=0.9)
     shp = inputs.get_shape()[-1].value
 
@@ -30,13 +31,23 @@ def conv_batch_norm(inputs,
         gamma = tf.get_variable("gamma", [shp], initializer=tf.random_normal_initializer(1., 0.02), trainable=trainable)
         beta = tf.get_variable("beta", [shp], initializer=tf.constant_initializer(0.), trainable=trainable)
 
-        mean, variance = tf.nn.moments(inputs, [0, 1, 2])
+        if groups > 1:
+            # moments of every group on its own, as if each was a separate call, their average feeds the moving averages
+            grouped = tf.reshape(inputs, tf.concat([[groups, -1], tf.shape(inputs)[1:]], 0))
+            group_mean, group_variance = tf.nn.moments(grouped, [1, 2, 3], keep_dims=True)
+            mean, variance = tf.reduce_mean(group_mean, [0, 1, 2, 3]), tf.reduce_mean(group_variance, [0, 1, 2, 3])
+        else:
+            mean, variance = tf.nn.moments(inputs, [0, 1, 2])
         mean.set_shape((shp,))
         variance.set_shape((shp,))
         ema_apply_op = ema.apply([mean, variance])
 
         def update():
             with tf.control_dependencies([ema_apply_op]):
+                if groups > 1:
+                    normalized = tf.reshape(tf.nn.batch_normalization(grouped, group_mean, group_variance, beta, gamma, epsilon), tf.shape(inputs))
+                    normalized.set_shape(inputs.get_shape())
+                    return normalized
                 return tf.nn.batch_norm_with_global_normalization(
                     inputs, mean, variance, beta, gamma, epsilon,
                     scale_after_normalization=True
@@ -55,29 +66,31 @@ def conv_batch_norm(inputs,
         )
         return normalized_x
 
-def conv2d(inputs,num_outputs,kernel_size,stride,is_training,normalizer_fn,activation_fn,name):
+def conv2d(inputs,num_outputs,kernel_size,stride,is_training,normalizer_fn,activation_fn,name,groups=1):
     with tf.variable_scope(name,reuse=tf.AUTO_REUSE):
         out = layers.convolution2d(inputs,
                     num_outputs=num_outputs,
                     kernel_size=kernel_size,
                     stride=stride,
-                    normalizer_params={"is_training": is_training},
+                    normalizer_params={"is_training": is_training, "groups": groups},
                     normalizer_fn=normalizer_fn,
                     activation_fn=activation_fn)
         return out
 
-def conv2d_transpose(inputs,num_outputs,kernel_size,stride,is_training,normalizer_fn,activation_fn,name):
+def conv2d_transpose(inputs,num_outputs,kernel_size,stride,is_training,normalizer_fn,activation_fn,name,groups=1):
     with tf.variable_scope(name,reuse=tf.AUTO_REUSE):
         out = layers.convolution2d_transpose(inputs,
                     num_outputs=num_outputs,
                     kernel_size=kernel_size,
                     stride=stride,
-                    normalizer_params={"is_training": is_training},
+                    normalizer_params={"is_training": is_training, "groups": groups},
                     normalizer_fn=normalizer_fn,
                     activation_fn=activation_fn)
         return out
 
-def fc(inputs,num_outputs,is_training,normalizer_fn,activation_fn,name):
+def fc(inputs,num_outputs,is_training,normalizer_fn,activation_fn,name,groups=1):
+    if groups > 1:
+        return tf.concat([fc(part,num_outputs,is_training,normalizer_fn,activation_fn,name) for part in tf.split(inputs,groups,0)],0)
     with tf.variable_scope(name,reuse=tf.AUTO_REUSE):
         out = layers.fully_connected(inputs,
                 num_outputs=num_outputs,
@@ -86,32 +99,32 @@ def fc(inputs,num_outputs,is_training,normalizer_fn,activation_fn,name):
                 normalizer_params={"is_training": is_training, "updates_collections": None})
         return out
 
-def encoder(image,kernel,stride,class_dim,style_dim,is_training,name='encoder'):
+def encoder(image,kernel,stride,class_dim,style_dim,is_training,name='encoder',groups=1):
     with tf.variable_scope(name,reuse=tf.AUTO_REUSE) as scope:
         print(scope.name, name)
-        conv1 = conv2d(image,32,kernel,stride,is_training,conv_batch_norm,leaky_rectify,'conv1')
-        conv2 = conv2d(conv1,64,kernel,stride,is_training,conv_batch_norm,leaky_rectify,'conv2')
-        conv3 = conv2d(conv2,128,kernel,stride,is_training,conv_batch_norm,leaky_rectify,'conv3')
-        conv4 = conv2d(conv3,128,kernel,stride,is_training,conv_batch_norm,leaky_rectify,'conv4')
+        conv1 = conv2d(image,32,kernel,stride,is_training,conv_batch_norm,leaky_rectify,'conv1',groups)
+        conv2 = conv2d(conv1,64,kernel,stride,is_training,conv_batch_norm,leaky_rectify,'conv2',groups)
+        conv3 = conv2d(conv2,128,kernel,stride,is_training,conv_batch_norm,leaky_rectify,'conv3',groups)
+        conv4 = conv2d(conv3,128,kernel,stride,is_training,conv_batch_norm,leaky_rectify,'conv4',groups)
         sp = conv4.get_shape()
         flatten = tf.reshape(conv4, [-1,sp[1]*sp[2]*sp[3]])
-        fc1 = fc(flatten,1024,is_training,layers.batch_norm,leaky_rectify,'fc1')
+        fc1 = fc(flatten,1024,is_training,layers.batch_norm,leaky_rectify,'fc1',groups)
         #class_vector = fc(fc1,class_dim,is_training,layers.batch_norm,leaky_rectify,'class_vector')
         #style_vector = fc(fc1,style_dim,is_training,layers.batch_norm,leaky_rectify,'style_vector')
-        class_vector = fc(fc1,class_dim,is_training,layers.batch_norm,tf.nn.tanh,'class_vector')
-        style_vector = fc(fc1,style_dim,is_training,layers.batch_norm,tf.nn.tanh,'style_vector')
+        class_vector = fc(fc1,class_dim,is_training,layers.batch_norm,tf.nn.tanh,'class_vector',groups)
+        style_vector = fc(fc1,style_dim,is_training,layers.batch_norm,tf.nn.tanh,'style_vector',groups)
     return class_vector, style_vector, sp[1], sp[2], sp[3]
 
-def decoder(vector,w,h,c,kernel,stride,is_training,name='decoder'):
+def decoder(vector,w,h,c,kernel,stride,is_training,name='decoder',groups=1):
     with tf.variable_scope(name,reuse=tf.AUTO_REUSE) as scope:
         print(scope.name, name)
-        fc1 = fc(vector,1024,is_training,layers.batch_norm,leaky_rectify,'fc1')
-        fc2 = fc(fc1,w*h*c,is_training,layers.batch_norm,leaky_rectify,'fc2')
+        fc1 = fc(vector,1024,is_training,layers.batch_norm,leaky_rectify,'fc1',groups)
+        fc2 = fc(fc1,w*h*c,is_training,layers.batch_norm,leaky_rectify,'fc2',groups)
         expand = tf.reshape(fc2, [-1,w,h,c])
-        conv1 = conv2d_transpose(expand,128,kernel,stride,is_training,conv_batch_norm,leaky_rectify,'conv1')
-        conv2 = conv2d_transpose(conv1,64,kernel,stride,is_training,conv_batch_norm,leaky_rectify,'conv2')
-        conv3 = conv2d_transpose(conv2,32,kernel,stride,is_training,conv_batch_norm,leaky_rectify,'conv3')
-        conv4 = conv2d_transpose(conv3,1,kernel,stride,is_training,conv_batch_norm,tf.nn.sigmoid,'conv4')
+        conv1 = conv2d_transpose(expand,128,kernel,stride,is_training,conv_batch_norm,leaky_rectify,'conv1',groups)
+        conv2 = conv2d_transpose(conv1,64,kernel,stride,is_training,conv_batch_norm,leaky_rectify,'conv2',groups)
+        conv3 = conv2d_transpose(conv2,32,kernel,stride,is_training,conv_batch_norm,leaky_rectify,'conv3',groups)
+        conv4 = conv2d_transpose(conv3,1,kernel,stride,is_training,conv_batch_norm,tf.nn.sigmoid,'conv4',groups)
     return conv4
 
 def discriminator(image,kernel,stride,is_training,name='discriminator'):
@@ -128,31 +141,44 @@ def discriminator(image,kernel,stride,is_training,name='discriminator'):
         pred = fc(fc2,1,is_training,layers.batch_norm,tf.nn.sigmoid,'pred')
     return pred
 
-def ae_with_gan(image1,image2,image3,image4,image5,image6,kernel,stride,class_dim,style_dim,is_training,reconstruct_coef_1,reconstruct_coef_2,reconstruct_coef_3,generator_coef,discriminator_coef,name='ae-with-gan'):
+def encode_all(images,kernel,stride,class_dim,style_dim,is_training,batch_forward=None):
+    # None encodes every image on its own, otherwise their concatenation runs through the encoder once with
+    # batch norm statistics kept per image ('grouped') or shared by all of them ('pooled')
+    if batch_forward is None:
+        return [encoder(image,kernel,stride,class_dim,style_dim,is_training) for image in images]
+    groups = len(images) if batch_forward == 'grouped' else 1
+    class_vector, style_vector, w, h, c = encoder(tf.concat(images,0),kernel,stride,class_dim,style_dim,is_training,groups=groups)
+    return [(class_vector_i, style_vector_i, w, h, c) for class_vector_i, style_vector_i in zip(tf.split(class_vector,len(images),0),tf.split(style_vector,len(images),0))]
+
+def decode_all(vectors,w,h,c,kernel,stride,is_training,batch_forward=None):
+    if batch_forward is None:
+        return [decoder(vector,w,h,c,kernel,stride,is_training) for vector in vectors]
+    groups = len(vectors) if batch_forward == 'grouped' else 1
+    return tf.split(decoder(tf.concat(vectors,0),w,h,c,kernel,stride,is_training,groups=groups),len(vectors),0)
+
+def ae_with_gan(image1,image2,image3,image4,image5,image6,kernel,stride,class_dim,style_dim,is_training,reconstruct_coef_1,reconstruct_coef_2,reconstruct_coef_3,generator_coef,discriminator_coef,name='ae-with-gan',batch_forward=None):
     # image2 is the ground truth of image1
     # image4 is the ground truth of image3
     # image5 if the ground truth of content of image1 with style of image3
     # image6 if the ground truth of content of image3 with style of image1
     with tf.variable_scope(name,reuse=tf.AUTO_REUSE) as scope:
-        class_vector_1, style_vector_1, w, h, c = encoder(image1,kernel,stride,class_dim,style_dim,is_training)
-        class_vector_2, style_vector_2, _, _, _ = encoder(image2,kernel,stride,class_dim,style_dim,is_training)
-        class_vector_3, style_vector_3, _, _, _ = encoder(image3,kernel,stride,class_dim,style_dim,is_training)
-        class_vector_4, style_vector_4, _, _, _ = encoder(image4,kernel,stride,class_dim,style_dim,is_training)
+        (class_vector_1, style_vector_1, w, h, c), (class_vector_2, style_vector_2, _, _, _), (class_vector_3, style_vector_3, _, _, _), (class_vector_4, style_vector_4, _, _, _) = encode_all([image1,image2,image3,image4],kernel,stride,class_dim,style_dim,is_training,batch_forward)
         w,h,c = int(w), int(h), int(c)
+        image1_forward_reconstruct, image3_forward_reconstruct, image2_forward_reconstruct, image4_forward_reconstruct, image1_style_reconstruct, image3_style_reconstruct = decode_all([
+            tf.concat([class_vector_1,style_vector_1],1),
+            tf.concat([class_vector_3,style_vector_3],1),
+            tf.concat([class_vector_1,tf.zeros_like(style_vector_1)],1),
+            tf.concat([class_vector_3,tf.zeros_like(style_vector_3)],1),
+            tf.concat([class_vector_1,style_vector_3],1),
+            tf.concat([class_vector_3,style_vector_1],1)],w,h,c,kernel,stride,is_training,batch_forward)
 
         # forward
-        image1_forward_reconstruct = decoder(tf.concat([class_vector_1,style_vector_1],1),w,h,c,kernel,stride,is_training)
-        image3_forward_reconstruct = decoder(tf.concat([class_vector_3,style_vector_3],1),w,h,c,kernel,stride,is_training)
         reconstruct_loss_1 = tf.reduce_mean(tf.reduce_sum(tf.abs(image1-image1_forward_reconstruct),[1,2,3])) + tf.reduce_mean(tf.reduce_sum(tf.abs(image3-image3_forward_reconstruct),[1,2,3]))
         reconstruct_loss_1 = reconstruct_coef_1 * reconstruct_loss_1
 
-        image2_forward_reconstruct = decoder(tf.concat([class_vector_1,tf.zeros_like(style_vector_1)],1),w,h,c,kernel,stride,is_training)
-        image4_forward_reconstruct = decoder(tf.concat([class_vector_3,tf.zeros_like(style_vector_3)],1),w,h,c,kernel,stride,is_training)
         reconstruct_loss_2 = tf.reduce_mean(tf.reduce_sum(tf.abs(image2-image2_forward_reconstruct),[1,2,3])) + tf.reduce_mean(tf.reduce_sum(tf.abs(image4-image4_forward_reconstruct),[1,2,3]))
         reconstruct_loss_2 = reconstruct_coef_2 * reconstruct_loss_2
 
-        image1_style_reconstruct = decoder(tf.concat([class_vector_1,style_vector_3],1),w,h,c,kernel,stride,is_training)
-        image3_style_reconstruct = decoder(tf.concat([class_vector_3,style_vector_1],1),w,h,c,kernel,stride,is_training)
         reconstruct_loss_3 = tf.reduce_mean(tf.reduce_sum(tf.abs(image5-image1_style_reconstruct),[1,2,3])) + tf.reduce_mean(tf.reduce_sum(tf.abs(image6-image3_style_reconstruct),[1,2,3]))
         reconstruct_loss_3 = reconstruct_coef_3 * reconstruct_loss_3
 
@@ -195,13 +221,11 @@ def ae_with_gan(image1,image2,image3,image4,image5,image6,kernel,stride,class_di
 
     return forward_loss, reconstruct_loss_1, reconstruct_loss_2, reconstruct_loss_3, generator_loss, discriminator_loss, image1_forward_reconstruct, image2_forward_reconstruct, image3_forward_reconstruct, image4_forward_reconstruct, class_vector_1, style_vector_1, image1_style_reconstruct, image3_style_reconstruct
 
-def transfer(image1,image2,kernel,stride,class_dim,style_dim,is_training,name):
+def transfer(image1,image2,kernel,stride,class_dim,style_dim,is_training,name,batch_forward=None):
     with tf.variable_scope(name,reuse=tf.AUTO_REUSE):
-        class_vector_1, style_vector_1, w, h, c = encoder(image1,kernel,stride,class_dim,style_dim,is_training)
-        class_vector_2, style_vector_2, w, h, c = encoder(image2,kernel,stride,class_dim,style_dim,is_training)
+        (class_vector_1, style_vector_1, w, h, c), (class_vector_2, style_vector_2, w, h, c) = encode_all([image1,image2],kernel,stride,class_dim,style_dim,is_training,batch_forward)
         w,h,c = int(w), int(h), int(c)
 
-        image1_forward_reconstruct = decoder(tf.concat([class_vector_1,style_vector_2],1),w,h,c,kernel,stride,is_training)
-        image2_forward_reconstruct = decoder(tf.concat([class_vector_2,style_vector_1],1),w,h,c,kernel,stride,is_training)
+        image1_forward_reconstruct, image2_forward_reconstruct = decode_all([tf.concat([class_vector_1,style_vector_2],1),tf.concat([class_vector_2,style_vector_1],1)],w,h,c,kernel,stride,is_training,batch_forward)
 
         return image1_forward_reconstruct, image2_forward_reconstruct
\ No newline at end of file
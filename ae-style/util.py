@@ -1,13 +1,70 @@
 import numpy as np
 import os
+import json
+import time
+import hashlib
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 
-def locate(data_path, styles=None, max_label=100):
+manifest_state = {'path': None, 'dirs': None}
+
+def set_manifest(path):
+    # json file caching the directory listings of the dataset (None: walk the file system every time)
+    manifest_state.update(path=path, dirs=None)
+
+def walk_files(path):
+    # os.walk drop-in. with a manifest, a directory whose mtime did not change since it was recorded is not listed
+    # again, so startup costs one stat per directory and only new or modified directories are rescanned
+    if manifest_state['path'] is None:
+        yield from os.walk(path)
+        return
+    if manifest_state['dirs'] is None:
+        manifest_state['dirs'] = {}
+        if os.path.exists(manifest_state['path']):
+            with open(manifest_state['path']) as f:
+                dirs = json.load(f)
+            # manifests of an older layout are rebuilt
+            if all('links' in entry for entry in dirs.values()):
+                manifest_state['dirs'] = dirs
+    dirs = manifest_state['dirs']
+    changed, visited, pending = False, set(), [path]
+    while pending:
+        basepath = pending.pop()
+        visited.add(basepath)
+        mtime = os.stat(basepath).st_mtime_ns
+        entry = dirs.get(basepath)
+        if entry is None or entry['mtime'] != mtime:
+            # a directory modified within the last seconds may still change within the same mtime tick, rescan it next time
+            # like os.walk, links to directories are listed with the directories but never descended into
+            entry = {'mtime': mtime if time.time() - mtime / 1e9 > 2 else None, 'dirs': [], 'links': [], 'files': []}
+            for item in os.scandir(basepath):
+                if item.is_dir():
+                    entry['dirs'].append(item.name)
+                    if item.is_symlink(): entry['links'].append(item.name)
+                else:
+                    entry['files'].append(item.name)
+            dirs[basepath] = entry
+            changed = True
+        yield basepath, list(entry['dirs']), list(entry['files'])
+        pending.extend(os.path.join(basepath, d) for d in reversed(entry['dirs']) if d not in entry['links'])
+    for basepath in list(dirs):
+        if (basepath == path or basepath.startswith(os.path.join(path, ''))) and basepath not in visited:
+            del dirs[basepath]
+            changed = True
+    if changed:
+        with open(manifest_state['path'] + '.tmp', 'w') as f:
+            json.dump(dirs, f)
+        os.replace(manifest_state['path'] + '.tmp', manifest_state['path'])
+
+def locate(data_path, styles=None, max_label=100, index=False):
     imageName, imageDict = [], {}
+    labels, styleIds = [], []
     if styles is None: styles = ['std-comp']
     for i in range(len(styles)):
         path = os.path.join(data_path,styles[i])
-        for basepath, directories, fnames in os.walk(path):
+        for basepath, directories, fnames in walk_files(path):
             for fname in fnames:
                 flabel = int(fname.split('/')[-1].split('.')[0].split('-')[0])
                 suffix = fname.split('/')[-1].split('.')[-1]
@@ -16,8 +73,20 @@ def locate(data_path, styles=None, max_label=100):
                         imageName.append(os.path.join(basepath,fname))
                         if flabel not in imageDict: imageDict[flabel] = []
                         imageDict[flabel].append(os.path.join(basepath,fname))
+                        labels.append(flabel)
+                        styleIds.append(i)
+    if index:
+        return np.array(imageName), imageDict, make_index(labels, styleIds, max_label)
     return np.array(imageName), imageDict
 
+def make_index(labels, styleIds, max_label):
+    # integer view of a locate() result: label and style of every row, and the rows of label l in
+    # rows[offsets[l]:offsets[l+1]], kept in imageDict order
+    labels = np.array(labels, dtype=np.int32)
+    rows = np.argsort(labels, kind='stable').astype(np.int32)
+    offsets = np.searchsorted(labels[rows], np.arange(max_label+1)).astype(np.int32)
+    return {'labels': labels, 'styles': np.array(styleIds, dtype=np.int32), 'rows': rows, 'offsets': offsets}
+
 def choice(image1,imageDict):
     image2 = []
     for fname in image1:
@@ -32,48 +101,138 @@ def find_truth(image1,imageTrue):
         image2.append(imageTrue[flabel][0])
     return image2
 
+def truth_rows(labels,index):
+    # vectorized find_truth(): the first row of index with the same label for every entry of labels
+    start = index['offsets'][labels]
+    assert np.all(index['offsets'][labels+1] > start)
+    return index['rows'][start]
+
+glyph_cache = OrderedDict()
+glyph_cache_state = {'budget': 512*1024*1024, 'bytes': 0, 'path': None}
+
+def set_glyph_cache(budget, path=None):
+    # budget in bytes for decoded glyphs kept in memory, path is an optional on-disk cache directory
+    glyph_cache.clear()
+    glyph_cache_state.update(budget=budget, bytes=0, path=path)
+    if path is not None and not os.path.exists(path):
+        os.makedirs(path)
+
+def cached_glyph(decode, *key):
+    img = glyph_cache.get(key)
+    if img is not None:
+        glyph_cache.move_to_end(key)
+        return img
+    path = glyph_cache_state['path']
+    if path is not None:
+        digest = hashlib.md5('-'.join(str(k) for k in key+(os.path.getmtime(key[0]),)).encode()).hexdigest()
+        cache_name = os.path.join(path, digest+'.npy')
+        if os.path.exists(cache_name):
+            img = np.load(cache_name)
+        else:
+            img = decode(*key)
+            # written under a unique name and renamed into place, so that other threads or processes never load a partial file
+            with tempfile.NamedTemporaryFile(dir=path, suffix='.tmp', delete=False) as f:
+                np.save(f, img)
+            os.replace(f.name, cache_name)
+    else:
+        img = decode(*key)
+    img.flags.writeable = False
+    if img.nbytes <= glyph_cache_state['budget']:
+        glyph_cache[key] = img
+        glyph_cache_state['bytes'] += img.nbytes
+        while glyph_cache_state['bytes'] > glyph_cache_state['budget']:
+            _, evicted = glyph_cache.popitem(last=False)
+            glyph_cache_state['bytes'] -= evicted.nbytes
+    return img
+
+def new_batch(length,shape,dtype=np.float32):
+    return np.empty((length,)+tuple(shape), dtype=dtype)
+
+def scale_batch(batch,value_range):
+    batch /= 255.0
+    batch *= (value_range[1] - value_range[0])
+    batch += value_range[0]
+    return batch
+
+def decode_glyph(fname,desired_height,desired_width,force_grayscale):
+    image = Image.open(fname)
+    width, height = image.size
+    if width != desired_width or height != desired_height:
+        image = image.resize((desired_width, desired_height), Image.BILINEAR)
+    if force_grayscale: 
+        image = image.convert("L")
+    img = np.array(image)
+    if len(img.shape) == 2: 
+        img = img[:, :, None]
+    return img
+
 def loader(imageName,desired_height,desired_width,value_range,force_grayscale=True):
     image_batch = None
-    for fname in imageName:
-        image = Image.open(fname)
-        width, height = image.size
-        if width != desired_width or height != desired_height:
-            image = image.resize((desired_width, desired_height), Image.BILINEAR)
-        if force_grayscale: 
-            image = image.convert("L")
-        img = np.array(image)
-        if len(img.shape) == 2: 
-            img = img[:, :, None]
+    for i, fname in enumerate(imageName):
+        img = cached_glyph(decode_glyph,fname,desired_height,desired_width,force_grayscale)
         if image_batch is None: 
-            image_batch = np.array([img], dtype=np.float32)
-        else: 
-            image_batch = np.concatenate((image_batch,np.array([img], dtype=np.float32)),axis=0)
-    image_batch = (value_range[0] + (image_batch / 255.0) * (value_range[1] - value_range[0]))
-    return image_batch
+            image_batch = new_batch(len(imageName),img.shape)
+        image_batch[i] = img
+    return scale_batch(image_batch,value_range)
+
+plot_writer = {'executor': None, 'pending': []}
+
+def montage(columns):
+    # [num,h,w,1] float images in [0,1], laid side by side as a single uint8 [num*h,len(columns)*w] grid
+    grid = (np.stack([column[...,0] for column in columns],axis=1)*255).astype(np.uint8)
+    num, length, h, w = grid.shape
+    return grid.transpose(0,2,1,3).reshape(num*h,length*w)
+
+def save_montage(grid, path):
+    # png encoding and writing run on a background thread so the training loop does not wait on them
+    if plot_writer['executor'] is None:
+        plot_writer['executor'] = ThreadPoolExecutor(max_workers=1)
+    for future in [future for future in plot_writer['pending'] if future.done()]:
+        future.result()
+        plot_writer['pending'].remove(future)
+    plot_writer['pending'].append(plot_writer['executor'].submit(lambda: Image.fromarray(grid,'L').save(path)))
+
+def flush_plots():
+    for future in plot_writer['pending']:
+        future.result()
+    plot_writer['pending'] = []
 
 def plot(image1_plot, image2_plot, image1_reconstruct, image2_reconstruct, title, epoch, reconstruct_coef_1, reconstruct_coef_2, lr):
-    num, w, h, c = image1_plot.shape[0], image1_plot.shape[1], image1_plot.shape[2], image1_plot.shape[3]
-    img = Image.new('L',(w*4,h*num))
-    for i in range(num):
-        img.paste(Image.fromarray(np.squeeze((image1_plot[i]*255).astype(np.uint8))),(64*0,64*i))
-        img.paste(Image.fromarray(np.squeeze((image2_plot[i]*255).astype(np.uint8))),(64*1,64*i))
-        img.paste(Image.fromarray(np.squeeze((image1_reconstruct[i]*255).astype(np.uint8))),(64*2,64*i))
-        img.paste(Image.fromarray(np.squeeze((image2_reconstruct[i]*255).astype(np.uint8))),(64*3,64*i))
-    img.save(os.path.join('savedImages',title+'-'+str(epoch)+'-'+str(reconstruct_coef_1)+'-'+str(reconstruct_coef_2)+str(lr)+'-''.png'))
+    save_montage(montage([image1_plot, image2_plot, image1_reconstruct, image2_reconstruct]), os.path.join('savedImages',title+'-'+str(epoch)+'-'+str(reconstruct_coef_1)+'-'+str(reconstruct_coef_2)+str(lr)+'-''.png'))
 
 def plot_batch(images, title, epoch, coefs):
-    length = len(images)
-    num, w, h, c = images[0].shape[0], images[0].shape[1], images[0].shape[2], images[0].shape[3]
-    img = Image.new('L',(w*length,h*num))
-    for i in range(num):
-        for j in range(length):
-            img.paste(Image.fromarray(np.squeeze((images[j][i]*255).astype(np.uint8))),(64*j,64*i))
     imgName = title+'-'+str(epoch)
     for coef in coefs:
         imgName += '-'+str(coef)
-    img.save(os.path.join('savedImages',imgName+'.png'))
+    save_montage(montage(images), os.path.join('savedImages',imgName+'.png'))
+
+def vector_key(fname):
+    # '<style>/<file name without extension>', the same for a glyph and the .npy file save_vector writes for it
+    namesp = fname.split('/')
+    return namesp[-2]+'/'+namesp[-1].split('.')[0]
+
+def create_vector_store(path, imageName, dim):
+    # one float32 [len(imageName),dim] matrix path.npy with a row for every glyph of imageName, written in batches
+    # by save_vector, and path-index.json listing the vector_key of every row
+    keys = [vector_key(fname) for fname in imageName]
+    with open(path+'-index.json', 'w') as f:
+        json.dump(keys, f)
+    vectors = np.lib.format.open_memmap(path+'.npy', mode='w+', dtype=np.float32, shape=(len(keys), dim))
+    return {'path': path, 'index': {key: row for row, key in enumerate(keys)}, 'vectors': vectors}
+
+def open_vector_store(path):
+    with open(path+'-index.json') as f:
+        keys = json.load(f)
+    return {'path': path, 'index': {key: row for row, key in enumerate(keys)}, 'vectors': np.load(path+'.npy', mmap_mode='r')}
+
+def vector_rows(store, imageName):
+    return np.array([store['index'][vector_key(fname)] for fname in imageName], dtype=np.int64)
 
-def save_vector(imageName, vector):
+def save_vector(imageName, vector, store=None):
+    # without a store every vector goes to its own .npy file next to the glyph
+    if store is not None:
+        store['vectors'][vector_rows(store, imageName)] = vector
+        return
     path = '../../demo'
     for i in range(len(imageName)):
         namesp = imageName[i].split('/')
@@ -2,7 +2,7 @@ import tensorflow as tf
 import numpy as np
 import argparse
 import os
-from util import locate, choice, find_truth, loader, plot
+from util import locate, choice, truth_rows, loader, plot, flush_plots, set_glyph_cache, set_manifest
 from network import cycle_consistent_vae_with_gan, scope_variables, get_mean
 
 def init():
@@ -15,9 +15,13 @@ def init():
     parser.add_argument('--image_size', type=int, default=64, help="the size of images trained")
     parser.add_argument('--force_grayscale', type=bool, default=True, help="transform images into single channel or not")
     parser.add_argument('--seed', type=int, default=1, help="random seed")
+    parser.add_argument('--cache_size', type=int, default=512, help="memory budget of the decoded glyph cache in MB")
+    parser.add_argument('--cache_path', type=str, default=None, help="directory of the on-disk glyph cache (None: memory only)")
+    parser.add_argument('--manifest_path', type=str, default=None, help="json file caching the dataset directory listings (None: walk the dataset at every start)")
     parser.add_argument('--lr', type=float, default=1e-3, help="learning rate")
     parser.add_argument('--batch_size', type=int, default=64, help="batch size")
     parser.add_argument('--epochs', type=int, default=1000, help="epochs")
+    parser.add_argument('--plot_every', type=int, default=1, help="write the preview montages every k epochs")
     parser.add_argument('--kernel', type=int, default=4, help="kernel size")
     parser.add_argument('--stride', type=int, default=2, help="stride")
     parser.add_argument('--class_dim', type=int, default=75, help="dimension of class vector")
@@ -48,8 +52,10 @@ def main():
     discriminator_coef = parser.discriminator_coef
 
     # load data
-    imageName, imageDict = locate(data_path, styles=styles, max_label=categorical_cardinality)
-    _, imageTrue = locate(data_path, max_label=categorical_cardinality)
+    set_glyph_cache(parser.cache_size*1024*1024, parser.cache_path)
+    set_manifest(parser.manifest_path)
+    imageName, imageDict, imageIndex = locate(data_path, styles=styles, max_label=categorical_cardinality, index=True)
+    imageTrueName, imageTrue, imageTrueIndex = locate(data_path, max_label=categorical_cardinality, index=True)
     imageNum = len(imageName)
 
     image1 = tf.placeholder(tf.float32,[None, image_size, image_size, channel_size],name="image1")
@@ -86,7 +92,7 @@ def main():
             
             for idx in range(0, imageNum, batch_size):
                 image1_batch = loader(imageName[idxes_1[idx:idx + batch_size]],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
-                image2_batch = loader(find_truth(imageName[idxes_1[idx:idx + batch_size]],imageTrue),desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
+                image2_batch = loader(imageTrueName[truth_rows(imageIndex['labels'][idxes_1[idx:idx + batch_size]],imageTrueIndex)],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
 
                 feed_dict_training = {image1:image1_batch,image2:image2_batch,is_training:True}
 
@@ -104,11 +110,13 @@ def main():
 
             print('epoch: %d\nforward_loss: %f, generator_loss: %f, discriminator_loss: %f\n' % (epoch, get_mean(forward_losses), get_mean(generator_losses), get_mean(discriminator_losses)))
             
-            image1_plot = loader(imageName[idxes_1[0:10]],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
-            image2_plot = loader(find_truth(imageName[idxes_1[0:10]],imageTrue),desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
-            feed_dict_not_training = {image1:image1_plot,image2:image2_plot,is_training:False}
-            image1_reconstruct = sess.run(image1_forward_reconstruct,feed_dict=feed_dict_not_training)
-            plot(image1_plot, image1_reconstruct, image2_plot, epoch)
+            if epoch % parser.plot_every == 0:
+                image1_plot = loader(imageName[idxes_1[0:10]],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
+                image2_plot = loader(imageTrueName[truth_rows(imageIndex['labels'][idxes_1[0:10]],imageTrueIndex)],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
+                feed_dict_not_training = {image1:image1_plot,image2:image2_plot,is_training:False}
+                image1_reconstruct = sess.run(image1_forward_reconstruct,feed_dict=feed_dict_not_training)
+                plot(image1_plot, image1_reconstruct, image2_plot, epoch)
+        flush_plots()
         saver.save(sess,'ckpt/model')
 
 
@@ -2,25 +2,36 @@ import tensorflow as tf
 import tensorflow.contrib.layers as layers
 import numpy as np
 import argparse
-from loader import load_calligraphy
+from loader import load_calligraphy, scale_images
 import random
 import os
+import itertools
+import multiprocessing
+import shutil
+import tempfile
 
 def init():
     parser = argparse.ArgumentParser()
     parser.add_argument('--gpu', type=str, default='0', help="gpu to use")
-    parser.add_argument('--gpu_fraction', type=float, default=0.8, help="fraction of gpu memory to use")
+    parser.add_argument('--gpu_fraction', type=float, default=0.8, help="fraction of gpu memory to use, split evenly between the workers sharing a gpu")
     parser.add_argument('--categorical_cardinality', type=int, default=100, help="number of the characters to be loaded")
     parser.add_argument('--data_path', type=str, default='../../demo/', help="path to save images")
     parser.add_argument('--styles', type=str, default='cklxz', help="calligraphy style (sub folders)")
     parser.add_argument('--image_size', type=int, default=64, help="the size of images trained")
     parser.add_argument('--force_grayscale', type=bool, default=True, help="transform images into single channel or not")
     parser.add_argument('--seed', type=int, default=1, help="random seed")
+    parser.add_argument('--cache_path', type=str, default=None, help="prefix of the memory-mapped uint8 dataset cache (None: decode the images at every start)")
     parser.add_argument('--lr', nargs="*", type=float, default=[5e-2], help="learning rate")
     parser.add_argument('--batch_size', nargs="*", type=int, default=[64], help="batch size")
     parser.add_argument('--epochs', type=int, default=200, help="epochs")
+    parser.add_argument('--eval_batch_size', type=int, default=512, help="batch size of the evaluation on the test set")
+    parser.add_argument('--eval_every', type=int, default=1, help="evaluate on the test set every k epochs (the last epoch is always evaluated)")
     parser.add_argument('--kernel', nargs="*", type=int, default=[4], help="kernel size")
     parser.add_argument('--stride', nargs="*", type=int, default=[2], help="stride")
+    parser.add_argument('--workers', type=int, default=1, help="number of configurations trained concurrently, gpus in --gpu are handed out round-robin")
+    parser.add_argument('--log_path', type=str, default='log', help="log the results are appended to")
+    parser.add_argument('--resume', type=int, default=1, help="1: skip the configurations already in --log_path, 0: train every configuration")
+    parser.add_argument('--table_path', type=str, default=None, help="tab separated file the results table is written to (None: only print it)")
     return parser.parse_args()
 
 def variables_in_current_scope():
@@ -109,81 +120,173 @@ def network(image, kernel, stride, categorical_cardinality, is_training,name='cl
         out = fc(fc1,categorical_cardinality,is_training,layers.batch_norm,leaky_rectify,'layer_6','fc_2')
         return out
 
-def main():
-    parser = init()
-    os.environ["CUDA_VISIBLE_DEVICES"] = parser.gpu
+def eval_metrics(logits, label, name='eval'):
+    # streaming mean cross entropy and accuracy, accumulated over the eval batches until reset
+    with tf.variable_scope(name):
+        loss, loss_update = tf.metrics.mean(tf.nn.sparse_softmax_cross_entropy_with_logits(labels=label, logits=logits))
+        accuracy, accuracy_update = tf.metrics.accuracy(label, tf.argmax(logits, axis=1, output_type=tf.int32))
+        reset = tf.variables_initializer(tf.get_collection(tf.GraphKeys.LOCAL_VARIABLES, scope=tf.get_variable_scope().name))
+    return [loss, accuracy], [loss_update, accuracy_update], reset
+
+def evaluate(sess, metrics, image, label, is_training, X_test, Y_test, eval_batch_size):
+    values, updates, reset = metrics
+    sess.run(reset)
+    for idx in range(0,X_test.shape[0],eval_batch_size):
+        sess.run(updates,feed_dict={image:scale_images(X_test[idx:idx + eval_batch_size],(0,1)),label:Y_test[idx:idx + eval_batch_size],is_training:False})
+    return sess.run(values)
+
+worker_state = {}
+
+def init_worker(gpus, paths, labels):
+    # every worker owns one gpu (and its share of --gpu_fraction) and maps the shared dataset cache instead of
+    # decoding its own copy
+    os.environ["CUDA_VISIBLE_DEVICES"], worker_state['gpu_fraction'] = gpus.get()
+    worker_state['data'] = [np.load(paths[0], mmap_mode='r'), labels[0], np.load(paths[1], mmap_mode='r'), labels[1]]
+
+def sweep_worker(args):
+    parser, config = args
+    return config, train_config(parser, config, *worker_state['data'], gpu_fraction=worker_state['gpu_fraction'])
+
+def train_config(parser, config, X_train, Y_train, X_test, Y_test, gpu_fraction=None):
+    lr, kernel, stride, batch_size = config
     categorical_cardinality = parser.categorical_cardinality
-    data_path = parser.data_path
-    styles = parser.styles
     image_size = parser.image_size
-    force_grayscale = parser.force_grayscale
-    channel_size = 1 if force_grayscale else 3
-    seed = parser.seed
-    lrs = parser.lr
-    batch_sizes = parser.batch_size
+    channel_size = 1 if parser.force_grayscale else 3
     epochs = parser.epochs
-    kernels = parser.kernel
-    strides = parser.stride
-
-    X_train, Y_train, X_test, Y_test = load_calligraphy(data_path,categorical_cardinality,styles,image_size,image_size,(0,1),force_grayscale)
-    length_train, length_test = X_train.shape[0], X_test.shape[0]
-    print(length_train, length_test)
-
-    for lr in lrs:
-        for kernel in kernels:
-            for stride in strides:
-                for batch_size in batch_sizes:
-                    image = tf.placeholder(tf.float32,[None, image_size, image_size, channel_size],name="input_images")
-                    label = tf.placeholder(tf.float32,[None, categorical_cardinality],name="input_label")
-                    is_training = tf.placeholder(tf.bool,[],name="is_training")
-
-                    pred = network(image,kernel,stride,categorical_cardinality,is_training,name='clf')
-                    entropy_loss = tf.reduce_sum(tf.nn.softmax_cross_entropy_with_logits(labels=label, logits=pred))
-                    solver = tf.train.AdamOptimizer(learning_rate=lr,beta1=0.5)
-                    train = solver.minimize(entropy_loss, var_list=scope_variables('clf'))
-
-                    config = tf.ConfigProto() 
-                    config.gpu_options.per_process_gpu_memory_fraction = parser.gpu_fraction
-                    with tf.Session(config=config) as sess:
-                        sess.run(tf.global_variables_initializer())
-                        idxes_train = np.arange(length_train, dtype=np.int32)
-                        idxes_test = np.arange(length_test, dtype=np.int32)
-                        accuracies = []
-                        for epoch in range(epochs):
-                            np.random.shuffle(idxes_train)
-                            np.random.shuffle(idxes_test)
-                            losses = []
-                            corrects = 0
-                            for idx in range(0,length_train,batch_size):
-                                image_batch_train = X_train[idxes_train[idx:idx + batch_size]]
-                                label_batch_train = Y_train[idxes_train[idx:idx + batch_size]]
-                                _,loss_train = sess.run([train,entropy_loss],feed_dict={image:image_batch_train,label:label_batch_train,is_training:True})
-
-                            for idx in range(0,length_test,batch_size):
-                                image_batch_test = X_test[idxes_test[idx:idx + batch_size]]
-                                label_batch_test = Y_test[idxes_test[idx:idx + batch_size]]
-                                loss_test, pred_test = sess.run([entropy_loss, pred],feed_dict={image:image_batch_test,label:label_batch_test,is_training:False})
-                                losses.append(loss_test)
-                                pred_category = np.argmax(pred_test, axis=1)
-                                true_category = np.argmax(label_batch_test, axis=1)
-                                corrects += np.sum(pred_category == true_category)
-                                
-                            accuracies.append(corrects / length_test)
-                            print('epoch %d finished, loss on test set is %f, accuracy is %f' % (epoch, np.mean(losses), accuracies[-1]))
-
-                        accuracies = np.array(accuracies)
-                        with open('log','a') as f:
-                            f.write('===============================================\n')
-                            f.write('categorical cardinality: %d \n' % categorical_cardinality)
-                            f.write('lr: %f \n' % lr)
-                            f.write('batch size: %d \n' % batch_size)
-                            f.write('epochs: %d \n' % epochs)
-                            f.write('kernel size : %d \n' % kernel)
-                            f.write('stride: %d \n' % stride)
-                            f.write('mean accuracy for the last 10 epochs: %f \n' % np.mean(accuracies[-10:]))
-                            f.write('\n')
-
-                    tf.reset_default_graph()
+    length_train = X_train.shape[0]
+
+    with tf.Graph().as_default():
+        image = tf.placeholder(tf.float32,[None, image_size, image_size, channel_size],name="input_images")
+        label = tf.placeholder(tf.int32,[None],name="input_label")
+        is_training = tf.placeholder(tf.bool,[],name="is_training")
+
+        pred = network(image,kernel,stride,categorical_cardinality,is_training,name='clf')
+        entropy_loss = tf.reduce_sum(tf.nn.sparse_softmax_cross_entropy_with_logits(labels=label, logits=pred))
+        metrics = eval_metrics(pred, label)
+        solver = tf.train.AdamOptimizer(learning_rate=lr,beta1=0.5)
+        train = solver.minimize(entropy_loss, var_list=scope_variables('clf'))
+
+        session_config = tf.ConfigProto()
+        session_config.gpu_options.per_process_gpu_memory_fraction = parser.gpu_fraction if gpu_fraction is None else gpu_fraction
+        with tf.Session(config=session_config) as sess:
+            sess.run(tf.global_variables_initializer())
+            idxes_train = np.arange(length_train, dtype=np.int32)
+            accuracies = []
+            for epoch in range(epochs):
+                np.random.shuffle(idxes_train)
+                for idx in range(0,length_train,batch_size):
+                    image_batch_train = scale_images(X_train[idxes_train[idx:idx + batch_size]],(0,1))
+                    label_batch_train = Y_train[idxes_train[idx:idx + batch_size]]
+                    _,loss_train = sess.run([train,entropy_loss],feed_dict={image:image_batch_train,label:label_batch_train,is_training:True})
+
+                if (epoch + 1) % parser.eval_every and epoch != epochs - 1: continue
+                loss_test, accuracy_test = evaluate(sess,metrics,image,label,is_training,X_test,Y_test,parser.eval_batch_size)
+                accuracies.append(accuracy_test)
+                print('lr %f kernel %d stride %d batch size %d: epoch %d finished, loss on test set is %f, accuracy is %f' % (lr, kernel, stride, batch_size, epoch, loss_test, accuracies[-1]))
+
+    return np.mean(accuracies[-10:])
+
+def write_log(path, parser, config, accuracy):
+    lr, kernel, stride, batch_size = config
+    with open(path,'a') as f:
+        f.write('===============================================\n')
+        f.write('categorical cardinality: %d \n' % parser.categorical_cardinality)
+        f.write('styles: %s \n' % parser.styles)
+        f.write('data path: %s \n' % parser.data_path)
+        f.write('image size: %d \n' % parser.image_size)
+        f.write('lr: %f \n' % lr)
+        f.write('batch size: %d \n' % batch_size)
+        f.write('epochs: %d \n' % parser.epochs)
+        f.write('eval every: %d \n' % parser.eval_every)
+        f.write('kernel size : %d \n' % kernel)
+        f.write('stride: %d \n' % stride)
+        f.write('mean accuracy for the last 10 epochs: %f \n' % accuracy)
+        f.write('\n')
+
+def read_log(path, parser):
+    # {(lr, kernel, stride, batch_size): accuracy} of the runs in the log trained on the same data (cardinality, styles,
+    # data path, image size) for as long and evaluated as often as this sweep
+    finished = {}
+    if not os.path.exists(path): return finished
+    with open(path) as f:
+        blocks = f.read().split('===============================================\n')
+    for block in blocks:
+        entry = {}
+        for line in block.split('\n'):
+            if ':' not in line: continue
+            key, value = line.split(':', 1)
+            entry[key.strip()] = value.strip()
+        try:
+            settings = (int(entry['categorical cardinality']), entry['styles'], entry['data path'], int(entry['image size']), int(entry['epochs']), int(entry['eval every']))
+            if settings != (parser.categorical_cardinality, parser.styles, parser.data_path, parser.image_size, parser.epochs, parser.eval_every): continue
+            config = ('%f' % float(entry['lr']), int(entry['kernel size']), int(entry['stride']), int(entry['batch size']))
+            finished[config] = float(entry['mean accuracy for the last 10 epochs'])
+        except (KeyError, ValueError):
+            continue
+    return finished
+
+def print_table(results, path=None):
+    header = ['lr', 'kernel', 'stride', 'batch_size', 'accuracy']
+    rows = [['%f' % lr, '%d' % kernel, '%d' % stride, '%d' % batch_size, '%f' % accuracy]
+            for (lr, kernel, stride, batch_size), accuracy in sorted(results, key=lambda r: -r[1])]
+    widths = [max([len(h)] + [len(r[i]) for r in rows]) for i, h in enumerate(header)]
+    for row in [header] + rows:
+        print('  '.join(c.rjust(w) for c, w in zip(row, widths)))
+    if path is not None:
+        with open(path, 'w') as f:
+            for row in [header] + rows:
+                f.write('\t'.join(row) + '\n')
+
+def main():
+    parser = init()
+    gpus = parser.gpu.split(',')
+    configs = list(itertools.product(parser.lr, parser.kernel, parser.stride, parser.batch_size))
+
+    results = []
+    finished = read_log(parser.log_path, parser) if parser.resume else {}
+    pending = []
+    for config in configs:
+        key = ('%f' % config[0],) + config[1:]
+        if key in finished:
+            print('lr %f kernel %d stride %d batch size %d already in %s, skipped' % (config + (parser.log_path,)))
+            results.append((config, finished[key]))
+        else:
+            pending.append(config)
+
+    if pending:
+        # with several workers the dataset goes through the memory-mapped cache, a temporary one if none is given
+        cache_dir = None
+        cache_path = parser.cache_path
+        if parser.workers > 1 and cache_path is None:
+            cache_dir = tempfile.mkdtemp()
+            cache_path = os.path.join(cache_dir, 'dataset')
+        X_train, Y_train, X_test, Y_test = load_calligraphy(parser.data_path,parser.categorical_cardinality,parser.styles,parser.image_size,parser.image_size,parser.force_grayscale,cache_path)
+        print(X_train.shape[0], X_test.shape[0])
+
+        pool = None
+        try:
+            if parser.workers > 1:
+                ctx = multiprocessing.get_context('spawn')
+                queue = ctx.Queue()
+                worker_gpus = [gpus[i % len(gpus)] for i in range(parser.workers)]
+                for gpu in worker_gpus: queue.put((gpu, parser.gpu_fraction / worker_gpus.count(gpu)))
+                paths = [cache_path + '-train.npy', cache_path + '-test.npy']
+                pool = ctx.Pool(parser.workers, init_worker, (queue, paths, [Y_train, Y_test]))
+                outputs = pool.imap_unordered(sweep_worker, [(parser, config) for config in pending])
+            else:
+                os.environ["CUDA_VISIBLE_DEVICES"] = parser.gpu
+                outputs = ((config, train_config(parser, config, X_train, Y_train, X_test, Y_test)) for config in pending)
+            for config, accuracy in outputs:
+                write_log(parser.log_path, parser, config, accuracy)
+                results.append((config, accuracy))
+        finally:
+            # the workers map the cache files, they are stopped before a temporary cache is removed
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            if cache_dir is not None: shutil.rmtree(cache_dir)
+
+    print_table(results, parser.table_path)
 
 
 if __name__ == '__main__':
@@ -2,7 +2,7 @@ import tensorflow as tf
 import tensorflow.contrib.layers as layers
 import numpy as np
 import argparse
-from loader import load_calligraphy
+from loader import load_calligraphy, scale_images, set_manifest
 import random
 import os
 
@@ -16,9 +16,13 @@ def init():
     parser.add_argument('--image_size', type=int, default=64, help="the size of images trained")
     parser.add_argument('--force_grayscale', type=bool, default=True, help="transform images into single channel or not")
     parser.add_argument('--seed', type=int, default=1, help="random seed")
+    parser.add_argument('--cache_path', type=str, default=None, help="prefix of the memory-mapped uint8 dataset cache (None: decode the images at every start)")
+    parser.add_argument('--manifest_path', type=str, default=None, help="json file caching the dataset directory listings (None: walk the dataset at every start)")
     parser.add_argument('--lr', type=float, default=5e-2, help="learning rate")
     parser.add_argument('--batch_size', type=int, default=64, help="batch size")
     parser.add_argument('--epochs', type=int, default=200, help="epochs")
+    parser.add_argument('--eval_batch_size', type=int, default=512, help="batch size of the evaluation on the test set")
+    parser.add_argument('--eval_every', type=int, default=1, help="evaluate on the test set every k epochs (the last epoch is always evaluated)")
     parser.add_argument('--kernel', type=int, default=4, help="kernel size")
     parser.add_argument('--stride', type=int, default=2, help="stride")
     return parser.parse_args()
@@ -109,6 +113,21 @@ def network(image, kernel, stride, categorical_cardinality, is_training,name='cl
         out = fc(fc1,categorical_cardinality,is_training,layers.batch_norm,leaky_rectify,'layer_6','fc_2')
         return out
 
+def eval_metrics(logits, label, name='eval'):
+    # streaming mean cross entropy and accuracy, accumulated over the eval batches until reset
+    with tf.variable_scope(name):
+        loss, loss_update = tf.metrics.mean(tf.nn.sparse_softmax_cross_entropy_with_logits(labels=label, logits=logits))
+        accuracy, accuracy_update = tf.metrics.accuracy(label, tf.argmax(logits, axis=1, output_type=tf.int32))
+        reset = tf.variables_initializer(tf.get_collection(tf.GraphKeys.LOCAL_VARIABLES, scope=tf.get_variable_scope().name))
+    return [loss, accuracy], [loss_update, accuracy_update], reset
+
+def evaluate(sess, metrics, image, label, is_training, X_test, Y_test, eval_batch_size):
+    values, updates, reset = metrics
+    sess.run(reset)
+    for idx in range(0,X_test.shape[0],eval_batch_size):
+        sess.run(updates,feed_dict={image:scale_images(X_test[idx:idx + eval_batch_size],(0,1)),label:Y_test[idx:idx + eval_batch_size],is_training:False})
+    return sess.run(values)
+
 def main():
     parser = init()
     os.environ["CUDA_VISIBLE_DEVICES"] = parser.gpu
@@ -125,17 +144,19 @@ def main():
     kernel = parser.kernel
     stride = parser.stride
 
-    X_train, Y_train, X_test, Y_test = load_calligraphy(data_path,categorical_cardinality,styles,image_size,image_size,(0,1),force_grayscale)
+    set_manifest(parser.manifest_path)
+    X_train, Y_train, X_test, Y_test = load_calligraphy(data_path,categorical_cardinality,styles,image_size,image_size,force_grayscale,parser.cache_path)
     length_train, length_test = X_train.shape[0], X_test.shape[0]
     print(length_train, length_test)
 
     image = tf.placeholder(tf.float32,[None, image_size, image_size, channel_size],name="input_images")
-    label = tf.placeholder(tf.float32,[None, categorical_cardinality],name="input_label")
+    label = tf.placeholder(tf.int32,[None],name="input_label")
     is_training = tf.placeholder(tf.bool,[],name="is_training")
 
 
     pred = network(image,kernel,stride,categorical_cardinality,is_training)
-    entropy_loss = tf.reduce_sum(tf.nn.softmax_cross_entropy_with_logits(labels=label, logits=pred))
+    entropy_loss = tf.reduce_sum(tf.nn.sparse_softmax_cross_entropy_with_logits(labels=label, logits=pred))
+    metrics = eval_metrics(pred, label)
     solver = tf.train.AdamOptimizer(learning_rate=lr,beta1=0.5)
     train = solver.minimize(entropy_loss, var_list=scope_variables('clf'))
 
@@ -144,29 +165,18 @@ def main():
     with tf.Session(config=config) as sess:
         sess.run(tf.global_variables_initializer())
         idxes_train = np.arange(length_train, dtype=np.int32)
-        idxes_test = np.arange(length_test, dtype=np.int32)
         accuracies = []
         for epoch in range(epochs):
             np.random.shuffle(idxes_train)
-            np.random.shuffle(idxes_test)
-            losses = []
-            corrects = 0
             for idx in range(0,length_train,batch_size):
-                image_batch_train = X_train[idxes_train[idx:idx + batch_size]]
+                image_batch_train = scale_images(X_train[idxes_train[idx:idx + batch_size]],(0,1))
                 label_batch_train = Y_train[idxes_train[idx:idx + batch_size]]
                 _,loss_train = sess.run([train,entropy_loss],feed_dict={image:image_batch_train,label:label_batch_train,is_training:True})
 
-            for idx in range(0,length_test,batch_size):
-                image_batch_test = X_test[idxes_test[idx:idx + batch_size]]
-                label_batch_test = Y_test[idxes_test[idx:idx + batch_size]]
-                loss_test, pred_test = sess.run([entropy_loss, pred],feed_dict={image:image_batch_test,label:label_batch_test,is_training:False})
-                losses.append(loss_test)
-                pred_category = np.argmax(pred_test, axis=1)
-                true_category = np.argmax(label_batch_test, axis=1)
-                corrects += np.sum(pred_category == true_category)
-                
-            accuracies.append(corrects / length_test)
-            print('epoch %d finished, loss on test set is %f, accuracy is %f' % (epoch, np.mean(losses), accuracies[-1]))
+            if (epoch + 1) % parser.eval_every and epoch != epochs - 1: continue
+            loss_test, accuracy_test = evaluate(sess,metrics,image,label,is_training,X_test,Y_test,parser.eval_batch_size)
+            accuracies.append(accuracy_test)
+            print('epoch %d finished, loss on test set is %f, accuracy is %f' % (epoch, loss_test, accuracies[-1]))
 
         accuracies = np.array(accuracies)
         with open('log','a') as f:
@@ -1,6 +1,9 @@
 import random
 from os.path import exists, join
-from os import listdir, walk
+from os import listdir
+import os
+import json
+import time
 from PIL import Image
 import numpy as np
 import progressbar
@@ -61,65 +64,142 @@ def create_progress_bar(message):
     return pbar
 
 
+manifest_state = {'path': None, 'dirs': None}
+
+def set_manifest(path):
+    # json file caching the directory listings of the dataset (None: walk the file system every time)
+    manifest_state.update(path=path, dirs=None)
+
+def walk_files(path):
+    # os.walk drop-in. with a manifest, a directory whose mtime did not change since it was recorded is not listed
+    # again, so startup costs one stat per directory and only new or modified directories are rescanned
+    if manifest_state['path'] is None:
+        yield from os.walk(path)
+        return
+    if manifest_state['dirs'] is None:
+        manifest_state['dirs'] = {}
+        if os.path.exists(manifest_state['path']):
+            with open(manifest_state['path']) as f:
+                dirs = json.load(f)
+            # manifests of an older layout are rebuilt
+            if all('links' in entry for entry in dirs.values()):
+                manifest_state['dirs'] = dirs
+    dirs = manifest_state['dirs']
+    changed, visited, pending = False, set(), [path]
+    while pending:
+        basepath = pending.pop()
+        visited.add(basepath)
+        mtime = os.stat(basepath).st_mtime_ns
+        entry = dirs.get(basepath)
+        if entry is None or entry['mtime'] != mtime:
+            # a directory modified within the last seconds may still change within the same mtime tick, rescan it next time
+            # like os.walk, links to directories are listed with the directories but never descended into
+            entry = {'mtime': mtime if time.time() - mtime / 1e9 > 2 else None, 'dirs': [], 'links': [], 'files': []}
+            for item in os.scandir(basepath):
+                if item.is_dir():
+                    entry['dirs'].append(item.name)
+                    if item.is_symlink(): entry['links'].append(item.name)
+                else:
+                    entry['files'].append(item.name)
+            dirs[basepath] = entry
+            changed = True
+        yield basepath, list(entry['dirs']), list(entry['files'])
+        pending.extend(os.path.join(basepath, d) for d in reversed(entry['dirs']) if d not in entry['links'])
+    for basepath in list(dirs):
+        if (basepath == path or basepath.startswith(os.path.join(path, ''))) and basepath not in visited:
+            del dirs[basepath]
+            changed = True
+    if changed:
+        with open(manifest_state['path'] + '.tmp', 'w') as f:
+            json.dump(dirs, f)
+        os.replace(manifest_state['path'] + '.tmp', manifest_state['path'])
+
 def find_files_with_extension(path, extensions):
-    for basepath, directories, fnames in walk(path):
+    for basepath, directories, fnames in walk_files(path):
         for fname in fnames:
             name = fname.lower()
             if any(name.endswith(ext) for ext in extensions):
                 yield join(basepath, fname)
 
 def make_one_hot(indices, size):
-    as_one_hot = np.zeros((indices.shape[0], size))
+    as_one_hot = np.zeros((indices.shape[0], size), dtype=np.float32)
     as_one_hot[np.arange(0, indices.shape[0]), indices] = 1.0
     return as_one_hot
 
+def decode_calligraphy(fname, desired_height, desired_width, force_grayscale):
+    image = Image.open(fname)
+    width, height = image.size
+    if width != desired_width or height != desired_height:
+        image = image.resize((desired_width, desired_height), Image.BILINEAR)
+    if force_grayscale: image = image.convert("L")
+    img = np.array(image)
+    if len(img.shape) == 2: img = img[:, :, None]
+    return img
+
+def scale_images(batch, value_range=None):
+    # uint8 glyphs to float32, mapped onto value_range when given
+    batch = batch.astype(np.float32)
+    if value_range is not None:
+        batch *= (value_range[1] - value_range[0]) / 255.0
+        batch += value_range[0]
+    return batch
+
 def load_calligraphy(path, max_label, styles,
                      desired_height=None,
                      desired_width=None,
-                     value_range=None,
-                     force_grayscale=False):
+                     force_grayscale=False,
+                     cache_path=None):
+    # returns uint8 images and int32 labels, every 10th glyph goes to the test split. the file list is collected
+    # first so that both splits are filled in place; with cache_path they are written to (and next time read
+    # from) memory-mapped .npy files instead of being decoded again
     root_path = path
-    X_train, Y_train, X_test, Y_test = None, None, None, None
-    idx = 0
+    fnames, labels = [], []
     for i in range(len(styles)):
         path = join(root_path,styles[i])
-        image_paths = list(find_files_with_extension(path, [".png", ".jpg", ".jpeg"]))
-        pb = create_progress_bar("Loading dataset ")
-        for fname in pb(image_paths):
+        for fname in find_files_with_extension(path, [".png", ".jpg", ".jpeg"]):
             label = int(fname.split('/')[-1].split('-')[0])
-            #print(label, max_label)
             if label >= max_label: continue
-            image = Image.open(fname)
-            width, height = image.size
-            if desired_height is not None and desired_width is not None:
-                if width != desired_width or height != desired_height:
-                    image = image.resize((desired_width, desired_height), Image.BILINEAR)
-            else:
-                desired_height = height
-                desired_width = width
-
-            if force_grayscale: image = image.convert("L")
-            img = np.array(image)
-            if len(img.shape) == 2: img = img[:, :, None]
-
-            if not idx % 10:
-                if X_test is None: X_test = np.array([img], dtype=np.float32)
-                else: X_test = np.concatenate((X_test,np.array([img], dtype=np.float32)),axis=0)
-
-                if Y_test is None: Y_test = np.array([label], dtype=np.int32)
-                else: Y_test = np.concatenate((Y_test,np.array([label], dtype=np.int32)),axis=0)
-
-            else:
-                if X_train is None: X_train = np.array([img], dtype=np.float32)
-                else: X_train = np.concatenate((X_train,np.array([img], dtype=np.float32)),axis=0)
-
-                if Y_train is None: Y_train = np.array([label], dtype=np.int32)
-                else: Y_train = np.concatenate((Y_train,np.array([label], dtype=np.int32)),axis=0)
-            idx += 1
-
-    if value_range is not None:
-        X_train = (value_range[0] + (X_train / 255.0) * (value_range[1] - value_range[0]))
-        X_test = (value_range[0] + (X_test / 255.0) * (value_range[1] - value_range[0]))
+            fnames.append(fname)
+            labels.append(label)
+    labels = np.array(labels, dtype=np.int32)
+    is_test = np.arange(len(fnames)) % 10 == 0
+
+    if cache_path is not None:
+        # the mtimes make a rewritten glyph invalidate the cache
+        key = {'files': fnames, 'mtimes': [os.stat(fname).st_mtime_ns for fname in fnames],
+               'height': desired_height, 'width': desired_width, 'force_grayscale': force_grayscale}
+        if exists(cache_path + '-key.json'):
+            with open(cache_path + '-key.json') as f:
+                if json.load(f) == key:
+                    print("dataset loaded from %s." % cache_path)
+                    sys.stdout.flush()
+                    return np.load(cache_path + '-train.npy', mmap_mode='r'), labels[~is_test], np.load(cache_path + '-test.npy', mmap_mode='r'), labels[is_test]
+            # the arrays are about to be rewritten, an interrupted load must not leave them behind a valid key
+            os.remove(cache_path + '-key.json')
+
+    if desired_height is None or desired_width is None:
+        desired_width, desired_height = Image.open(fnames[0]).size
+    first = decode_calligraphy(fnames[0], desired_height, desired_width, force_grayscale)
+    shapes = [(int(np.sum(~is_test)),)+first.shape, (int(np.sum(is_test)),)+first.shape]
+    if cache_path is not None:
+        X_train, X_test = [np.lib.format.open_memmap(cache_path + suffix, mode='w+', dtype=np.uint8, shape=shape) for suffix, shape in zip(['-train.npy', '-test.npy'], shapes)]
+    else:
+        X_train, X_test = [np.empty(shape, dtype=np.uint8) for shape in shapes]
+
+    rows = np.cumsum(~is_test) - 1, np.cumsum(is_test) - 1
+    pb = create_progress_bar("Loading dataset ")
+    for idx in pb(range(len(fnames))):
+        img = first if idx == 0 else decode_calligraphy(fnames[idx], desired_height, desired_width, force_grayscale)
+        if is_test[idx]:
+            X_test[rows[1][idx]] = img
+        else:
+            X_train[rows[0][idx]] = img
+
+    if cache_path is not None:
+        X_train.flush()
+        X_test.flush()
+        with open(cache_path + '-key.json', 'w') as f:
+            json.dump(key, f)
     print("dataset loaded.")
     sys.stdout.flush()
-    return X_train, make_one_hot(Y_train,max_label), X_test, make_one_hot(Y_test,max_label)
\ No newline at end of file
+    return X_train, labels[~is_test], X_test, labels[is_test]
@@ -127,6 +127,19 @@ def mutual_fc(hidden, contiuous_dim, is_training, name):
         fc2 = fc(fc1,contiuous_dim,is_training,None,tf.identity,'fc2')
         return fc2
 
+def latent_sampler(class_dim,style_dim,continuous_dim,name):
+    # zc_vector drawn in the graph: the class vectors live in a local variable loaded once with its initializer
+    # (feed class_vector_init), only the rows of the batch are fed and the style/continuous noise is sampled on the device
+    with tf.variable_scope(name):
+        class_vector_init = tf.placeholder(tf.float32,[None, class_dim],name="class_vector_init")
+        class_vectors = tf.Variable(class_vector_init,trainable=False,collections=[tf.GraphKeys.LOCAL_VARIABLES],validate_shape=False,name="class_vectors")
+        rows = tf.placeholder(tf.int32,[None],name="rows")
+        batch_size = tf.shape(rows)[0]
+        class_vector = tf.reshape(tf.gather(class_vectors,rows),[-1, class_dim])
+        style_vector = tf.random_normal([batch_size, style_dim])
+        continuous_vector = tf.random_uniform([batch_size, continuous_dim],-1.0,1.0)
+        return tf.concat([class_vector,style_vector,continuous_vector],axis=1), rows, class_vectors, class_vector_init
+
 def infogan(zc_vector,image,kernel,stride,class_dim,style_dim,contiuous_dim,is_training,reconstruct_coef,continuous_coef,generator_coef,discriminator_coef,name):
     with tf.variable_scope(name,reuse=tf.AUTO_REUSE):
         image_reconstruct = decoder(zc_vector,4,4,128,kernel,stride,is_training,'decoder')
@@ -2,7 +2,7 @@ import tensorflow as tf
 import numpy as np
 import argparse
 import os
-from util import locate, choice, find_truth, loader, plot
+from util import locate, choice, truth_rows, loader, plot
 from network import cycle_consistent_vae_with_gan
 
 def init():
@@ -46,8 +46,8 @@ def main():
     generator_coef = parser.generator_coef
     discriminator_coef = parser.discriminator_coef
 
-    imageName, imageDict = locate(data_path, styles=styles, max_label=categorical_cardinality)
-    _, imageTrue = locate(data_path, max_label=categorical_cardinality)
+    imageName, imageDict, imageIndex = locate(data_path, styles=styles, max_label=categorical_cardinality, index=True)
+    imageTrueName, imageTrue, imageTrueIndex = locate(data_path, max_label=categorical_cardinality, index=True)
     imageNum = len(imageName)
 
     image1 = tf.placeholder(tf.float32,[None, image_size, image_size, channel_size],name="image1")
@@ -67,7 +67,7 @@ def main():
     with tf.Session(config=config) as sess:
         saver.restore(sess, tf.train.latest_checkpoint('ckpt/'))
         image1_test = loader(imageName[idxes_1[0:10]],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
-        image2_test = loader(find_truth(imageName[idxes_1[0:10]],imageTrue),desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
+        image2_test = loader(imageTrueName[truth_rows(imageIndex['labels'][idxes_1[0:10]],imageTrueIndex)],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
         feed_dict_not_training = {image1:image1_test,image2:image2_test,is_training:False}
         image_reconstruct, latent_vector = sess.run([image1_forward_reconstruct, vector],feed_dict=feed_dict_not_training)
         print(latent_vector.shape)
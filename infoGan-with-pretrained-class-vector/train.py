@@ -2,8 +2,8 @@ import tensorflow as tf
 import numpy as np
 import argparse
 import os
-from util import locate, choice, find_truth, loader, plot, noise, get_vector
-from network import infogan, scope_variables, get_mean
+from util import locate, choice, find_truth, loader, plot, flush_plots, noise, load_class_vectors, sample_latent, open_vector_store, set_glyph_cache, set_manifest
+from network import infogan, latent_sampler, scope_variables, get_mean
 
 def init():
     parser = argparse.ArgumentParser()
@@ -15,9 +15,15 @@ def init():
     parser.add_argument('--image_size', type=int, default=64, help="the size of images trained")
     parser.add_argument('--force_grayscale', type=bool, default=True, help="transform images into single channel or not")
     parser.add_argument('--seed', type=int, default=1, help="random seed")
+    parser.add_argument('--cache_size', type=int, default=512, help="memory budget of the decoded glyph cache in MB")
+    parser.add_argument('--cache_path', type=str, default=None, help="directory of the on-disk glyph cache (None: memory only)")
+    parser.add_argument('--manifest_path', type=str, default=None, help="json file caching the dataset directory listings (None: walk the dataset at every start)")
+    parser.add_argument('--vector_path', type=str, default=None, help="vector store written by infoae/test.py --vector_path (None: one .npy file per glyph next to it)")
+    parser.add_argument('--graph_noise', type=int, default=0, help="draw the style and continuous noise in the graph and feed only the rows of the class vectors (0: feed the whole zc_vector)")
     parser.add_argument('--lr', type=float, default=5e-4, help="learning rate")
     parser.add_argument('--batch_size', type=int, default=64, help="batch size")
     parser.add_argument('--epochs', type=int, default=1000, help="epochs")
+    parser.add_argument('--plot_every', type=int, default=1, help="write the preview montages every k epochs")
     parser.add_argument('--kernel', type=int, default=4, help="kernel size")
     parser.add_argument('--stride', type=int, default=2, help="stride")
     parser.add_argument('--class_dim', type=int, default=30, help="dimension of class vector")
@@ -54,12 +60,20 @@ def main():
     discriminator_coef = parser.discriminator_coef
 
     # load data
+    set_glyph_cache(parser.cache_size*1024*1024, parser.cache_path)
+    set_manifest(parser.manifest_path)
     imageName, imageDict = locate(data_path, styles=styles, max_label=categorical_cardinality)
     imageNum = len(imageName)
+    store = open_vector_store(parser.vector_path) if parser.vector_path else None
+    # the pretrained class vectors of all glyphs, indexed like imageName
+    class_vectors = load_class_vectors(imageName, store)
 
     image1 = tf.placeholder(tf.float32,[None, image_size, image_size, channel_size],name="image1")
     is_training = tf.placeholder(tf.bool,[],name="is_training")
-    zc_vector = tf.placeholder(tf.float32,[None, class_dim+style_dim+continuous_dim],name="zc_vector")
+    if parser.graph_noise:
+        zc_vector, zc_rows, zc_class_vectors, zc_class_vector_init = latent_sampler(class_dim,style_dim,continuous_dim,'latent')
+    else:
+        zc_vector = tf.placeholder(tf.float32,[None, class_dim+style_dim+continuous_dim],name="zc_vector")
 
     reconstruct_loss, continuous_loss, generator_loss, discriminator_loss, image_reconstruct = infogan(zc_vector,image1,kernel,stride,
                                                                                                        class_dim,style_dim,continuous_dim,is_training,
@@ -85,6 +99,8 @@ def main():
     saver = tf.train.Saver()
     with tf.Session(config=config) as sess:
         sess.run(tf.global_variables_initializer())
+        if parser.graph_noise:
+            sess.run(zc_class_vectors.initializer,feed_dict={zc_class_vector_init:class_vectors})
         for epoch in range(epochs):
             np.random.shuffle(idxes_1)
             reconstruct_losses = []
@@ -94,8 +110,13 @@ def main():
             
             for idx in range(0, imageNum, batch_size):
                 image1_batch = loader(imageName[idxes_1[idx:idx + batch_size]],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
-                vector = get_vector(imageName[idxes_1[idx:idx + batch_size]],style_dim,continuous_dim)
-                feed_dict_training = {image1:image1_batch,zc_vector:vector,is_training:True}
+                # with graph_noise the decoder and the discriminator steps draw their own noise for the same glyphs
+                if parser.graph_noise:
+                    vector = idxes_1[idx:idx + batch_size]
+                    feed_dict_training = {image1:image1_batch,zc_rows:vector,is_training:True}
+                else:
+                    vector = sample_latent(class_vectors,idxes_1[idx:idx + batch_size],style_dim,continuous_dim)
+                    feed_dict_training = {image1:image1_batch,zc_vector:vector,is_training:True}
 
                 # decoder
                 _,_,_,_reconstruct_loss,_continuous_loss,_generator_loss = sess.run([reconstruct_train,continuous_train,generator_train,reconstruct_loss,continuous_loss,generator_loss],feed_dict=feed_dict_training)
@@ -109,10 +130,12 @@ def main():
 
             print('epoch: %d\nreconstruct_loss: %f, continuous_loss: %f\ngenerator_loss: %f, discriminator_loss: %f\n' % (epoch, get_mean(reconstruct_losses), get_mean(continuous_losses), get_mean(generator_losses), get_mean(discriminator_losses)))
             
-            image1_plot = loader(imageName[idxes_1[0:10]],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
-            feed_dict_not_training = {image1:image1_plot,zc_vector:vector,is_training:False}
-            _image_reconstruct = sess.run(image_reconstruct,feed_dict=feed_dict_not_training)
-            plot(image1_plot, _image_reconstruct, epoch)
+            if epoch % parser.plot_every == 0:
+                image1_plot = loader(imageName[idxes_1[0:10]],desired_height=image_size,desired_width=image_size,value_range=(0.0, 1.0),force_grayscale=force_grayscale)
+                feed_dict_not_training = {image1:image1_plot,zc_rows if parser.graph_noise else zc_vector:vector,is_training:False}
+                _image_reconstruct = sess.run(image_reconstruct,feed_dict=feed_dict_not_training)
+                plot(image1_plot, _image_reconstruct, epoch)
+        flush_plots()
         saver.save(sess,'ckpt/infogan/model')
 
 